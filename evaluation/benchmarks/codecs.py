@@ -0,0 +1,72 @@
+import argparse
+import timeit
+from pathlib import Path
+
+from injection_attacks_mitigation_framework.end_to_end.compress_sqlite_advanced import merge_bucketed_data
+from injection_attacks_mitigation_framework.multi_stream.compress import (
+    CODEC_NAMES,
+    COMPRESSION_STREAMS,
+    MSCompressor,
+    MSDecompressor,
+    available_codecs,
+)
+from injection_attacks_mitigation_framework.partitioner.access_control import (
+    basic_partition_policy,
+    generate_attribute_based_partition_policy,
+)
+from injection_attacks_mitigation_framework.partitioner.types.sqlite_advanced import SQLiteAdvancedPartitioner
+from injection_attacks_mitigation_framework.partitioner.types.xml_advanced import XmlAdvancedPartitioner
+from tests.test_partitioner_sqlite import gid_as_principal_access_control_policy
+from tests.test_partitioner_xml import example_group_uuid_as_principal_keepass_sample_xml
+
+
+def partition_dataset(path: Path) -> list[tuple[str, bytes]]:
+    """Partition a WhatsApp database or KeePass XML export the same way the evaluation scripts do."""
+    if path.suffix == ".db":
+        partitioner = SQLiteAdvancedPartitioner(
+            path, gid_as_principal_access_control_policy, generate_attribute_based_partition_policy("gid")
+        )
+        return merge_bucketed_data(partitioner.partition())
+    if path.suffix == ".xml":
+        partitioner = XmlAdvancedPartitioner(
+            path, example_group_uuid_as_principal_keepass_sample_xml, basic_partition_policy
+        )
+        return partitioner.partition()
+    return [("file", path.read_bytes())]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("datasets", help="WhatsApp .db or KeePass .xml files generated for evaluation", nargs="+", type=Path)
+    parser.add_argument("--codecs", help="Codecs to compare", nargs="+", type=str, default=available_codecs())
+    parser.add_argument("--level", help="Compression level, the codec default if not given", type=int, default=None)
+    parser.add_argument("--trials", help="Number of trials", type=int, default=3)
+    args = parser.parse_args()
+
+    stream_params = {} if args.level is None else {"level": args.level}
+    print("dataset,codec,raw_bytes,compressed_bytes,ratio,compress_mb_s,decompress_mb_s")
+    for dataset in args.datasets:
+        bucketed_data = partition_dataset(dataset)
+        raw_bytes = sum(len(data) for _, data in bucketed_data)
+
+        for codec in args.codecs:
+
+            def compress():
+                msc = MSCompressor(COMPRESSION_STREAMS[CODEC_NAMES[codec]], **stream_params)
+                for bucket, data in bucketed_data:
+                    msc.compress(bucket, data)
+                return msc.finish()
+
+            def decompress():
+                msd = MSDecompressor()
+                msd.decompress(compressed)
+                return msd.finish()
+
+            compressed = compress()
+            compress_time = min(timeit.repeat(compress, number=1, repeat=args.trials))
+            decompress_time = min(timeit.repeat(decompress, number=1, repeat=args.trials))
+            mb = raw_bytes / 1e6
+            print(
+                f"{dataset.name},{codec},{raw_bytes},{len(compressed)},{raw_bytes / len(compressed):.3f},"
+                f"{mb / compress_time:.1f},{mb / decompress_time:.1f}"
+            )
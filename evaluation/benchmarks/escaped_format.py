@@ -0,0 +1,44 @@
+import argparse
+import os
+import timeit
+
+from injection_attacks_mitigation_framework.multi_stream.compress import MSDecompressor, ZlibDecompressionStream
+
+
+def bytewise_decode_add_output_delimiter(data: bytes, output_delimiter: bytes = b"\x7f") -> bytes:
+    """The byte by byte unescaping MSDecompressor used before it switched to bytes.replace, kept as a reference."""
+    output = []
+    pair = False
+    for b in data:
+        if pair:
+            o = 90 if b == 90 else int.from_bytes(output_delimiter)
+            output.append(o)
+            pair = False
+        elif b == 90:
+            pair = True
+        else:
+            output.append(b)
+    return bytes(output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", help="Sizes in MB of the escaped streams to decode", nargs="+", type=int, default=[1])
+    parser.add_argument("--trials", help="Number of trials", type=int, default=3)
+    args = parser.parse_args()
+
+    msd = MSDecompressor(ZlibDecompressionStream)
+    for size in args.size:
+        # Random bytes look like compressed data and contain both escaped bytes at the expected rate
+        data = os.urandom(size * 1024 * 1024)
+        escaped = data.replace(b"Z", b"ZZ").replace(msd.output_delimiter, b"Z:")
+        assert msd.decode_add_output_delimiter(escaped) == bytewise_decode_add_output_delimiter(escaped) == data
+
+        bytewise = min(
+            timeit.repeat(lambda: bytewise_decode_add_output_delimiter(escaped), number=1, repeat=args.trials)
+        )
+        replace_path = min(timeit.repeat(lambda: msd.decode_add_output_delimiter(escaped), number=1, repeat=args.trials))
+        print(
+            f"{size} MB: bytewise {size / bytewise:.1f} MB/s, replace {size / replace_path:.1f} MB/s, "
+            f"speedup {bytewise / replace_path:.0f}x"
+        )
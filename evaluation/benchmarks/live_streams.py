@@ -0,0 +1,46 @@
+import argparse
+import tracemalloc
+from pathlib import Path
+
+from evaluation.benchmarks.codecs import partition_dataset
+from injection_attacks_mitigation_framework.multi_stream.compress import MSCompressor, ZlibCompressionStream
+
+
+def compress_with_budget(bucketed_data: list[tuple[str, bytes]], max_live_streams: int) -> tuple[int, int, int]:
+    """Compress with a live stream budget, returning the archive size, the number of segments and the peak memory
+    allocated while compressing (zlib allocates its state through the Python allocator, so tracemalloc sees it).
+    """
+    tracemalloc.start()
+    msc = MSCompressor(ZlibCompressionStream, max_live_streams=max_live_streams)
+    for bucket, data in bucketed_data:
+        msc.compress(bucket, data)
+    segments = msc.segments
+    compressed = msc.finish()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return len(compressed), len(segments), peak
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("datasets", help="WhatsApp .db or KeePass .xml files generated for evaluation", nargs="+", type=Path)
+    parser.add_argument(
+        "--budgets",
+        help="Values of max_live_streams to compare, 0 is unbounded",
+        nargs="+",
+        type=int,
+        default=[0, 64, 16, 4, 1],
+    )
+    args = parser.parse_args()
+
+    print("dataset,streams,max_live_streams,segments,raw_bytes,compressed_bytes,ratio,peak_memory_bytes")
+    for dataset in args.datasets:
+        bucketed_data = partition_dataset(dataset)
+        raw_bytes = sum(len(data) for _, data in bucketed_data)
+        streams = len({bucket for bucket, _ in bucketed_data})
+        for budget in args.budgets:
+            compressed_bytes, segments, peak = compress_with_budget(bucketed_data, budget)
+            print(
+                f"{dataset.name},{streams},{budget},{segments},{raw_bytes},{compressed_bytes},"
+                f"{raw_bytes / compressed_bytes:.3f},{peak}"
+            )
@@ -0,0 +1,191 @@
+import argparse
+import itertools
+import json
+import platform
+import random
+import subprocess
+import tempfile
+import timeit
+import tracemalloc
+from pathlib import Path
+
+from injection_attacks_mitigation_framework.multi_stream.compress import (
+    MSCompressor,
+    MSDecompressor,
+    ZlibCompressionStream,
+)
+from injection_attacks_mitigation_framework.multi_stream.container import decode_header
+from injection_attacks_mitigation_framework.multi_stream.dedup import checksum_comparison_function, dedup
+
+WORDS = [b"alice", b"bob", b"message", b"hello", b"backup", b"sqlite", b"group", b"entry", b"\x00\x01", b"2024"]
+
+
+def generate_fragments(
+    buckets: int, fragment_size: int, run_length: int, total_size: int, seed: int = 0
+) -> list[tuple[int, bytes]]:
+    """Generate total_size bytes of fragments, run_length consecutive fragments going to the same bucket.
+
+    Fragments are a mix of a small vocabulary and random bytes, compressing about as well as database pages. The
+    number of switches between buckets follows from total_size, fragment_size and run_length.
+    """
+    rng = random.Random(seed)
+    fragments = []
+    bucket = 0
+    produced = 0
+    while produced < total_size:
+        if len(fragments) % run_length == 0:
+            bucket = rng.randrange(buckets)
+        fragment = bytearray()
+        while len(fragment) < fragment_size:
+            fragment += rng.choice(WORDS) if rng.random() < 0.8 else rng.randbytes(8)
+        fragments.append((bucket, bytes(fragment[:fragment_size])))
+        produced += fragment_size
+    return fragments
+
+
+def peak_memory(func) -> int:
+    """Peak number of bytes allocated while running func, zlib state included."""
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def bench_multi_stream(buckets: int, fragment_size: int, run_length: int, total_size: int, trials: int) -> dict:
+    """Time MSCompressor and MSDecompressor against a single ZlibCompressionStream over the same data."""
+    fragments = generate_fragments(buckets, fragment_size, run_length, total_size)
+    raw_bytes = sum(len(data) for _, data in fragments)
+    switches = sum(1 for a, b in zip(fragments, fragments[1:]) if a[0] != b[0])
+
+    def single_stream():
+        compression_stream = ZlibCompressionStream()
+        for _, data in fragments:
+            compression_stream.compress(data)
+        return compression_stream.finish()
+
+    def compress():
+        msc = MSCompressor(ZlibCompressionStream)
+        for bucket, data in fragments:
+            msc.compress(bucket, data)
+        return msc.finish()
+
+    def decompress():
+        msd = MSDecompressor()
+        msd.decompress(compressed)
+        return msd.finish()
+
+    compressed = compress()
+    single_stream_time = min(timeit.repeat(single_stream, number=1, repeat=trials))
+    compress_time = min(timeit.repeat(compress, number=1, repeat=trials))
+    decompress_time = min(timeit.repeat(decompress, number=1, repeat=trials))
+    header_bytes = len(compressed) - sum(entry.compressed_length for entry in decode_header(compressed).segments)
+    mb = raw_bytes / 1e6
+    return {
+        "benchmark": "multi_stream",
+        "buckets": buckets,
+        "fragment_size": fragment_size,
+        "run_length": run_length,
+        "total_size": raw_bytes,
+        "fragments": len(fragments),
+        "switches": switches,
+        "compressed_bytes": len(compressed),
+        "header_bytes": header_bytes,
+        "single_stream_compressed_bytes": len(single_stream()),
+        "single_stream_compress_mb_s": mb / single_stream_time,
+        "compress_mb_s": mb / compress_time,
+        "decompress_mb_s": mb / decompress_time,
+        "compress_peak_memory_bytes": peak_memory(compress),
+        "decompress_peak_memory_bytes": peak_memory(decompress),
+        "per_switch_header_bytes": header_bytes / max(switches, 1),
+        "per_switch_compress_us": max(compress_time - single_stream_time, 0) / max(switches, 1) * 1e6,
+    }
+
+
+def bench_dedup(files: int, file_size: int, duplicate_fraction: float, trials: int) -> dict:
+    """Time dedup with checksum_comparison_function over files of which duplicate_fraction are copies."""
+    rng = random.Random(0)
+    unique = max(int(files * (1 - duplicate_fraction)), 1)
+    contents = [rng.randbytes(file_size) for _ in range(unique)]
+    with tempfile.TemporaryDirectory() as tmp:
+        file_paths = []
+        for i in range(files):
+            path = Path(tmp) / f"{i}.bin"
+            path.write_bytes(contents[i % unique])
+            file_paths.append(path)
+        dedup_time = min(
+            timeit.repeat(lambda: dedup(checksum_comparison_function, file_paths), number=1, repeat=trials)
+        )
+        remaining = len(dedup(checksum_comparison_function, file_paths))
+    return {
+        "benchmark": "dedup",
+        "files": files,
+        "file_size": file_size,
+        "duplicate_fraction": duplicate_fraction,
+        "remaining_files": remaining,
+        "files_per_s": files / dedup_time,
+        "mb_s": files * file_size / 1e6 / dedup_time,
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def case_key(result: dict) -> tuple:
+    return tuple((k, v) for k, v in result.items() if not isinstance(v, float) and not k.endswith("bytes"))
+
+
+def compare(results: list[dict], baseline: list[dict]) -> None:
+    """Print the change of every throughput metric against a baseline run of the same cases."""
+    baseline_by_case = {case_key(result): result for result in baseline}
+    for result in results:
+        old = baseline_by_case.get(case_key(result))
+        if old is None:
+            continue
+        changes = [
+            f"{metric} {100 * (value / old[metric] - 1):+.1f}%"
+            for metric, value in result.items()
+            if metric.endswith("_s") and old.get(metric)
+        ]
+        print(f"{dict(case_key(result))}: {', '.join(changes)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--buckets", help="Numbers of buckets", nargs="+", type=int, default=[1, 16, 256, 4096])
+    parser.add_argument("--fragment-sizes", help="Fragment sizes in bytes", nargs="+", type=int, default=[64, 4096])
+    parser.add_argument(
+        "--run-lengths",
+        help="Consecutive fragments per bucket, sets the switch count",
+        nargs="+",
+        type=int,
+        default=[1, 16],
+    )
+    parser.add_argument("--total-sizes", help="Total sizes in MB", nargs="+", type=float, default=[4])
+    parser.add_argument("--dedup-files", help="Numbers of files for dedup", nargs="+", type=int, default=[100, 1000])
+    parser.add_argument("--trials", help="Number of trials", type=int, default=3)
+    parser.add_argument("--output", help="JSON file the results are written to", type=Path, default=None)
+    parser.add_argument("--compare", help="JSON file of an earlier run to compare against", type=Path, default=None)
+    args = parser.parse_args()
+
+    results = []
+    for buckets, fragment_size, run_length, total_size in itertools.product(
+        args.buckets, args.fragment_sizes, args.run_lengths, args.total_sizes
+    ):
+        result = bench_multi_stream(buckets, fragment_size, run_length, int(total_size * 1e6), args.trials)
+        print(json.dumps(result))
+        results.append(result)
+    for files in args.dedup_files:
+        result = bench_dedup(files, 4096, 0.5, args.trials)
+        print(json.dumps(result))
+        results.append(result)
+
+    if args.output is not None:
+        report = {"revision": git_revision(), "python": platform.python_version(), "results": results}
+        args.output.write_text(json.dumps(report, indent=2))
+    if args.compare is not None:
+        compare(results, json.loads(args.compare.read_text())["results"])
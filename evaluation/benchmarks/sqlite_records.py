@@ -0,0 +1,185 @@
+import argparse
+import mmap
+import random
+import sqlite3
+import struct
+import tempfile
+import timeit
+from pathlib import Path
+from typing import Callable
+
+from injection_attacks_mitigation_framework.partitioner.access_control import generate_attribute_based_partition_policy
+from injection_attacks_mitigation_framework.partitioner.types.sqlite_advanced import (
+    PAGE_TYPES,
+    SQLiteAdvancedPartitioner,
+    _decode_record,
+    _decode_record_header,
+    _payload_on_page,
+    _read_varint,
+)
+from tests.example_data.generate_test_db_sqlite import create_messages_db
+from tests.test_partitioner_sqlite import gid_as_principal_access_control_policy
+
+
+def reference_varint_to_integer(varint: bytes) -> tuple[int, int]:
+    """The byte loop SQLiteAdvancedPartitioner used before _read_varint, kept as a reference."""
+    value = 0
+    num_bytes = 0
+    for byte in varint:
+        num_bytes += 1
+        if (byte & 0x80) == 0:
+            break
+    for i in range(num_bytes):
+        value = (value << 7) | (varint[i] & 0x7F)
+    return value, num_bytes
+
+
+def reference_get_content_size_type(serial_type: int) -> tuple[int, Callable]:
+    """The if/elif chain SQLiteAdvancedPartitioner used before the serial type tables, kept as a reference."""
+    if serial_type == 0:
+        return 0, int.from_bytes
+    elif serial_type == 1:
+        return 1, int.from_bytes
+    elif serial_type == 2:
+        return 2, int.from_bytes
+    elif serial_type == 3:
+        return 3, int.from_bytes
+    elif serial_type == 4:
+        return 4, int.from_bytes
+    elif serial_type == 5:
+        return 6, int.from_bytes
+    elif serial_type == 6:
+        return 8, int.from_bytes
+    elif serial_type == 7:
+        return 8, int.from_bytes
+    elif serial_type == 8:
+        return 0, int.from_bytes
+    elif serial_type == 9:
+        return 0, int.from_bytes
+    elif serial_type >= 12 and serial_type % 2 == 0:
+        return (serial_type - 12) // 2, bytes
+    elif serial_type >= 13 and serial_type % 2 == 1:
+        return (serial_type - 13) // 2, lambda x: str(x, "utf-8")
+
+
+def reference_decode_record(payload: bytes) -> list:
+    """Record header and body decoding as SQLiteAdvancedPartitioner did it before, kept as a reference."""
+    payload_header_size, payload_header_offset = reference_varint_to_integer(payload[:9])
+    column_types = []
+    while payload_header_offset < payload_header_size:
+        column_serial_type, column_serial_type_bu = reference_varint_to_integer(
+            payload[payload_header_offset : payload_header_offset + 9]
+        )
+        column_types.append(column_serial_type)
+        payload_header_offset += column_serial_type_bu
+    record_data = payload[payload_header_size:]
+    record_offset = 0
+    row = []
+    for col in column_types:
+        if col == 0:
+            col_data = None
+        elif col == 8:
+            col_data = 0
+        elif col == 9:
+            col_data = 1
+        else:
+            col_data_size, col_data_type = reference_get_content_size_type(col)
+            col_data = col_data_type(record_data[record_offset : record_offset + col_data_size])
+            record_offset += col_data_size
+        row.append(col_data)
+    return row
+
+
+def decode_record(payload: bytes) -> list:
+    column_types, header_size = _decode_record_header(payload)
+    return _decode_record(payload[header_size:], column_types)
+
+
+def reference_cell_offsets(page: memoryview, num_cells: int) -> list[int]:
+    """The cell pointer array parsing SQLiteAdvancedPartitioner used before struct.unpack_from, kept as a reference."""
+    cell_pointer_array = page[8 : 8 + 2 * num_cells]
+    return sorted(int.from_bytes(cell_pointer_array[i * 2 : i * 2 + 2]) for i in range(num_cells))
+
+
+def cell_offsets(page: memoryview, num_cells: int) -> list[int]:
+    return sorted(struct.unpack_from(f">{num_cells}H", page, 8))
+
+
+def generate_messages_db(path: Path, rows: int) -> Path:
+    """A message table of rows rows, message lengths following roughly those of a chat history."""
+    rng = random.Random(0)
+    create_messages_db(str(path))
+    with sqlite3.connect(path) as con:
+        con.executemany(
+            "INSERT INTO message (gid, from_me, content) VALUES (?, ?, ?)",
+            (
+                (rng.randrange(200), rng.randrange(2), "hello " * int(rng.expovariate(1 / 15)))
+                for _ in range(rows)
+            ),
+        )
+    con.close()
+    return path
+
+
+def table_leaf_cells(db: memoryview, page_size: int) -> tuple[list[tuple[memoryview, int]], list[memoryview]]:
+    """Leaf pages with their cell count, and the payloads of the leaf cells that do not overflow."""
+    pages = []
+    payloads = []
+    for page_start in range(page_size, len(db), page_size):
+        page = db[page_start : page_start + page_size]
+        if page[0] != PAGE_TYPES["table_leaf"]:
+            continue
+        num_cells = struct.unpack_from(">H", page, 3)[0]
+        pages.append((page, num_cells))
+        for cell_offset in cell_offsets(page, num_cells):
+            payload_size, rowid_offset = _read_varint(page, cell_offset)
+            payload_offset = _read_varint(page, rowid_offset)[1]
+            if _payload_on_page(page_size, payload_size) == payload_size:
+                payloads.append(page[payload_offset : payload_offset + payload_size])
+    return pages, payloads
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("datasets", help="SQLite databases, a generated message table if none", nargs="*", type=Path)
+    parser.add_argument("--rows", help="Rows of the generated message table", type=int, default=50000)
+    parser.add_argument("--trials", help="Number of trials", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        datasets = args.datasets or [generate_messages_db(Path(tmp) / "messages.db", args.rows)]
+        for dataset in datasets:
+            with open(dataset, "rb") as f:
+                db = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            page_size = int.from_bytes(db[16:18])
+            pages, payloads = table_leaf_cells(db, page_size)
+            varint_positions = [(page, offset) for page, num_cells in pages for offset in cell_offsets(page, num_cells)]
+
+            cases = {
+                "varint": (
+                    lambda: [reference_varint_to_integer(page[o : o + 9]) for page, o in varint_positions],
+                    lambda: [_read_varint(page, o) for page, o in varint_positions],
+                ),
+                "cell_pointers": (
+                    lambda: [reference_cell_offsets(page, n) for page, n in pages],
+                    lambda: [cell_offsets(page, n) for page, n in pages],
+                ),
+                "records": (
+                    lambda: [reference_decode_record(p) for p in payloads],
+                    lambda: [decode_record(p) for p in payloads],
+                ),
+            }
+            for case, (reference, current) in cases.items():
+                reference_time = min(timeit.repeat(reference, number=1, repeat=args.trials))
+                current_time = min(timeit.repeat(current, number=1, repeat=args.trials))
+                print(
+                    f"{dataset.name} {case}: reference {reference_time * 1e3:.1f} ms, "
+                    f"current {current_time * 1e3:.1f} ms, speedup {reference_time / current_time:.1f}x"
+                )
+
+            partitioner = SQLiteAdvancedPartitioner(
+                dataset, gid_as_principal_access_control_policy, generate_attribute_based_partition_policy("gid")
+            )
+            partitioner.partition()
+            partition_time = min(timeit.repeat(partitioner.partition, number=1, repeat=args.trials))
+            print(f"{dataset.name} partition: {len(db) / 1e6 / partition_time:.1f} MB/s")
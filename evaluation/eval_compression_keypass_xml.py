@@ -44,6 +44,7 @@ if __name__ == "__main__":
         "compressed_bytes",
         "safe_compressed_bytes_simple",
         "safe_compressed_bytes_advanced",
+        "safe_compressed_bytes_advanced_dict",
         "unsafe_compressed_bytes_advanced",
     ]
 
@@ -82,6 +83,13 @@ if __name__ == "__main__":
                         if cleanup:
                             partition_path.unlink()
 
+                        # Same, with every stream primed with a dictionary built from the null principal bucket
+                        advanced_safe_dict_size = len(
+                            compress_xml_advanced_by_element(
+                                xml_path, example_group_uuid_as_principal_keepass_sample_xml, preset_dictionary=True
+                            )
+                        )
+
                         advanced_unsafe_compressed_bytes = unsafe_compress_xml_advanced_by_element(
                             xml_path, example_group_uuid_as_principal_keepass_sample_xml)
                         advanced_unsafe_compressed_path = args.output_dir / f"{n}_{m}_{dist}.db.gz.unsafe.advanced"
@@ -100,6 +108,7 @@ if __name__ == "__main__":
                                 compress_path.stat().st_size,
                                 simple_safe_size,
                                 advanced_safe_size,
+                                advanced_safe_dict_size,
                                 advanced_unsafe_size,
                             ]
                         )
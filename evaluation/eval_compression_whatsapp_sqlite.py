@@ -47,6 +47,7 @@ if __name__ == "__main__":
         "compressed_bytes",
         "safe_compressed_bytes_simple",
         "safe_compressed_bytes_advanced",
+        "safe_compressed_bytes_advanced_dict",
         "unsafe_compressed_bytes_advanced",
     ]
 
@@ -73,6 +74,9 @@ if __name__ == "__main__":
                     advanced_safe_compressed_path = args.output_dir / f"{n}_{m}_{dist}.db.gz.safe.advanced"
                     advanced_safe_compressed_path.write_bytes(advanced_compressed_bytes)
 
+                    # Same, with every stream primed with a dictionary built from the rows of the null principal
+                    advanced_dict_compressed_bytes = compress_sqlite_advanced(db_path, gid_as_principal_access_control_policy, generate_attribute_based_partition_policy("gid"), preset_dictionary=True)
+
                     advanced_unsafe_compressed_bytes = unsafe_compress_sqlite_advanced(db_path, gid_as_principal_access_control_policy, generate_attribute_based_partition_policy("gid"))
                     advanced_unsafe_compressed_path = args.output_dir / f"{n}_{m}_{dist}.db.gz.unsafe.advanced"
                     advanced_unsafe_compressed_path.write_bytes(advanced_unsafe_compressed_bytes)
@@ -91,6 +95,7 @@ if __name__ == "__main__":
                             compressed_db_path.stat().st_size,
                             safe_compressed_db_path.stat().st_size,
                             advanced_safe_compressed_path.stat().st_size,
+                            len(advanced_dict_compressed_bytes),
                             advanced_unsafe_compressed_path.stat().st_size,
                         ]
                     )
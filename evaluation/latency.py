@@ -118,7 +118,7 @@ if __name__ == "__main__":
                         merged_bucketed_data = merge_bucketed_data(bucketed_data)
                         return merged_bucketed_data
                     def safe_compress_func(merged_bucketed_data):
-                        msc = MSCompressor(ZlibCompressionStream, stream_switch_delimiter=b"[|\\")
+                        msc = MSCompressor(ZlibCompressionStream)
                         for bucket, data in merged_bucketed_data:
                             msc.compress(bucket, data)
                         out = msc.finish()
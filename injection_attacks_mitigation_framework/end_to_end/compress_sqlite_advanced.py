@@ -1,4 +1,5 @@
-from collections.abc import Callable
+import itertools
+from collections.abc import Callable, Iterable, Mapping
 from pathlib import Path
 
 from injection_attacks_mitigation_framework.multi_stream.compress import (
@@ -6,43 +7,70 @@ from injection_attacks_mitigation_framework.multi_stream.compress import (
     MSDecompressor,
     ZlibCompressionStream,
     ZlibDecompressionStream,
+    build_preset_dictionary,
+)
+from injection_attacks_mitigation_framework.partitioner.access_control import Principal
+from injection_attacks_mitigation_framework.partitioner.types.sqlite_advanced import (
+    SQLiteAdvancedPartitioner,
+    SQLiteDataUnit,
 )
-from injection_attacks_mitigation_framework.partitioner.access_control import Principal, SQLiteDataUnit
-from injection_attacks_mitigation_framework.partitioner.types.sqlite_advanced import SQLiteAdvancedPartitioner
 
 
 def compress_sqlite_advanced(
     db_path: Path,
     access_control_policy: Callable[[SQLiteDataUnit], Principal],
     partition_policy: Callable[[Principal], str],
+    preset_dictionary: bool = False,
+    columns: Mapping[str, Iterable[int]] | None = None,
 ) -> bytes:
     """Implements end to end safe compression for SQLite
 
     The application provides a Python function that extracts the principal from an SQLiteDataUnit (table + row) for
     use as the access control policy
 
+    The whole database is compressed on every call. SQLite updates pages in place, so a newer version of a database is
+    not its previous content followed by new data, which is all an archive appended to by MSCompressor(append=True)
+    can decompress to.
+
     Args:
     ----
         db_path: The SQLite DB to be compressed
         access_control_policy: Access control policy provided by application
+        preset_dictionary: Prime every stream with a dictionary built from the rows the access control policy gives to
+        the null principal. The rest of the null principal bucket is left out, index pages in particular carry the
+        indexed values of every principal's rows
+        columns: Indexes of the columns the access control policy reads, by table name, see SQLiteAdvancedPartitioner
 
     Returns:
     -------
         Bytes of the safely compressed database
 
     """
-    partitioner = SQLiteAdvancedPartitioner(db_path, access_control_policy, partition_policy)
+    # The database stays mapped while it is compressed, and is unmapped once the slices of it are gone
+    with SQLiteAdvancedPartitioner(
+        db_path, access_control_policy, partition_policy, zero_copy=True, columns=columns
+    ) as partitioner:
+        return _compress_partitioned(partitioner, preset_dictionary)
+
+
+def _compress_partitioned(partitioner: SQLiteAdvancedPartitioner, preset_dictionary: bool) -> bytes:
+    """Compress the buckets of a zero_copy partitioner, every slice of the mapping is released on return."""
     bucketed_data = partitioner.partition()
     merged_bucketed_data = merge_bucketed_data(bucketed_data)
 
-    msc = MSCompressor(ZlibCompressionStream, stream_switch_delimiter=b"[|\\")
+    dictionary = build_preset_dictionary(partitioner.shared_cells) if preset_dictionary else None
+
+    msc = MSCompressor(ZlibCompressionStream, preset_dictionary=dictionary)
     for bucket, data in merged_bucketed_data:
         msc.compress(bucket, data)
-    return msc.finish()
+    compressed = msc.finish()
+    # Without a sink the archive is returned
+    assert compressed is not None
+    return compressed
 
 
 def decompress_sqlite_advanced(ms_compressed_data: bytes) -> bytes:
-    msd = MSDecompressor(ZlibDecompressionStream, stream_switch_delimiter=b"[|\\")
+    msd = MSDecompressor(ZlibDecompressionStream)
     msd.decompress(ms_compressed_data)
     return msd.finish()
 
@@ -66,17 +94,12 @@ def unsafe_compress_sqlite_advanced(
     return usc.finish()
 
 
-def merge_bucketed_data(bucketed_data: list[tuple[str, bytes]]) -> list[tuple[str, bytes]]:
-    # Merge adjacent buckets with same principal
+def merge_bucketed_data(
+    bucketed_data: list[tuple[str, bytes | memoryview]],
+) -> list[tuple[str, bytes | memoryview]]:
+    # Merge adjacent buckets with same principal, a bucket on its own is passed on as is so views are not copied
     merged_bucketed_data = []
-    current_bucket = bucketed_data[0][0]
-    current_bucket_bytes = bucketed_data[0][1]
-    for i in range(1, len(bucketed_data)):
-        if bucketed_data[i][0] == current_bucket:
-            current_bucket_bytes += bucketed_data[i][1]
-        else:
-            merged_bucketed_data.append((current_bucket, current_bucket_bytes))
-            current_bucket = bucketed_data[i][0]
-            current_bucket_bytes = bucketed_data[i][1]
-    merged_bucketed_data.append((current_bucket, current_bucket_bytes))
+    for bucket, run in itertools.groupby(bucketed_data, key=lambda x: x[0]):
+        run_data = [data for _, data in run]
+        merged_bucketed_data.append((bucket, run_data[0] if len(run_data) == 1 else b"".join(run_data)))
     return merged_bucketed_data
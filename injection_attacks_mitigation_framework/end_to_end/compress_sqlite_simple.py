@@ -1,3 +1,5 @@
+import mmap
+import os
 from pathlib import Path
 from typing import Callable
 
@@ -17,9 +19,18 @@ def compress_sqlite_simple(
     partitioner = SQLiteSimplePartitioner(db_path, access_control_policy, partition_policy)
     db_bucket_paths = partitioner.partition()
 
-    msc = MSCompressor(ZlibCompressionStream, stream_switch_delimiter=b"[|\\")
+    msc = MSCompressor(ZlibCompressionStream)
     for db_bucket_path in db_bucket_paths:
+        # Compress straight from a mapping of the bucket database rather than a copy read into memory
         with db_bucket_path.open(mode="rb") as f:
-            msc.compress(db_bucket_path.name, f.read())
+            if f.seek(0, os.SEEK_END) == 0:
+                # Empty files cannot be mapped
+                msc.compress(db_bucket_path.name, b"")
+                continue
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as db_bucket:
+                msc.compress(db_bucket_path.name, db_bucket)
 
-    return msc.finish()
+    compressed = msc.finish()
+    # Without a sink the archive is returned
+    assert compressed is not None
+    return compressed
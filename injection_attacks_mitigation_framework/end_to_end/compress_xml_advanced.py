@@ -6,6 +6,7 @@ from injection_attacks_mitigation_framework.multi_stream.compress import (
     MSDecompressor,
     ZlibCompressionStream,
     ZlibDecompressionStream,
+    build_preset_dictionary,
 )
 from injection_attacks_mitigation_framework.partitioner.access_control import (
     Principal,
@@ -16,7 +17,7 @@ from injection_attacks_mitigation_framework.partitioner.types.xml_advanced impor
 
 
 def compress_xml_advanced_by_element(
-    xml_file: Path, access_control_policy: Callable[[XMLDataUnit], Principal]
+    xml_file: Path, access_control_policy: Callable[[XMLDataUnit], Principal], preset_dictionary: bool = False
 ) -> bytes:
     """Implements an XML compression scenario where the principal is encoded as an XML element.
 
@@ -27,6 +28,7 @@ def compress_xml_advanced_by_element(
     ----
         xml_file: The XML file to be compressed
         access_control_policy: Access control policy provided by application
+        preset_dictionary: Prime every stream with a dictionary built from the null principal bucket
 
     Returns:
     -------
@@ -35,10 +37,17 @@ def compress_xml_advanced_by_element(
     """
     partitioner = XmlAdvancedPartitioner(xml_file, access_control_policy, basic_partition_policy)
     bucketed_data = partitioner.partition()
-    msc = MSCompressor(ZlibCompressionStream)
+    dictionary = None
+    if preset_dictionary:
+        null_bucket = basic_partition_policy(Principal(null=True))
+        dictionary = build_preset_dictionary(data for bucket, data in bucketed_data if bucket == null_bucket)
+    msc = MSCompressor(ZlibCompressionStream, preset_dictionary=dictionary)
     for bucket, data in bucketed_data:
         msc.compress(bucket, data)
-    return msc.finish()
+    compressed = msc.finish()
+    # Without a sink the archive is returned
+    assert compressed is not None
+    return compressed
 
 
 def decompress_xml_advanced_by_element(ms_compressed_data: bytes) -> bytes:
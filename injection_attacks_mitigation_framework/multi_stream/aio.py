@@ -0,0 +1,184 @@
+"""Implements an asyncio front-end for multi stream compression.
+
+MSCompressor and MSDecompressor are synchronous and not thread safe. The classes here run every call to them on an
+executor, one at a time and in order, so the event loop never blocks on codec work and many archive jobs can share one
+loop. Parallelism across the streams of a single archive still comes from the workers parameter of the wrapped classes.
+"""
+
+import asyncio
+from collections.abc import AsyncIterator
+from concurrent.futures import Executor
+from typing import Any, BinaryIO, Protocol, cast
+
+from typing_extensions import Buffer
+
+from injection_attacks_mitigation_framework.multi_stream.compress import (
+    DEFAULT_CHUNK_SIZE,
+    CompressionStream,
+    MSCompressor,
+    MSDecompressor,
+)
+from injection_attacks_mitigation_framework.multi_stream.container import ArchiveData
+
+DEFAULT_MAX_PENDING = 16
+
+
+class AsyncWriter(Protocol):
+    """Destination of an archive or of decompressed data, e.g. an asyncio.StreamWriter."""
+
+    def write(self, data: bytes) -> None: ...
+
+    async def drain(self) -> None: ...
+
+
+class _ThreadsafeWriter:
+    """File-like object handed to MSCompressor as a sink, forwarding every write from the executor to an AsyncWriter.
+
+    Each write waits until the writer has drained, so the archive is copied out with bounded memory.
+    """
+
+    def __init__(self, writer: AsyncWriter, loop: asyncio.AbstractEventLoop) -> None:
+        self.writer = writer
+        self.loop = loop
+
+    def write(self, data: bytes) -> int:
+        asyncio.run_coroutine_threadsafe(self._write(bytes(data)), self.loop).result()
+        return len(data)
+
+    async def _write(self, data: bytes) -> None:
+        self.writer.write(data)
+        await self.writer.drain()
+
+
+class AsyncMSCompressor:
+    """asyncio front-end for MSCompressor.
+
+    Attributes:
+    ----------
+        compressor: The wrapped MSCompressor, only ever called from the executor
+        writer: Optional AsyncWriter the archive is streamed to by finish. Compressed output is then spilled to a
+        temporary file as it is produced (see MSCompressor.sink) rather than held in memory.
+        executor: Executor running the codec work, the event loop's default executor if None
+        max_pending: Maximum number of chunks accepted but not yet compressed. Once reached, compress waits, which
+        applies backpressure to the producers.
+
+    """
+
+    def __init__(
+        self,
+        stream_type: type[CompressionStream],
+        writer: AsyncWriter | None = None,
+        executor: Executor | None = None,
+        max_pending: int = DEFAULT_MAX_PENDING,
+        **compressor_params: Any,
+    ) -> None:
+        if compressor_params.get("append"):
+            # Appending reads the archive back from the sink, which an AsyncWriter cannot do
+            raise ValueError("AsyncMSCompressor cannot append, use MSCompressor with a file or path as sink")
+        self.writer = writer
+        self.executor = executor
+        self.max_pending = max_pending
+        self._loop = asyncio.get_running_loop()
+        # Without append, MSCompressor only ever calls write on the sink
+        sink = cast(BinaryIO, _ThreadsafeWriter(writer, self._loop)) if writer is not None else None
+        self.compressor = MSCompressor(stream_type, sink=sink, **compressor_params)
+        self._queue: asyncio.Queue[tuple[Any, Buffer] | None] = asyncio.Queue(maxsize=max_pending)
+        self._consumer = asyncio.create_task(self._consume())
+
+    async def _consume(self) -> None:
+        """Pass queued chunks to the compressor in order, a None chunk ends the queue."""
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            await self._loop.run_in_executor(self.executor, self.compressor.compress, *item)
+
+    async def compress(self, stream_key: Any, data: Buffer) -> None:
+        """Queue data for a stream, waiting while max_pending chunks are already queued.
+
+        data can be any object supporting the buffer protocol and is not copied, so it must not be modified until
+        finish.
+
+        Raises
+        ------
+            Any error the compressor hit on an earlier chunk.
+
+        """
+        if self._consumer.done():
+            self._consumer.result()
+            raise RuntimeError("Compressor is finished")
+        await self._put((stream_key, data))
+
+    async def _put(self, item: tuple[Any, Buffer] | None) -> None:
+        """Queue an item, giving up if the consumer stops on an error while the queue is full."""
+        put = asyncio.ensure_future(self._queue.put(item))
+        await asyncio.wait([put, self._consumer], return_when=asyncio.FIRST_COMPLETED)
+        if not put.done():
+            put.cancel()
+            self._consumer.result()
+
+    async def finish(self) -> bytes | None:
+        """Compress the queued chunks and flush all streams.
+
+        Returns
+        -------
+            The archive, or None once it has been written to the writer.
+
+        """
+        if not self._consumer.done():
+            await self._put(None)
+        await self._consumer
+        return await self._loop.run_in_executor(self.executor, self.compressor.finish)
+
+
+class AsyncMSDecompressor:
+    """asyncio front-end for MSDecompressor.
+
+    Attributes:
+    ----------
+        decompressor: The wrapped MSDecompressor, only ever called from the executor
+        executor: Executor running the codec work, the event loop's default executor if None
+
+    """
+
+    def __init__(self, executor: Executor | None = None, **decompressor_params: Any) -> None:
+        self.executor = executor
+        self.decompressor = MSDecompressor(**decompressor_params)
+        self._loop = asyncio.get_running_loop()
+
+    async def decompress(self, compressed_data: ArchiveData) -> None:
+        """Locate every stream in an archive."""
+        await self._loop.run_in_executor(self.executor, self.decompressor.decompress, compressed_data)
+
+    async def decompress_from(self, reader: asyncio.StreamReader) -> None:
+        """Read an archive from an async reader until EOF and locate every stream in it.
+
+        The header refers to segments anywhere in the archive, so the whole archive is read before decoding it.
+        """
+        compressed_data = bytearray()
+        while chunk := await reader.read(DEFAULT_CHUNK_SIZE):
+            compressed_data += chunk
+        await self.decompress(compressed_data)
+
+    async def iter_chunks(self, chunk_size: int = DEFAULT_CHUNK_SIZE) -> AsyncIterator[bytes]:
+        """Yield the decompressed data in its original order, see MSDecompressor.iter_chunks."""
+        chunks = self.decompressor.iter_chunks(chunk_size)
+        while True:
+            chunk = await self._loop.run_in_executor(self.executor, next, chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+
+    async def write_to(self, writer: AsyncWriter, chunk_size: int = DEFAULT_CHUNK_SIZE) -> None:
+        """Stream the decompressed data to an async writer, waiting for it to drain after every chunk."""
+        async for chunk in self.iter_chunks(chunk_size):
+            writer.write(chunk)
+            await writer.drain()
+
+    async def finish(self) -> bytes:
+        """Flush all decompression streams, see MSDecompressor.finish."""
+        return await self._loop.run_in_executor(self.executor, self.decompressor.finish)
+
+    async def extract_bucket(self, stream_key: Any) -> bytes:
+        """Return the data written to one stream, see MSDecompressor.extract_bucket."""
+        return await self._loop.run_in_executor(self.executor, self.decompressor.extract_bucket, stream_key)
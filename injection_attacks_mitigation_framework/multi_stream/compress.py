@@ -1,9 +1,62 @@
 """Implements multi stream compression."""
 
+import bz2
 import json
+import lzma
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+import time
 import zlib
+from collections import deque
+from collections.abc import Iterable, Iterator
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Any, BinaryIO, Protocol
 
-from typing_extensions import override
+from typing_extensions import Buffer, override
+
+from injection_attacks_mitigation_framework.multi_stream.container import (
+    ArchiveData,
+    BucketIndex,
+    ContainerHeader,
+    build_bucket_index,
+    decode_archive,
+    encode_header,
+    is_container,
+)
+from injection_attacks_mitigation_framework.multi_stream.stats import ArchiveStats, StatsCallback, StreamStats
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Codec ids recorded in the container header
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+CODEC_BZ2 = 3
+CODEC_ZSTD = 4
+
+# Size of the zlib window, the history a deflate stream can refer back to
+ZLIB_WINDOW_SIZE = 32 * 1024
+
+# Size of the dictionaries built by build_preset_dictionary, matching the zlib window
+DEFAULT_DICTIONARY_SIZE = ZLIB_WINDOW_SIZE
+
+# Size of the blocks ParallelZlibCompressionStream compresses independently, as in pigz
+DEFAULT_BLOCK_SIZE = 128 * 1024
+
+# Upper bound on the size of the plaintext chunks produced while decompressing incrementally
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+# With workers, the number of compress calls per worker that may be queued before compress blocks
+MAX_PENDING_PER_WORKER = 16
+
+# A fragment as MSCompressor.compress passes it on, a buffer whose length and slices are in bytes
+FragmentData = bytes | bytearray | mmap.mmap | memoryview
 
 
 class StreamClosedException(Exception):
@@ -14,27 +67,48 @@ class StreamClosedException(Exception):
 
 
 class CompressionStream:
-    """Base class for compression."""
+    """Base class for compression.
+
+    Child classes take their codec parameters as keyword arguments, e.g. the level a StreamPolicy picks. Those that
+    set supports_zdict accept a zdict keyword argument: a preset dictionary the stream is primed with. compress accepts
+    any object supporting the buffer protocol and hands it to the codec without copying.
+    """
+
+    codec_id: int = 0
+    supports_zdict: bool = False
 
-    def __init__(self, *parameters) -> None:
+    def __init__(self, *parameters: Any, **options: Any) -> None:
         pass
 
-    def compress(self, data: bytes) -> None:
+    def compress(self, data: Buffer) -> None:
         """Child classes must implement this method."""
         raise NotImplementedError
 
+    def take(self) -> bytes:
+        """Return the compressed output produced so far and drop it from the stream.
+
+        Child classes must implement this method.
+        """
+        raise NotImplementedError
+
     def finish(self) -> bytes:
         """Child classes must implement this method."""
         raise NotImplementedError
 
 
 class DecompressionStream:
-    """Base class for decompression."""
+    """Base class for decompression.
+
+    decompress and iter_decompress accept any object supporting the buffer protocol, e.g. a slice of a mapped archive.
+    """
 
-    def __init__(self, *parameters) -> None:
+    codec_id: int = 0
+    supports_zdict: bool = False
+
+    def __init__(self, *parameters: Any, **options: Any) -> None:
         pass
 
-    def decompress(self, data: bytes) -> None:
+    def decompress(self, data: Buffer) -> None:
         """Child classes must implement this method."""
         raise NotImplementedError
 
@@ -42,39 +116,89 @@ class DecompressionStream:
         """Child classes must implement this method."""
         raise NotImplementedError
 
+    def iter_decompress(self, data: Buffer, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[bytes]:
+        """Decompress data as a whole stream, yielding the output in chunks of at most chunk_size bytes.
 
-class ZlibCompressionStream(CompressionStream):
-    """Wraps zlib compression.
+        Child classes should override this with a genuinely incremental implementation, the default decompresses
+        everything before yielding.
+        """
+        self.decompress(data)
+        out = self.finish()
+        for i in range(0, len(out), chunk_size):
+            yield out[i : i + chunk_size]
+
+
+class _Compressor(Protocol):
+    """Interface of the compressor objects of zlib, lzma, bz2 and zstandard."""
+
+    def compress(self, data: Buffer, /) -> bytes: ...
+
+    def flush(self) -> bytes: ...
+
+
+class _WrappedCompressionStream(CompressionStream):
+    """Wraps a compressor object exposing compress and flush, as zlib, lzma, bz2 and zstandard all do.
 
     Attributes
     ----------
-        compression_object: A zlib compressobj.
+        compression_object: The wrapped compressor, set by child classes.
         compressed: The compression stream.
         finished: Boolean indicating whether stream is finished.
 
     """
 
-    def __init__(self, level: int = -1) -> None:
+    compression_object: _Compressor
+
+    def __init__(self) -> None:
         super().__init__()
-        self.compression_object = zlib.compressobj(level=level)
-        self.compressed = b""
+        self.compressed = bytearray()
         self.finished = False
 
     @override
-    def compress(self, data: bytes) -> None:
+    def compress(self, data: Buffer) -> None:
         if self.finished:
             raise StreamClosedException
         c = self.compression_object.compress(data)
         self.compressed += c
 
+    @override
+    def take(self) -> bytes:
+        if self.finished:
+            raise StreamClosedException
+        c = bytes(self.compressed)
+        self.compressed.clear()
+        return c
+
     @override
     def finish(self) -> bytes:
-        """Return the entire compression of input bytes."""
+        """Return the compression of input bytes that has not already been returned by take."""
         if self.finished:
             raise StreamClosedException
         self.compressed += self.compression_object.flush()
         self.finished = True
-        return self.compressed
+        return bytes(self.compressed)
+
+
+class ZlibCompressionStream(_WrappedCompressionStream):
+    """Wraps zlib compression.
+
+    Attributes
+    ----------
+        compression_object: A zlib compressobj.
+        compressed: The compression stream.
+        finished: Boolean indicating whether stream is finished.
+
+    """
+
+    codec_id = CODEC_ZLIB
+    supports_zdict = True
+
+    def __init__(self, level: int = -1, zdict: bytes | None = None) -> None:
+        super().__init__()
+        if zdict:
+            self.compression_object = zlib.compressobj(level=level, zdict=zdict)
+        else:
+            self.compression_object = zlib.compressobj(level=level)
 
 
 class ZlibDecompressionStream(DecompressionStream):
@@ -88,14 +212,17 @@ class ZlibDecompressionStream(DecompressionStream):
 
     """
 
-    def __init__(self):
+    codec_id = CODEC_ZLIB
+    supports_zdict = True
+
+    def __init__(self, zdict: bytes | None = None):
         super().__init__()
-        self.decompression_object = zlib.decompressobj()
-        self.decompressed = b""
+        self.decompression_object = zlib.decompressobj(zdict=zdict) if zdict else zlib.decompressobj()
+        self.decompressed = bytearray()
         self.finished = False
 
     @override
-    def decompress(self, compressed_data: bytes) -> None:
+    def decompress(self, compressed_data: Buffer) -> None:
         if self.finished:
             raise StreamClosedException
         d = self.decompression_object.decompress(compressed_data)
@@ -107,21 +234,761 @@ class ZlibDecompressionStream(DecompressionStream):
             raise StreamClosedException
         self.decompressed += self.decompression_object.flush()
         self.finished = True
-        return self.decompressed
+        return bytes(self.decompressed)
+
+    @override
+    def iter_decompress(self, data: Buffer, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[bytes]:
+        """Input is fed in slices of chunk_size so the unconsumed_tail copies zlib makes stay small."""
+        if self.finished:
+            raise StreamClosedException
+        view = memoryview(data)
+        for start in range(0, len(view), chunk_size):
+            pending: bytes | memoryview = view[start : start + chunk_size]
+            while pending:
+                out = self.decompression_object.decompress(pending, chunk_size)
+                if out:
+                    yield out
+                pending = self.decompression_object.unconsumed_tail
+        self.finished = True
+        if out := self.decompression_object.flush():
+            yield out
+
+
+class ParallelZlibCompressionStream(CompressionStream):
+    """zlib compression of a single stream split in blocks compressed in parallel, as pigz does.
+
+    Every block is raw deflated on an executor, primed with the 32 KB of data preceding it as a dictionary, and ended
+    with a sync flush so the blocks concatenate into one deflate stream. The output is an ordinary zlib stream, read by
+    ZlibDecompressionStream like any other, at the cost of a few bytes per block. The data itself is only held until
+    its block is compressed, at most two blocks per executor thread are in flight.
+
+    Attributes
+    ----------
+        level: zlib compression level
+        zdict: Preset dictionary the first block is primed with
+        block_size: Number of bytes compressed by every block
+        executor: Executor the blocks are compressed on. If None, a pool with a thread per CPU is created once the
+        stream grows past one block, so small streams are compressed on the calling thread only. Pass a shared
+        executor when many streams are compressed at once (MSCompressor passes its stream parameters to every stream).
+        compressed: Compressed output of the finished blocks not taken yet
+        finished: Boolean indicating whether stream is finished.
+
+    """
+
+    codec_id = CODEC_ZLIB
+    supports_zdict = True
+
+    def __init__(
+        self,
+        level: int = -1,
+        zdict: bytes | None = None,
+        block_size: int = DEFAULT_BLOCK_SIZE,
+        executor: Executor | None = None,
+    ) -> None:
+        super().__init__()
+        self.level = level
+        self.zdict = zdict or b""
+        self.block_size = block_size
+        self.executor = executor
+        self._owns_executor = False
+        self._max_in_flight = 2 * (os.cpu_count() or 1)
+        # The zlib header, with the dictionary id when primed, is that of an empty stream compressed the same way
+        empty_stream = (zlib.compressobj(level, zdict=zdict) if zdict else zlib.compressobj(level)).flush()
+        self.compressed = bytearray(empty_stream[: 6 if zdict else 2])
+        self.finished = False
+        self._checksum = zlib.adler32(b"")
+        self._history = self.zdict[-ZLIB_WINDOW_SIZE:]
+        self._pending = bytearray()
+        self._blocks: deque[Future[bytes]] = deque()
+
+    @override
+    def compress(self, data: Buffer) -> None:
+        if self.finished:
+            raise StreamClosedException
+        self._checksum = zlib.adler32(data, self._checksum)
+        self._pending += data
+        if len(self._pending) < self.block_size:
+            return
+        view = memoryview(self._pending)
+        end = len(view) - len(view) % self.block_size
+        for start in range(0, end, self.block_size):
+            self._submit(bytes(view[start : start + self.block_size]))
+        view.release()
+        del self._pending[:end]
+
+    def _submit(self, block: bytes) -> None:
+        """Compress a block on the executor, waiting for the oldest block if too many are in flight."""
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+            self._owns_executor = True
+        self._blocks.append(self.executor.submit(_deflate_block, block, self.level, self._history, False))
+        self._history = (self._history + block)[-ZLIB_WINDOW_SIZE:]
+        self._collect(wait_oldest=len(self._blocks) > self._max_in_flight)
+
+    def _collect(self, wait_oldest: bool = False) -> None:
+        """Move the output of the finished blocks at the front of the queue to compressed."""
+        while self._blocks and (wait_oldest or self._blocks[0].done()):
+            self.compressed += self._blocks.popleft().result()
+            wait_oldest = False
+
+    @override
+    def take(self) -> bytes:
+        if self.finished:
+            raise StreamClosedException
+        self._collect()
+        c = bytes(self.compressed)
+        self.compressed.clear()
+        return c
+
+    @override
+    def finish(self) -> bytes:
+        """Compress the last block on the calling thread and return the output not already returned by take."""
+        if self.finished:
+            raise StreamClosedException
+        last_block = _deflate_block(bytes(self._pending), self.level, self._history, True)
+        try:
+            while self._blocks:
+                self._collect(wait_oldest=True)
+        finally:
+            if self._owns_executor and self.executor is not None:
+                self.executor.shutdown()
+        self.compressed += last_block + self._checksum.to_bytes(4, "big")
+        self.finished = True
+        return bytes(self.compressed)
+
+
+def _deflate_block(block: bytes, level: int, history: bytes, last: bool) -> bytes:
+    """Raw deflate one block of a ParallelZlibCompressionStream, byte aligned by a sync flush unless it is the last."""
+    if history:
+        compression_object = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=history)
+    else:
+        compression_object = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    compressed = compression_object.compress(block)
+    return compressed + compression_object.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class LzmaCompressionStream(_WrappedCompressionStream):
+    """Wraps lzma compression (xz container), slow but with the best ratio of the stdlib codecs.
+
+    Attributes
+    ----------
+        compression_object: An lzma.LZMACompressor.
+        compressed: The compression stream.
+        finished: Boolean indicating whether stream is finished.
+
+    """
+
+    codec_id = CODEC_LZMA
+
+    def __init__(self, level: int = 6) -> None:
+        super().__init__()
+        self.compression_object = lzma.LZMACompressor(preset=level)
+
+
+class Bz2CompressionStream(_WrappedCompressionStream):
+    """Wraps bz2 compression.
+
+    Attributes
+    ----------
+        compression_object: A bz2.BZ2Compressor.
+        compressed: The compression stream.
+        finished: Boolean indicating whether stream is finished.
+
+    """
+
+    codec_id = CODEC_BZ2
+
+    def __init__(self, level: int = 9) -> None:
+        super().__init__()
+        self.compression_object = bz2.BZ2Compressor(level)
+
+
+class _LimitedDecompressor(Protocol):
+    """Interface of the decompressor objects of lzma and bz2."""
+
+    @property
+    def eof(self) -> bool: ...
+
+    @property
+    def needs_input(self) -> bool: ...
+
+    def decompress(self, data: Buffer, max_length: int = -1) -> bytes: ...
+
+
+class _LimitedDecompressionStream(DecompressionStream):
+    """Wraps a decompressor object with the lzma/bz2 interface: decompress(data, max_length), needs_input and eof.
+
+    Attributes
+    ----------
+        decompression_object: The wrapped decompressor, set by child classes.
+        decompressed: The decompression stream.
+        finished: Boolean indicating whether stream is finished.
+
+    """
+
+    decompression_object: _LimitedDecompressor
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.decompressed = bytearray()
+        self.finished = False
+
+    @override
+    def decompress(self, compressed_data: Buffer) -> None:
+        if self.finished:
+            raise StreamClosedException
+        d = self.decompression_object.decompress(compressed_data)
+        self.decompressed += d
+
+    @override
+    def finish(self) -> bytes:
+        if self.finished:
+            raise StreamClosedException
+        self.finished = True
+        return bytes(self.decompressed)
+
+    @override
+    def iter_decompress(self, data: Buffer, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[bytes]:
+        if self.finished:
+            raise StreamClosedException
+        view = memoryview(data)
+        for start in range(0, len(view), chunk_size):
+            out = self.decompression_object.decompress(view[start : start + chunk_size], chunk_size)
+            if out:
+                yield out
+            # Output beyond max_length stays buffered inside the decompressor until it is asked for more
+            while not self.decompression_object.needs_input and not self.decompression_object.eof:
+                out = self.decompression_object.decompress(b"", chunk_size)
+                if out:
+                    yield out
+            if self.decompression_object.eof:
+                break
+        self.finished = True
+
+
+class LzmaDecompressionStream(_LimitedDecompressionStream):
+    """Wraps lzma decompression."""
+
+    codec_id = CODEC_LZMA
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.decompression_object = lzma.LZMADecompressor()
+
+
+class Bz2DecompressionStream(_LimitedDecompressionStream):
+    """Wraps bz2 decompression."""
+
+    codec_id = CODEC_BZ2
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.decompression_object = bz2.BZ2Decompressor()
+
+
+class ZstdCompressionStream(_WrappedCompressionStream):
+    """Wraps zstd compression, only available when the optional zstandard package is installed.
+
+    Attributes
+    ----------
+        compression_object: A zstandard compressobj.
+        compressed: The compression stream.
+        finished: Boolean indicating whether stream is finished.
+
+    """
+
+    codec_id = CODEC_ZSTD
+    supports_zdict = True
+
+    def __init__(self, level: int = 3, zdict: bytes | None = None) -> None:
+        super().__init__()
+        if zstandard is None:
+            raise ImportError("The zstd codec requires the zstandard package")
+        dict_data = _zstd_raw_dictionary(zdict) if zdict else None
+        self.compression_object = zstandard.ZstdCompressor(level=level, dict_data=dict_data).compressobj()
+
+
+class ZstdDecompressionStream(DecompressionStream):
+    """Wraps zstd decompression, only available when the optional zstandard package is installed.
+
+    Attributes
+    ----------
+        decompression_object: A zstandard decompressobj.
+        decompressed: The decompression stream.
+        finished: Boolean indicating whether stream is finished.
+
+    """
+
+    codec_id = CODEC_ZSTD
+    supports_zdict = True
+
+    def __init__(self, zdict: bytes | None = None) -> None:
+        super().__init__()
+        if zstandard is None:
+            raise ImportError("The zstd codec requires the zstandard package")
+        dict_data = _zstd_raw_dictionary(zdict) if zdict else None
+        self.decompressor = zstandard.ZstdDecompressor(dict_data=dict_data)
+        self.decompression_object = self.decompressor.decompressobj()
+        self.decompressed = bytearray()
+        self.finished = False
+
+    @override
+    def decompress(self, compressed_data: Buffer) -> None:
+        if self.finished:
+            raise StreamClosedException
+        d = self.decompression_object.decompress(compressed_data)
+        self.decompressed += d
+
+    @override
+    def finish(self) -> bytes:
+        if self.finished:
+            raise StreamClosedException
+        self.finished = True
+        return bytes(self.decompressed)
+
+    @override
+    def iter_decompress(self, data: Buffer, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[bytes]:
+        if self.finished:
+            raise StreamClosedException
+        yield from self.decompressor.read_to_iter(data, read_size=chunk_size, write_size=chunk_size)
+        self.finished = True
+
+
+def _zstd_raw_dictionary(zdict: bytes) -> "zstandard.ZstdCompressionDict":
+    """Use zdict as raw content, the zstd equivalent of a zlib preset dictionary."""
+    return zstandard.ZstdCompressionDict(zdict, dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+
+
+# Maps the codec ids recorded in containers to their stream types
+COMPRESSION_STREAMS: dict[int, type[CompressionStream]] = {
+    CODEC_ZLIB: ZlibCompressionStream,
+    CODEC_LZMA: LzmaCompressionStream,
+    CODEC_BZ2: Bz2CompressionStream,
+    CODEC_ZSTD: ZstdCompressionStream,
+}
+DECOMPRESSION_STREAMS: dict[int, type[DecompressionStream]] = {
+    CODEC_ZLIB: ZlibDecompressionStream,
+    CODEC_LZMA: LzmaDecompressionStream,
+    CODEC_BZ2: Bz2DecompressionStream,
+    CODEC_ZSTD: ZstdDecompressionStream,
+}
+CODEC_NAMES = {"zlib": CODEC_ZLIB, "lzma": CODEC_LZMA, "bz2": CODEC_BZ2, "zstd": CODEC_ZSTD}
+
+
+def available_codecs() -> list[str]:
+    """Return the names of the codecs that can be used in this environment."""
+    return [name for name, codec_id in CODEC_NAMES.items() if codec_id != CODEC_ZSTD or zstandard is not None]
+
+
+def build_preset_dictionary(samples: Iterable[Buffer], size: int = DEFAULT_DICTIONARY_SIZE) -> bytes:
+    """Build a preset dictionary from sample data.
+
+    The samples must not contain data any single principal has a view on, e.g. rows shared by every principal or a
+    static corpus derived from a schema, otherwise the dictionary would let principal streams compress against each
+    other. A null principal bucket may hold more than that, SQLite index pages carry the indexed values of every row.
+    zlib only uses the last 32 KiB of a dictionary and strings closer to the end are cheaper to reference, so the
+    samples are concatenated and the tail is kept.
+    """
+    dictionary = bytearray()
+    for sample in samples:
+        dictionary += sample
+        if len(dictionary) > 2 * size:
+            del dictionary[:-size]
+    return bytes(dictionary[-size:])
+
+
+class StreamPolicy:
+    """Base class for choosing the codec and level of every new segment.
+
+    Attributes
+    ----------
+        settings: Every (stream type, level) pair the policy can choose
+        review_size: If given, the setting of a segment is chosen again every review_size bytes written to it. When
+        the choice changes the segment is finished and the stream continues in a new segment with the new setting.
+
+    """
+
+    def __init__(self, settings: list[tuple[type[CompressionStream], int]], review_size: int | None = None) -> None:
+        self.settings = settings
+        self.review_size = review_size
+
+    def choose(self, stream_key: str, data: FragmentData) -> tuple[type[CompressionStream], int]:
+        """Return the (stream type, level) for a segment of stream_key, data being the write the choice is made on.
+
+        Child classes must implement this method.
+        """
+        raise NotImplementedError
+
+    def record(self, setting: tuple[type[CompressionStream], int], uncompressed_length: int, seconds: float) -> None:
+        """Called after every write to a segment with the setting of the segment, the length written and the time it
+        took to compress. May be called from worker threads.
+        """
+
+
+class AdaptiveStreamPolicy(StreamPolicy):
+    """Picks every segment's codec and level from a sample of its first write and the archive wide targets.
+
+    Data that does not compress gets the fastest setting. Otherwise the strongest setting that keeps the archive within
+    its time budget is used, or with a target ratio the fastest of those whose estimated ratio reaches the target. A
+    large repetitive bucket therefore gets a strong setting while incompressible or already compressible enough buckets
+    cost little time. The choice is reviewed every review_size bytes, so a long stream steps down to a faster setting
+    once the time budget runs short.
+
+    Attributes
+    ----------
+        settings: (stream type, level) pairs ordered from fastest to strongest
+        sample_size: Number of bytes of a write that compressibility is estimated on
+        min_sample_size: Writes shorter than this are too short for an estimate, e.g. single SQLite cells, since the
+        codec overhead would dominate. Only the time budget applies to them
+        incompressible_ratio: Samples whose ratio (uncompressed / compressed size) under the fastest setting stays
+        below this are considered incompressible
+        target_ratio: Optional ratio every segment should reach, estimated on its sample
+        time_budget: Optional number of seconds compressing the archive should take, requires expected_size
+        expected_size: Number of bytes the archive is expected to hold
+        throughput: Measured bytes per second of every setting used so far
+
+    """
+
+    def __init__(
+        self,
+        settings: list[tuple[type[CompressionStream], int]] | None = None,
+        sample_size: int = 4096,
+        min_sample_size: int = 1024,
+        incompressible_ratio: float = 1.05,
+        target_ratio: float | None = None,
+        time_budget: float | None = None,
+        expected_size: int | None = None,
+        review_size: int | None = 256 * 1024,
+    ) -> None:
+        super().__init__(settings or [(ZlibCompressionStream, level) for level in (1, 6, 9)], review_size)
+        if time_budget is not None and expected_size is None:
+            raise ValueError("A time budget needs the expected size of the archive")
+        self.sample_size = sample_size
+        self.min_sample_size = min_sample_size
+        self.incompressible_ratio = incompressible_ratio
+        self.target_ratio = target_ratio
+        self.time_budget = time_budget
+        self.expected_size = expected_size
+        self.throughput: dict[tuple[type[CompressionStream], int], float] = {}
+        self._measured: dict[tuple[type[CompressionStream], int], tuple[int, float]] = {}
+        self._bytes_done = 0
+        self._start: float | None = None
+        self._lock = threading.Lock()
+
+    def _estimate_ratio(self, setting: tuple[type[CompressionStream], int], sample: bytes) -> float:
+        """Compress a sample with a setting, which also measures the throughput of the setting."""
+        stream_type, level = setting
+        start = time.perf_counter()
+        compression_stream = stream_type(level=level)
+        compression_stream.compress(sample)
+        compressed_length = len(compression_stream.finish())
+        with self._lock:
+            self._measure(setting, len(sample), time.perf_counter() - start)
+        return len(sample) / max(compressed_length, 1)
+
+    def _measure(self, setting: tuple[type[CompressionStream], int], uncompressed_length: int, seconds: float) -> None:
+        measured_bytes, measured_seconds = self._measured.get(setting, (0, 0.0))
+        measured_bytes += uncompressed_length
+        measured_seconds += seconds
+        self._measured[setting] = (measured_bytes, measured_seconds)
+        if measured_seconds > 0:
+            self.throughput[setting] = measured_bytes / measured_seconds
+
+    def _allowed_settings(self) -> list[tuple[type[CompressionStream], int]]:
+        """Settings fast enough to compress the rest of the archive within the time budget, at least the fastest."""
+        if self.time_budget is None:
+            return self.settings
+        # A time budget comes with an expected size, and choose starts the clock before asking for the settings
+        assert self.expected_size is not None
+        assert self._start is not None
+        with self._lock:
+            remaining_time = self.time_budget - (time.perf_counter() - self._start)
+            remaining_bytes = max(self.expected_size - self._bytes_done, 0)
+            throughput = dict(self.throughput)
+        if remaining_time <= 0:
+            return self.settings[:1]
+        required = remaining_bytes / remaining_time
+        allowed = [self.settings[0]]
+        for setting in self.settings[1:]:
+            # Settings not measured yet are allowed, so they get measured
+            if throughput.get(setting, required) < required:
+                break
+            allowed.append(setting)
+        return allowed
+
+    @override
+    def choose(self, stream_key: str, data: FragmentData) -> tuple[type[CompressionStream], int]:
+        if self._start is None:
+            self._start = time.perf_counter()
+        sample = bytes(data[: self.sample_size]) if len(data) >= self.min_sample_size else None
+        ratios = {}
+        if sample:
+            ratios[self.settings[0]] = self._estimate_ratio(self.settings[0], sample)
+            if ratios[self.settings[0]] < self.incompressible_ratio:
+                return self.settings[0]
+            if self.time_budget is not None:
+                # Calibrate the throughput of settings not used yet on the sample
+                for setting in self.settings[1:]:
+                    if setting not in self.throughput:
+                        ratios[setting] = self._estimate_ratio(setting, sample)
+        allowed = self._allowed_settings()
+        if self.target_ratio is not None and sample:
+            for setting in allowed:
+                ratio = ratios[setting] if setting in ratios else self._estimate_ratio(setting, sample)
+                if ratio >= self.target_ratio:
+                    return setting
+        return allowed[-1]
+
+    @override
+    def record(self, setting: tuple[type[CompressionStream], int], uncompressed_length: int, seconds: float) -> None:
+        with self._lock:
+            self._bytes_done += uncompressed_length
+            self._measure(setting, uncompressed_length, seconds)
+
+
+class _Segment:
+    """One independently compressed part of a stream.
+
+    Attributes
+    ----------
+        stream_index: Index of the stream the segment belongs to
+        stats: StreamStats of the stream the segment belongs to
+        setting: (stream type, level) chosen by the stream policy, None without one
+        review_at: Uncompressed length at which the stream policy reviews the setting, None if it never does
+        codec_id: Codec of the segment
+        compression_stream: Compresses the segment, None once the segment is finished
+        uncompressed_length: Number of bytes written to the segment
+        compressed_length: Number of compressed bytes produced so far, only complete once the segment is finished
+        compressed: Output of the finished segment, when not writing to a sink
+        spill_runs: (offset, length) runs of the output of the segment in the spill file, when writing to a sink
+
+    """
+
+    def __init__(
+        self,
+        stream_index: int,
+        stats: StreamStats,
+        compression_stream: CompressionStream,
+        setting: tuple[type[CompressionStream], int] | None = None,
+    ) -> None:
+        self.stream_index = stream_index
+        self.stats = stats
+        self.setting = setting
+        self.review_at: int | None = None
+        self.codec_id = compression_stream.codec_id
+        self.compression_stream: CompressionStream | None = compression_stream
+        self.uncompressed_length = 0
+        self.compressed_length = 0
+        self.compressed = b""
+        self.spill_runs: list[tuple[int, int]] = []
+
+
+class _SegmentWriter:
+    """Writes fragments to segments of streams, the part shared by MSCompressor and MSProducer.
+
+    Child classes set the attributes documented on MSCompressor, with _executor None to compress on the calling
+    thread.
+    """
+
+    stream_type: type[CompressionStream]
+    stream_params: dict[str, Any]
+    stream_policy: StreamPolicy | None
+    max_live_streams: int
+    stats: ArchiveStats
+    stats_callback: StatsCallback | None
+    stream_indices: dict[str, int]
+    switch_runs: list[list[int]]
+    fragment_lengths: list[int]
+    segments: list[_Segment]
+    live_segments: dict[str, _Segment]
+    _keys_lock: threading.Lock
+    _spill: BinaryIO | None
+    _spill_lock: threading.Lock
+    _executor: ThreadPoolExecutor | None
+
+    def compress(self, stream_key: str, data: Buffer) -> None:
+        """Compress data to a given stream.
+
+        The length of data is recorded in the container, so data can contain any bytes and is passed to the stream
+        as is. data can be any object supporting the buffer protocol, e.g. a memoryview into an mmap of the source
+        file, and is never copied. With workers it is compressed after compress returns, so it must not be modified
+        or released until finish.
+
+        Args:
+        ----
+            stream_key: Label for which compression stream to be used
+            data: Data to be compressed
+
+        """
+        fragment: FragmentData
+        if isinstance(data, (bytes, bytearray, mmap.mmap)):
+            fragment = data
+        else:
+            # Lengths and samples are taken in bytes, whatever the item size of the buffer
+            fragment = memoryview(data)
+            if fragment.itemsize != 1:
+                fragment = fragment.cast("B")
+        segment = self.live_segments.get(stream_key)
+        if segment is None:
+            segment = self._open_segment(stream_key, fragment)
+        else:
+            if self.max_live_streams:
+                # Move the stream to the most recently used end
+                del self.live_segments[stream_key]
+                self.live_segments[stream_key] = segment
+            if segment.review_at is not None and segment.uncompressed_length >= segment.review_at:
+                segment = self._review_segment(stream_key, segment, fragment)
+
+        if self.switch_runs and self.switch_runs[-1][0] == segment.stream_index:
+            self.switch_runs[-1][1] += 1
+        else:
+            self.switch_runs.append([segment.stream_index, 1])
+            segment.stats.switches += 1
+        self.fragment_lengths.append(len(fragment))
+        segment.uncompressed_length += len(fragment)
+        segment.stats.fragments += 1
+        segment.stats.bytes_in += len(fragment)
+        if self._executor is None:
+            self._compress_segment(segment, fragment)
+        else:
+            self._queue(stream_key, segment, fragment)
+
+    @property
+    def stream_switch(self) -> list[str]:
+        """Stream key for every call to compress so far, in order."""
+        keys = list(self.stream_indices)
+        return [keys[stream_index] for stream_index, count in self.switch_runs for _ in range(count)]
+
+    def _stream_index(self, stream_key: str) -> int:
+        """Index of a stream in the keys of the container, registering the key if it is new."""
+        stream_index = self.stream_indices.get(stream_key)
+        if stream_index is None:
+            # Keys are shared with the producers, which may register keys concurrently
+            with self._keys_lock:
+                stream_index = self.stream_indices.setdefault(stream_key, len(self.stream_indices))
+        return stream_index
+
+    def _review_segment(self, stream_key: str, segment: _Segment, data: FragmentData) -> _Segment:
+        """Ask the stream policy for the setting again, continuing the stream in a new segment if it changed."""
+        # Only segments whose setting was chosen by a stream policy are reviewed
+        assert self.stream_policy is not None
+        review_size = self.stream_policy.review_size
+        assert segment.review_at is not None
+        assert review_size is not None
+        setting = self.stream_policy.choose(stream_key, data)
+        if setting == segment.setting:
+            segment.review_at += review_size
+            return segment
+        self._close_stream(stream_key)
+        return self._open_segment(stream_key, data, setting)
+
+    def _open_segment(
+        self, stream_key: str, data: FragmentData, setting: tuple[type[CompressionStream], int] | None = None
+    ) -> _Segment:
+        """Start a new segment of a stream, closing the least recently used stream if no budget is left."""
+        if self.max_live_streams and len(self.live_segments) >= self.max_live_streams:
+            self._close_stream(next(iter(self.live_segments)))
+        stream_index = self._stream_index(stream_key)
+        stats = self.stats.stream(stream_key)
+        stats.segments += 1
+        if self.stream_policy is None:
+            segment = _Segment(stream_index, stats, self.stream_type(**self.stream_params))
+        else:
+            setting = setting or self.stream_policy.choose(stream_key, data)
+            stream_type, level = setting
+            compression_stream = stream_type(**{**self.stream_params, "level": level})
+            segment = _Segment(stream_index, stats, compression_stream, setting)
+            segment.review_at = self.stream_policy.review_size
+        self.segments.append(segment)
+        self.live_segments[stream_key] = segment
+        return segment
 
+    def _close_stream(self, stream_key: str) -> None:
+        """Finish the open segment of a stream, releasing its compressor state."""
+        segment = self.live_segments.pop(stream_key)
+        if self._executor is None:
+            self._finish_segment(segment)
+        else:
+            self._queue(stream_key, segment, None)
 
-class MSCompressor:
+    def _compress_segment(self, segment: _Segment, data: FragmentData) -> None:
+        """Feed data to the segment and, when writing to a sink, spill whatever it produced."""
+        compression_stream = segment.compression_stream
+        assert compression_stream is not None
+        start = time.perf_counter()
+        compression_stream.compress(data)
+        seconds = time.perf_counter() - start
+        segment.stats.codec_seconds += seconds
+        if segment.setting is not None and self.stream_policy is not None:
+            self.stream_policy.record(segment.setting, len(data), seconds)
+        if self._spill is not None:
+            self._spill_output(segment, compression_stream.take())
+
+    def _finish_segment(self, segment: _Segment) -> None:
+        """Flush the segment and drop its compression stream."""
+        assert segment.compression_stream is not None
+        start = time.perf_counter()
+        compressed = segment.compression_stream.finish()
+        segment.stats.flush_seconds += time.perf_counter() - start
+        segment.compression_stream = None
+        if self._spill is None:
+            segment.compressed = compressed
+            segment.compressed_length = len(compressed)
+        else:
+            self._spill_output(segment, compressed)
+        segment.stats.bytes_out += segment.compressed_length
+        if self.stats_callback is not None:
+            self.stats_callback(segment.stats)
+
+    def _spill_output(self, segment: _Segment, compressed: bytes) -> None:
+        """Append compressed output of a segment to the spill file, merging it with the segment's previous run if they
+        are adjacent.
+        """
+        assert self._spill is not None
+        if not compressed:
+            return
+        with self._spill_lock:
+            offset = self._spill.tell()
+            self._spill.write(compressed)
+            runs = segment.spill_runs
+            if runs and runs[-1][0] + runs[-1][1] == offset:
+                runs[-1] = (runs[-1][0], runs[-1][1] + len(compressed))
+            else:
+                runs.append((offset, len(compressed)))
+            segment.compressed_length += len(compressed)
+
+
+class MSCompressor(_SegmentWriter):
     """Manages multiple compression streams.
 
     Attributes:
     ----------
         stream_type: A CompressionStream instantiation
         stream_params: Parameters for CompressionStream
-        stream_switch_delimiter: A byte sequence inserted between every call to compress as an indication to switch
-        streams while decompressing (currently this must be a byte sequence not found in the data to be compressed).
-        This sequence should not include duplicate bytes - imagine we use '||', this would cause an error because if
-        a '|' in the data ends up next to the delimiter we cannot determine where the true delimiter is
-        output_delimiter: A byte sequence used to separate each compression stream in the output
+        sink: Optional binary file object or path the archive is written to by finish. When given, compressed output
+        is appended to an unlinked spill file as soon as the streams produce it, so memory use does not grow with the
+        size of the input.
+        workers: If greater than 0, streams are compressed on a pool of this many threads. Calls to compress only
+        queue the data, each stream is drained in order by at most one worker at a time, so the output is identical
+        to compressing on the calling thread. zlib releases the GIL, so streams are compressed in parallel.
+        preset_dictionary: Optional dictionary every stream is primed with (see build_preset_dictionary), stored once
+        in the container header. Only for stream types that support zdict.
+        max_live_streams: If greater than 0, at most this many streams hold compressor state at a time. Writing to
+        another stream finishes the least recently used one into a segment and releases its state, a later write to
+        it starts a new segment of the same stream. Every segment starts with an empty history (apart from the preset
+        dictionary), so a tight budget trades compression ratio for memory.
+        append: If True, sink (a path or a seekable file opened for reading and writing) may already hold an archive.
+        finish then appends a container with only the new segments and switch to it, leaving the existing streams
+        untouched, and the archive decompresses to its previous content followed by the newly compressed data. The
+        codec must match the archive's and its preset dictionary is reused. This suits data that only grows at its
+        end, a file rewritten in place such as an SQLite database has to be compressed again as a whole.
+        stream_policy: Optional StreamPolicy choosing the stream type and level of every segment from its first write,
+        e.g. AdaptiveStreamPolicy. stream_type and stream_params then only serve as the archive codec and the
+        parameters besides level.
+        stats: ArchiveStats with the bytes, segments, switches and codec time of every stream, updated as data is
+        compressed
+        stats_callback: Optional function called with the StreamStats of a stream every time one of its segments is
+        finished, from the thread that finished it
 
 
     """
@@ -129,142 +996,479 @@ class MSCompressor:
     def __init__(
         self,
         stream_type: type[CompressionStream],
-        stream_switch_delimiter: bytes = b"[|",
-        output_delimiter: bytes = b"\x7f",
-        **stream_params,
+        sink: BinaryIO | Path | None = None,
+        workers: int = 0,
+        preset_dictionary: bytes | None = None,
+        max_live_streams: int = 0,
+        append: bool = False,
+        stream_policy: StreamPolicy | None = None,
+        stats_callback: StatsCallback | None = None,
+        **stream_params: Any,
     ) -> None:
         self.stream_type = stream_type
         self.stream_params = stream_params
-        self.compression_streams = {}
-        self.stream_switch = []
-        if len(stream_switch_delimiter) != len(set(stream_switch_delimiter)):
-            raise ValueError("Delimiter should be unique characters")
-        self.stream_switch_delimiter = stream_switch_delimiter
-        self.output_delimiter = output_delimiter
+        self.stream_policy = stream_policy
+        self.append = append
+        archive = None
+        if append:
+            if sink is None:
+                raise ValueError("Appending needs a sink holding the archive")
+            archive = _read_archive_header(sink)
+        if archive is not None:
+            if archive.codec_id != stream_type.codec_id:
+                raise ValueError(
+                    f"Cannot append {stream_type.__name__} streams to an archive using codec {archive.codec_id}"
+                )
+            if preset_dictionary is not None and preset_dictionary != archive.dictionary:
+                raise ValueError("Cannot append with a preset dictionary different from the archive's")
+            preset_dictionary = archive.dictionary
+        # Appended containers inherit the preset dictionary of the archive rather than repeating it
+        self._header_dictionary = archive is None
+        self.preset_dictionary = preset_dictionary or b""
+        if self.preset_dictionary:
+            stream_types = [t for t, _ in stream_policy.settings] if stream_policy is not None else [stream_type]
+            for t in stream_types:
+                if not t.supports_zdict:
+                    raise ValueError(f"{t.__name__} does not support preset dictionaries")
+            self.stream_params["zdict"] = self.preset_dictionary
+        # Index of every stream in creation order, and runs of [stream index, count] of consecutive compress calls
+        self.stream_indices: dict[str, int] = {}
+        self._keys_lock = threading.Lock()
+        self.switch_runs: list[list[int]] = []
+        self.fragment_lengths: list[int] = []
+        # Every segment in creation order, which is the order they are stored in, and the open segment of every live
+        # stream, least recently used first
+        self.segments: list[_Segment] = []
+        self.live_segments: dict[str, _Segment] = {}
+        self.max_live_streams = max_live_streams
+        self.stats = ArchiveStats()
+        self.stats_callback = stats_callback
+        self.sink = sink
+        self._spill = tempfile.TemporaryFile() if sink is not None else None
+        self._spill_lock = threading.Lock()
 
-    def compress(self, stream_key: str, data: bytes) -> None:
-        """Compress data to a given stream.
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers) if workers > 0 else None
+        # (segment, data) queued for every stream, data None closing the segment, and the streams a worker is
+        # currently draining
+        self._pending: dict[str, deque[tuple[_Segment, FragmentData | None]]] = {}
+        self._draining: set[str] = set()
+        self._pending_lock = threading.Lock()
+        self._pending_slots = threading.Semaphore(max(workers, 1) * MAX_PENDING_PER_WORKER)
+        self._futures: list[Future[None]] = []
+        # Every producer in the order their ranges were reserved, with the lengths of segments, switch_runs and
+        # fragment_lengths at the time
+        self._reservations: list[tuple[int, int, int, MSProducer]] = []
 
-        Args:
-        ----
-            stream_key: Label for which compression stream to be used
-            data: Data to be compressed
+    def producer(self) -> "MSProducer":
+        """Reserve the next range of the output order for a producer, e.g. one partitioner thread per table.
 
+        Everything written to the producer decompresses after everything written to the compressor and to earlier
+        producers so far, and before anything written to the compressor afterwards. Producers compress on the thread
+        using them, into their own segments, so any number of them can write concurrently. Must be called from the
+        thread calling compress.
         """
-        if self.stream_switch_delimiter in data:
-            raise ValueError("Delimiter found in data")
+        # Data compressed later follows the producer's range, so it cannot continue the open segments or the last run
+        for stream_key in list(self.live_segments):
+            self._close_stream(stream_key)
+        if self.switch_runs:
+            self.switch_runs.append([-1, 0])
+        producer = MSProducer(self)
+        self._reservations.append((len(self.segments), len(self.switch_runs), len(self.fragment_lengths), producer))
+        return producer
 
-        if not stream_key in self.compression_streams:
-            self.compression_streams[stream_key] = self.stream_type(*self.stream_params)
+    def _queue(self, stream_key: str, segment: _Segment, data: FragmentData | None) -> None:
+        """Queue data for a stream, scheduling a worker to drain the stream if none is doing so already."""
+        assert self._executor is not None
+        self._pending_slots.acquire()
+        with self._pending_lock:
+            self._pending.setdefault(stream_key, deque()).append((segment, data))
+            if stream_key in self._draining:
+                return
+            self._draining.add(stream_key)
+        self._futures.append(self._executor.submit(self._drain, stream_key))
+        if len(self._futures) > 1024:
+            self._collect_futures(wait_all=False)
 
-        self.stream_switch.append(stream_key)
-        self.compression_streams[stream_key].compress(data + self.stream_switch_delimiter)
+    def _drain(self, stream_key: str) -> None:
+        """Compress the data queued for a stream in order until the queue is empty."""
+        queue = self._pending[stream_key]
+        while True:
+            with self._pending_lock:
+                if not queue:
+                    self._draining.discard(stream_key)
+                    return
+                segment, data = queue.popleft()
+            try:
+                if data is None:
+                    self._finish_segment(segment)
+                else:
+                    self._compress_segment(segment, data)
+            except BaseException:
+                with self._pending_lock:
+                    for _ in queue:
+                        self._pending_slots.release()
+                    queue.clear()
+                    self._draining.discard(stream_key)
+                raise
+            finally:
+                self._pending_slots.release()
 
-    def encode_remove_output_delimiter(self, data: bytes) -> bytes:
-        """Removes output delimiter from compressed data.
+    def _collect_futures(self, wait_all: bool) -> None:
+        """Drop finished drain futures, raising the first error a worker hit."""
+        if wait_all:
+            wait(self._futures)
+        for future in self._futures:
+            if future.done():
+                # Raises the error of the worker if there was one
+                future.result()
+        self._futures = [future for future in self._futures if not future.done()]
 
-        If the output delimiter shows up in compressed data we will interpret this as changing
-        streams and the header check will fail. Here we replace a chosen delimiter byte by a two byte escape sequence
-        and replace the prefix of the escape sequence by a different two byte sequence as suggested in
-        https://stackoverflow.com/questions/62585234/can-zlib-compressed-output-avoid-using-certain-byte-value
-        """
-        return data.replace(b"Z", b"ZZ").replace(self.output_delimiter, b"Z:")
+    def _finish_segments(self) -> None:
+        """Finish the open segment of every live stream, on the workers if there are any."""
+        live_segments = list(self.live_segments.values())
+        self.live_segments.clear()
+        if self._executor is None:
+            for segment in live_segments:
+                self._finish_segment(segment)
+            return
+        try:
+            self._collect_futures(wait_all=True)
+            list(self._executor.map(self._finish_segment, live_segments))
+        finally:
+            self._executor.shutdown()
 
-    def finish(self) -> bytes:
+    def finish(self) -> bytes | None:
         """Flush all compression streams.
 
         Returns
         -------
-            The bytes for a json encoding of the stream_switch list followed by the compressed strings from each stream
-            concatenated together.
+            The bytes of a container (see container.py): a header locating every segment followed by the compressed
+            segments concatenated together. If a sink was given the container is written to it instead and None is
+            returned.
+
+        """
+        if not all(producer.closed for *_, producer in self._reservations):
+            raise RuntimeError("Every producer must be closed before finish")
+        self._finish_segments()
+        if self._reservations:
+            self._merge_producers()
+        header, _ = encode_header(
+            self.stream_type.codec_id,
+            list(self.stream_indices),
+            [(s.stream_index, s.codec_id, s.compressed_length, s.uncompressed_length) for s in self.segments],
+            self.switch_runs,
+            self.fragment_lengths,
+            self.preset_dictionary if self._header_dictionary else b"",
+        )
+        self.stats.header_length = len(header)
+        if self._spill is None:
+            return header + b"".join([segment.compressed for segment in self.segments])
+
+        if isinstance(self.sink, (str, os.PathLike)):
+            with Path(self.sink).open("ab" if self.append else "wb") as f:
+                self._write_spilled(f, header)
+        else:
+            # A spill file is only created along with a sink
+            assert self.sink is not None
+            if self.append:
+                self.sink.seek(0, os.SEEK_END)
+            self._write_spilled(self.sink, header)
+        self._spill.close()
+        return None
 
+    def _merge_producers(self) -> None:
+        """Interleave the segments, switch and fragment lengths of the producers with the compressor's own, in the
+        reserved order, and add up their stats.
         """
-        compressed_all = json.dumps(self.stream_switch).encode("utf-8") + self.output_delimiter
-        for k, compression_stream in self.compression_streams.items():
-            compressed_all += self.encode_remove_output_delimiter(compression_stream.finish())
-            compressed_all += self.output_delimiter
+        segments: list[_Segment] = []
+        switch_runs: list[list[int]] = []
+        fragment_lengths: list[int] = []
+
+        def extend(
+            part_segments: list[_Segment], part_switch_runs: list[list[int]], part_fragment_lengths: list[int]
+        ) -> None:
+            segments.extend(part_segments)
+            for stream_index, count in part_switch_runs:
+                if not count:
+                    continue
+                if switch_runs and switch_runs[-1][0] == stream_index:
+                    switch_runs[-1][1] += count
+                else:
+                    switch_runs.append([stream_index, count])
+            fragment_lengths.extend(part_fragment_lengths)
+
+        start = (0, 0, 0)
+        for segments_end, runs_end, lengths_end, producer in self._reservations:
+            extend(
+                self.segments[start[0] : segments_end],
+                self.switch_runs[start[1] : runs_end],
+                self.fragment_lengths[start[2] : lengths_end],
+            )
+            extend(producer.segments, producer.switch_runs, producer.fragment_lengths)
+            self.stats.add(producer.stats)
+            start = (segments_end, runs_end, lengths_end)
+        extend(self.segments[start[0] :], self.switch_runs[start[1] :], self.fragment_lengths[start[2] :])
+        self.segments, self.switch_runs, self.fragment_lengths = segments, switch_runs, fragment_lengths
+
+    def _write_spilled(self, f: BinaryIO, header: bytes) -> None:
+        """Write the header followed by every segment copied out of the spill file in bounded chunks."""
+        assert self._spill is not None
+        f.write(header)
+        for segment in self.segments:
+            for offset, length in segment.spill_runs:
+                self._spill.seek(offset)
+                shutil.copyfileobj(_BoundedReader(self._spill, length), f)
+
+
+class MSProducer(_SegmentWriter):
+    """Writes one reserved range of the output order of an MSCompressor, see MSCompressor.producer.
+
+    A producer is meant to be used by a single thread. It shares the stream keys, settings and sink of its compressor
+    but writes its own segments, so producers do not wait for each other while compressing.
+
+    Attributes:
+    ----------
+        compressor: The MSCompressor the range was reserved on
+        stats: ArchiveStats of the data written to the producer, added to the compressor's stats by finish
+        closed: Whether the producer was closed, after which it can no longer be written to
+
+    """
+
+    def __init__(self, compressor: MSCompressor) -> None:
+        self.compressor = compressor
+        self.stream_type = compressor.stream_type
+        self.stream_params = compressor.stream_params
+        self.stream_policy = compressor.stream_policy
+        self.max_live_streams = compressor.max_live_streams
+        self.stats_callback = compressor.stats_callback
+        self.stream_indices = compressor.stream_indices
+        self._keys_lock = compressor._keys_lock
+        self._spill = compressor._spill
+        self._spill_lock = compressor._spill_lock
+        self._executor = None
+        self.switch_runs: list[list[int]] = []
+        self.fragment_lengths: list[int] = []
+        self.segments: list[_Segment] = []
+        self.live_segments: dict[str, _Segment] = {}
+        self.stats = ArchiveStats()
+        self.closed = False
+
+    @override
+    def compress(self, stream_key: str, data: Buffer) -> None:
+        if self.closed:
+            raise StreamClosedException
+        super().compress(stream_key, data)
+
+    def close(self) -> None:
+        """Finish the open segment of every stream of the producer."""
+        if self.closed:
+            return
+        for stream_key in list(self.live_segments):
+            self._close_stream(stream_key)
+        self.closed = True
+
+    def __enter__(self) -> "MSProducer":
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+
+def _read_archive_header(sink: BinaryIO | Path) -> ContainerHeader | None:
+    """Decode the headers of the archive held by a sink, None if the sink is empty.
+
+    The archive is mapped rather than read, so only the pages holding headers are touched.
+    """
+    if isinstance(sink, (str, os.PathLike)):
+        if not Path(sink).exists():
+            return None
+        with Path(sink).open("rb") as f:
+            return _read_archive_header(f)
+    sink.seek(0, os.SEEK_END)
+    if sink.tell() == 0:
+        return None
+    with mmap.mmap(sink.fileno(), 0, access=mmap.ACCESS_READ) as archive:
+        return decode_archive(archive)
+
 
-        return compressed_all
+class _BoundedReader:
+    """File-like view of the next length bytes of a file, used to copy one spilled run with shutil.copyfileobj."""
+
+    def __init__(self, f: BinaryIO, length: int) -> None:
+        self.f = f
+        self.remaining = length
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
 
 
 class MSDecompressor:
     """Manages multiple decompression streams.
 
+    Reads containers written by MSCompressor, as well as archives in the older escaped format, where a JSON encoding of
+    the stream_switch list and every compressed stream are separated by output_delimiter.
+
     Attributes:
     ----------
-        stream_type: A DecompressionStream instantiation
-        stream_switch_delimiter: A byte sequence inserted between every call to compress as an indication to switch
-        streams while decompressing (currently this must be a byte sequence not found in the data to be compressed).
-        This sequence should not include duplicate bytes - imagine we use '||', this would cause an error because if
-        a '|' in the data ends up next to the delimiter we cannot determine where the true delimiter is
-        output_delimiter: A byte sequence used to separate each compression stream in the output
+        stream_type: A DecompressionStream instantiation used for archives in the escaped format. Containers record
+        their codec id, and the matching stream type is picked from DECOMPRESSION_STREAMS
+        stream_switch_delimiter: A byte sequence that was inserted after the data of every call to compress in archives
+        using the escaped format. Containers record the length of every fragment instead
+        output_delimiter: A byte sequence used to separate each compression stream in archives using the escaped format
+        workers: If greater than 0, finish decompresses every stream at once on a pool of this many threads and then
+        reassembles the output following the stream switch. This trades the bounded memory of iter_chunks for latency.
+        stats: ArchiveStats of the archive. segments, switches and fragments are filled in by decompress, bytes and
+        codec time add up over every decompression of a stream
+        stats_callback: Optional function called with the StreamStats of a stream every time the stream has been
+        decompressed entirely
 
 
     """
 
     def __init__(
-        self, stream_type: type[DecompressionStream], stream_switch_delimiter: bytes = b"[|", output_delimiter=b"\x7f"
+        self,
+        stream_type: type[DecompressionStream] = ZlibDecompressionStream,
+        stream_switch_delimiter: bytes = b"[|",
+        output_delimiter: bytes = b"\x7f",
+        workers: int = 0,
+        stats_callback: StatsCallback | None = None,
     ) -> None:
         self.stream_type = stream_type
-        self.decompression_streams = {}
+        self.workers = workers
+        self.stats = ArchiveStats()
+        self.stats_callback = stats_callback
         if len(stream_switch_delimiter) != len(set(stream_switch_delimiter)):
             raise ValueError("Delimiter should be unique characters")
         self.stream_switch_delimiter = stream_switch_delimiter
-        self.stream_switch = None
+        self.stream_switch: list[str] | None = None
+        self.fragment_lengths: list[int] | None = None
         self.output_delimiter = output_delimiter
+        self.index: dict[str, BucketIndex] = {}
+        self._stream_params: dict[str, bytes] = {}
+        # The (decompression stream type, compressed segment) pairs of every stream, in order
+        self._compressed_streams: dict[str, list[tuple[type[DecompressionStream], bytes | memoryview]]] = {}
 
     def decode_add_output_delimiter(self, data: bytes) -> bytes:
         """Adds output delimiter occurrences to compressed data.
 
-        In MSCompressor we escaped the output delimiter so that it did not occur in the compressed data and could be
-        used as a delimiter. This function parses data to find the escape sequences and replaces occurrences.
+        In the escaped format we escaped the output delimiter so that it did not occur in the compressed data and could
+        be used as a delimiter: b"Z" was written as b"ZZ" and the delimiter as b"Z:". Replacing b"Z:" and then b"ZZ"
+        decodes this correctly everywhere except after an even run of b"Z" followed by b":", where the run is made of
+        escaped b"Z" only. Those places are rare, so we cut the data there. Within a piece every b"Z:" is an escaped
+        delimiter, so the piece is split on them, b"ZZ" replaced in every part and the parts joined with the delimiter,
+        which touches the data once less than a second replace over the whole piece.
         """
-        output = []
-        pair = False
-        for b in data:
-            if pair:
-                # Previous byte was escape prefix
-                # 90 -> b'Z'
-                o = 90 if b == 90 else int.from_bytes(self.output_delimiter)
-                output.append(o)
-                pair = False
-            elif b == 90:
-                pair = True
-            else:
-                output.append(b)
-        return bytes(output)
+        if b"Z" not in data:
+            return data
+        pieces = []
+        start = 0
+        pos = data.find(b"ZZ:")
+        while pos != -1:
+            run_start = pos
+            while run_start > start and data[run_start - 1] == 90:  # 90 -> b'Z'
+                run_start -= 1
+            if (pos + 2 - run_start) % 2 == 0:
+                pieces.append(data[start : pos + 2])
+                start = pos + 2
+            pos = data.find(b"ZZ:", pos + 2)
+        pieces.append(data[start:] if start else data)
+        return b"".join(
+            [self.output_delimiter.join([part.replace(b"ZZ", b"Z") for part in piece.split(b"Z:")]) for piece in pieces]
+        )
 
-    def decompress(self, compressed_data: bytes) -> None:
-        """Decompress until unused_data is found, then start a new DecompressionStream.
+    def decompress(self, compressed_data: ArchiveData) -> None:
+        """Locate every stream in an archive, the actual decompression happens in iter_chunks or finish.
 
-        Try to do this: https://stackoverflow.com/questions/58402524/python-zlib-how-to-decompress-many-objects
+        compressed_data can also be a bytearray, memoryview or mmap of the archive file, since container streams are
+        only sliced.
         """
-        iterator = iter(range(0, len(compressed_data)))
-        stream_key_iter = 0
-        prev_od_pos = -1
-        od_pos = -1
-        to_decompress = b""
-        decoded_stream_switch = False
-        while -1 != (od_pos := compressed_data.find(self.output_delimiter, od_pos + 1)):
-            to_decompress += compressed_data[prev_od_pos + len(self.output_delimiter) : od_pos]
-            if not decoded_stream_switch:
-                # Data before first output delimiter should be stream switch
-                try:
-                    stream_switch = json.loads(to_decompress.decode("utf-8"))
-                except json.decoder.JSONDecodeError:
-                    raise ValueError("Expected JSON encoding of stream_switch list")
-                self.stream_switch = stream_switch
-                for stream_key in stream_switch:
-                    if stream_key not in self.decompression_streams:
-                        self.decompression_streams[stream_key] = self.stream_type()
-                decoded_stream_switch = True
-            else:
-                self.decompression_streams[list(self.decompression_streams.keys())[stream_key_iter]].decompress(
-                    self.decode_add_output_delimiter(to_decompress)
-                )
-                stream_key_iter += 1
-            to_decompress = b""
-            prev_od_pos = od_pos
+        if not is_container(compressed_data):
+            self._decompress_escaped(bytes(compressed_data))
+            return
+
+        header = decode_archive(compressed_data)
+        for codec_id in {header.codec_id} | {entry.codec_id for entry in header.segments}:
+            if codec_id not in DECOMPRESSION_STREAMS:
+                raise ValueError(f"Unsupported codec {codec_id}")
+        self.stream_type = DECOMPRESSION_STREAMS[header.codec_id]
+        self.stream_switch = header.stream_switch
+        self.fragment_lengths = header.fragment_lengths
+        self.index = build_bucket_index(header)
+        self._stream_params = {"zdict": header.dictionary} if header.dictionary else {}
+        view = memoryview(compressed_data)
+        for stream_key in header.stream_keys:
+            self._compressed_streams[stream_key] = []
+        for entry in header.segments:
+            self._compressed_streams[entry.key].append(
+                (DECOMPRESSION_STREAMS[entry.codec_id], view[entry.offset : entry.offset + entry.compressed_length])
+            )
+        self.stats = ArchiveStats(
+            header_length=header.container_length - sum(entry.compressed_length for entry in header.segments)
+        )
+        for stream_key, bucket in self.index.items():
+            stats = self.stats.stream(stream_key)
+            stats.segments = len(bucket.segments)
+            stats.fragments = len(bucket.switch_positions)
+            stats.switches = _count_runs(bucket.switch_positions)
+
+    def _decompress_escaped(self, compressed_data: bytes) -> None:
+        """Locate every stream in an archive in the escaped format.
+
+        The escaping guarantees the output delimiter only occurs between the stream switch and the streams, so the
+        archive is split in one pass and every piece terminated by a delimiter is decoded. Streams are matched to keys
+        in order of first appearance in the stream switch, which is the order MSCompressor created them in.
+        """
+        pieces = compressed_data.split(self.output_delimiter)[:-1]
+        if not pieces:
+            return
+        try:
+            stream_switch: list[str] = json.loads(pieces[0].decode("utf-8"))
+        except (UnicodeDecodeError, json.decoder.JSONDecodeError):
+            raise ValueError("Expected JSON encoding of stream_switch list")
+        self.stream_switch = stream_switch
+        for stream_key, piece in zip(dict.fromkeys(stream_switch), pieces[1:]):
+            self._compressed_streams[stream_key] = [(self.stream_type, self.decode_add_output_delimiter(piece))]
+        self.stats = ArchiveStats(header_length=len(pieces[0]) + len(self.output_delimiter))
+        switch_positions: dict[str, list[int]] = {}
+        for switch_position, stream_key in enumerate(stream_switch):
+            switch_positions.setdefault(stream_key, []).append(switch_position)
+        for stream_key in self._compressed_streams:
+            stats = self.stats.stream(stream_key)
+            stats.segments = 1
+            stats.fragments = len(switch_positions[stream_key])
+            stats.switches = _count_runs(switch_positions[stream_key])
+
+    def iter_chunks(self, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[bytes]:
+        """Yield the decompressed data in its original order.
+
+        Streams are decompressed incrementally and interleaved following the stream switch, so at any time only about
+        chunk_size bytes of output per stream are held in memory and the first bytes are available immediately.
+        """
+        stream_switch = self._decompressed_stream_switch()
+        if self.fragment_lengths is not None:
+            length_readers = {
+                stream_key: _LengthReader(self._iter_stream(stream_key, chunk_size))
+                for stream_key in self._compressed_streams
+            }
+            for stream_key, fragment_length in zip(stream_switch, self.fragment_lengths):
+                yield from length_readers[stream_key].read(fragment_length)
+            for length_reader in length_readers.values():
+                length_reader.end()
+            return
+
+        readers = {
+            stream_key: _FragmentReader(self._iter_stream(stream_key, chunk_size), self.stream_switch_delimiter)
+            for stream_key in self._compressed_streams
+        }
+        for stream_key in stream_switch:
+            yield from readers[stream_key].next_fragment()
+        for reader in readers.values():
+            reader.end()
 
     def finish(self) -> bytes:
         """Flush all decompression streams.
@@ -274,17 +1478,171 @@ class MSDecompressor:
             The decompressed strings from each stream concatenated together.
 
         """
-        pointers_stream = {}
-        for stream_key, decompression_stream in self.decompression_streams.items():
-            pointers_stream[stream_key] = 0
-            decompression_stream.finish()
-
-        split_decompressed_bytes = {
-            stream_key: self.decompression_streams[stream_key].decompressed.split(self.stream_switch_delimiter)
-            for stream_key in self.decompression_streams.keys()
-        }
-        decompressed_ordered = bytearray()
-        for stream in self.stream_switch:
-            decompressed_ordered.extend(split_decompressed_bytes[stream].pop(0))
+        if self.workers <= 0:
+            return b"".join(self.iter_chunks())
+
+        stream_switch = self._decompressed_stream_switch()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            decompressed = dict(
+                zip(self._compressed_streams, executor.map(self._decompress_stream, self._compressed_streams))
+            )
+
+        positions = dict.fromkeys(decompressed, 0)
+        fragments = []
+        if self.fragment_lengths is not None:
+            views = {stream_key: memoryview(data) for stream_key, data in decompressed.items()}
+            for stream_key, fragment_length in zip(stream_switch, self.fragment_lengths):
+                start = positions[stream_key]
+                fragments.append(views[stream_key][start : start + fragment_length])
+                positions[stream_key] = start + fragment_length
+            if any(positions[stream_key] != len(data) for stream_key, data in decompressed.items()):
+                raise ValueError("Stream does not match the fragment lengths")
+            return b"".join(fragments)
+
+        for stream_key in stream_switch:
+            start = positions[stream_key]
+            end = decompressed[stream_key].find(self.stream_switch_delimiter, start)
+            if end == -1:
+                raise ValueError("Stream ended in the middle of a fragment")
+            fragments.append(memoryview(decompressed[stream_key])[start:end])
+            positions[stream_key] = end + len(self.stream_switch_delimiter)
+        return b"".join(fragments)
+
+    def _decompressed_stream_switch(self) -> list[str]:
+        """Return the stream switch of the archive, which decompress must have been given."""
+        if self.stream_switch is None:
+            raise ValueError("No archive to decompress, decompress must be called first")
+        return self.stream_switch
+
+    def extract_bucket(self, stream_key: str) -> bytes:
+        """Return the data written to one stream, decompressing only that stream.
+
+        For containers the fragments are sliced out using the bucket index, archives in the escaped format are split on
+        the stream switch delimiter. Can be called any number of times, alongside iter_chunks or finish.
+
+        Raises
+        ------
+            KeyError: If the archive has no stream with this key.
+
+        """
+        if stream_key not in self._compressed_streams:
+            raise KeyError(stream_key)
+        decompressed = self._decompress_stream(stream_key)
+        if stream_key not in self.index:
+            return b"".join(decompressed.split(self.stream_switch_delimiter))
+
+        bucket = self.index[stream_key]
+        if len(decompressed) != sum(segment.uncompressed_length for segment in bucket.segments):
+            raise ValueError("Stream does not match its entries in the segment table")
+        view = memoryview(decompressed)
+        return b"".join(
+            [view[offset : offset + length] for offset, length in zip(bucket.fragment_offsets, bucket.fragment_lengths)]
+        )
+
+    def _iter_stream(self, stream_key: str, chunk_size: int) -> Iterator[bytes]:
+        """Decompress the segments of a stream one after the other, yielding the output in chunks."""
+        stats = self.stats.stream(stream_key)
+        for stream_type, segment in self._compressed_streams[stream_key]:
+            stats.bytes_in += len(segment)
+            chunks = stream_type(**self._stream_params).iter_decompress(segment, chunk_size)
+            while True:
+                start = time.perf_counter()
+                chunk = next(chunks, None)
+                stats.codec_seconds += time.perf_counter() - start
+                if chunk is None:
+                    break
+                stats.bytes_out += len(chunk)
+                yield chunk
+        if self.stats_callback is not None:
+            self.stats_callback(stats)
+
+    def _decompress_stream(self, stream_key: str) -> bytes:
+        """Decompress one whole stream, run on the workers."""
+        stats = self.stats.stream(stream_key)
+        decompressed = []
+        for stream_type, segment in self._compressed_streams[stream_key]:
+            decompression_stream = stream_type(**self._stream_params)
+            start = time.perf_counter()
+            decompression_stream.decompress(segment)
+            flush_start = time.perf_counter()
+            decompressed.append(decompression_stream.finish())
+            stats.codec_seconds += flush_start - start
+            stats.flush_seconds += time.perf_counter() - flush_start
+            stats.bytes_in += len(segment)
+            stats.bytes_out += len(decompressed[-1])
+        if self.stats_callback is not None:
+            self.stats_callback(stats)
+        return decompressed[0] if len(decompressed) == 1 else b"".join(decompressed)
+
+
+def _count_runs(switch_positions: list[int]) -> int:
+    """Number of runs of consecutive positions in the stream switch, i.e. how often the archive switched to a stream."""
+    return sum(1 for previous, position in zip([-2] + switch_positions, switch_positions) if position != previous + 1)
+
+
+class _LengthReader:
+    """Cuts the incremental output of one decompression stream into fragments of known length."""
+
+    def __init__(self, chunks: Iterator[bytes]) -> None:
+        self.chunks = chunks
+        self.chunk = memoryview(b"")
+
+    def read(self, length: int) -> Iterator[bytes]:
+        """Yield the next length bytes in pieces, whole decompressed chunks are passed on without copying."""
+        while length:
+            if not self.chunk:
+                chunk = next(self.chunks, None)
+                if chunk is None:
+                    raise ValueError("Stream ended in the middle of a fragment")
+                if len(chunk) <= length:
+                    length -= len(chunk)
+                    yield chunk
+                    continue
+                self.chunk = memoryview(chunk)
+            piece = self.chunk[:length]
+            self.chunk = self.chunk[length:]
+            length -= len(piece)
+            yield bytes(piece)
+
+    def end(self) -> None:
+        """Check the stream ends after the last fragment, running it to completion."""
+        if self.chunk or any(self.chunks):
+            raise ValueError("Stream does not match the fragment lengths")
+
+
+class _FragmentReader:
+    """Splits the incremental output of one decompression stream in the escaped format into the fragments written by
+    each compress call.
+    """
+
+    def __init__(self, chunks: Iterator[bytes], delimiter: bytes) -> None:
+        self.chunks = chunks
+        self.delimiter = delimiter
+        self.buffer = bytearray()
+
+    def next_fragment(self) -> Iterator[bytes]:
+        """Yield the next fragment in pieces, consuming the delimiter that ends it.
+
+        Anything that cannot be the start of a delimiter is yielded as soon as it is decompressed, so long fragments
+        are never held in memory as a whole.
+        """
+        keep = len(self.delimiter) - 1
+        while True:
+            pos = self.buffer.find(self.delimiter)
+            if pos != -1:
+                if pos:
+                    yield bytes(self.buffer[:pos])
+                del self.buffer[: pos + len(self.delimiter)]
+                return
+            if len(self.buffer) > keep:
+                yield bytes(self.buffer[: len(self.buffer) - keep])
+                del self.buffer[: len(self.buffer) - keep]
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                raise ValueError("Stream ended in the middle of a fragment")
+            self.buffer += chunk
 
-        return decompressed_ordered
+    def end(self) -> None:
+        """Check the stream ends after the last fragment, running it to completion."""
+        if self.buffer or any(self.chunks):
+            raise ValueError("Stream continues after its last fragment")
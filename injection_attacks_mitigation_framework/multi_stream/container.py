@@ -0,0 +1,364 @@
+"""Implements the binary container format written by MSCompressor and read by MSDecompressor.
+
+Layout (varints are unsigned LEB128):
+
+    magic                4 bytes, CONTAINER_MAGIC
+    version              u8
+    codec id             u8, the codec MSCompressor was created with
+    segment count        varint
+    keys length          varint
+    switch length        varint, length of the switch table shifted left by one, the low bit set if it is deflated
+    dictionary length    varint
+    segment table        segment count entries of (stream index varint, codec id varint, compressed length varint,
+                         uncompressed length varint)
+    keys                 UTF-8 JSON list of the stream keys, stream indices refer to this list
+    switch table         runs of consecutive compress calls to the same stream, each a stream index varint, a run
+                         length varint and a fragment length varint per call in the run. Stored raw deflated when that
+                         is smaller
+    dictionary           zlib compressed preset dictionary every stream was primed with, empty if none was used
+    segment data         the compressed segments, back to back, in segment table order
+
+Every stream is made of one or more segments, each compressed independently, so a stream can be closed to free its
+compressor state and continued later in a new segment (see MSCompressor.max_live_streams). Decompressing the segments of
+a stream in order and concatenating the output gives the stream. Every segment records its own codec, so segments can be
+compressed with different codecs and levels (see AdaptiveStreamPolicy). Segments are stored back to back straight after
+the header, so the offset of every segment follows from the header length and the compressed lengths before it. Each
+segment can then be sliced directly out of the archive without any escaping or delimiter scanning. Inside a stream the
+fragments written by every call to compress follow each other without any separator, the switch table records the length
+of every fragment instead. Fragments can therefore hold arbitrary bytes, and the position of any fragment inside its
+decompressed stream is known without decompressing any other stream (see build_bucket_index).
+
+Containers can be appended to an archive (see MSCompressor's append mode). An archive is then a sequence of containers
+and decodes as if the switch tables were concatenated, with segments of streams sharing a key continuing the same
+stream. Each appended container only carries the segments and switch written since, the earlier ones stay untouched.
+Appended containers use the codec of the first container and inherit its preset dictionary instead of repeating it.
+
+Keys are written once and the switch refers to them by index, so partitioners producing many small fragments (one per
+XML element or SQLite page) pay a few bytes per fragment rather than a label each.
+"""
+
+import json
+import mmap
+import struct
+import zlib
+from collections.abc import Iterable, Sequence
+from dataclasses import dataclass, field
+from typing import Any
+
+CONTAINER_MAGIC = b"MSCF"
+CONTAINER_VERSION = 7
+
+_PREAMBLE = struct.Struct("<4sBB")
+
+# An archive as the decoders accept it, e.g. a mapping of the archive file or a view of part of it
+ArchiveData = bytes | bytearray | mmap.mmap | memoryview
+
+
+@dataclass
+class StreamEntry:
+    """Location of a single compressed segment of a stream inside a container, offsets are relative to the container
+    start.
+    """
+
+    key: Any
+    offset: int
+    compressed_length: int
+    uncompressed_length: int
+    codec_id: int = 0
+
+
+@dataclass
+class ContainerHeader:
+    """Decoded container header.
+
+    Attributes
+    ----------
+        codec_id: Identifies the codec MSCompressor was created with, segments record the codec they actually use
+        stream_keys: Key of every stream, in order of creation
+        segments: One entry per segment, in the order the segments are stored
+        stream_switch: Stream key for every call to MSCompressor.compress, in order
+        fragment_lengths: Length of the data passed to every call to MSCompressor.compress, in order
+        dictionary: Preset dictionary shared by all streams, empty if none was used
+        header_length: Number of bytes taken up by the header, i.e. where stream data starts
+        container_length: Number of bytes taken up by the header and the segment data
+
+    """
+
+    codec_id: int
+    stream_keys: list[Any] = field(default_factory=list)
+    segments: list[StreamEntry] = field(default_factory=list)
+    stream_switch: list[Any] = field(default_factory=list)
+    fragment_lengths: list[int] = field(default_factory=list)
+    dictionary: bytes = b""
+    header_length: int = 0
+    container_length: int = 0
+
+
+@dataclass
+class BucketIndex:
+    """Location of all data written to one stream.
+
+    Attributes
+    ----------
+        segments: The segments of the stream holding the bucket, in order
+        switch_positions: Position in the stream switch of every fragment of the bucket, in order
+        fragment_offsets: Offset of every fragment inside the decompressed stream
+        fragment_lengths: Length of every fragment
+
+    """
+
+    segments: list[StreamEntry] = field(default_factory=list)
+    switch_positions: list[int] = field(default_factory=list)
+    fragment_offsets: list[int] = field(default_factory=list)
+    fragment_lengths: list[int] = field(default_factory=list)
+
+
+def encode_varint(value: int) -> bytes:
+    """Encode a non-negative integer as an unsigned LEB128 varint."""
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def encode_varints(values: Iterable[int], out: bytearray) -> None:
+    """Append every value to out as an unsigned LEB128 varint."""
+    for value in values:
+        while value > 0x7F:
+            out.append((value & 0x7F) | 0x80)
+            value >>= 7
+        out.append(value)
+
+
+def decode_varint(data: ArchiveData, offset: int) -> tuple[int, int]:
+    """Decode an unsigned LEB128 varint starting at offset, returning the value and the offset after it."""
+    value = 0
+    shift = 0
+    while True:
+        if offset >= len(data):
+            raise ValueError("Truncated varint")
+        b = data[offset]
+        offset += 1
+        value |= (b & 0x7F) << shift
+        if b < 0x80:
+            return value, offset
+        shift += 7
+
+
+def decode_varints(data: ArchiveData, offset: int, count: int) -> tuple[list[int], int]:
+    """Decode count consecutive varints starting at offset, returning the values and the offset after them.
+
+    Fragment lengths are usually below 128, so when the next count bytes all are single byte varints they are decoded
+    in one go.
+    """
+    single_bytes = bytes(data[offset : offset + count])
+    if len(single_bytes) == count and single_bytes.isascii():
+        return list(single_bytes), offset + count
+    values: list[int] = []
+    append = values.append
+    end = len(data)
+    for _ in range(count):
+        if offset >= end:
+            raise ValueError("Truncated varint")
+        b = data[offset]
+        offset += 1
+        if b < 0x80:
+            append(b)
+            continue
+        value = b & 0x7F
+        shift = 7
+        while True:
+            if offset >= end:
+                raise ValueError("Truncated varint")
+            b = data[offset]
+            offset += 1
+            value |= (b & 0x7F) << shift
+            if b < 0x80:
+                break
+            shift += 7
+        append(value)
+    return values, offset
+
+
+def is_container(data: ArchiveData) -> bool:
+    """Return True if data starts with the container magic bytes."""
+    return bytes(data[: len(CONTAINER_MAGIC)]) == CONTAINER_MAGIC
+
+
+def encode_header(
+    codec_id: int,
+    stream_keys: list[Any],
+    segment_lengths: list[tuple[int, int, int, int]],
+    switch_runs: Iterable[Sequence[int]],
+    fragment_lengths: list[int],
+    dictionary: bytes = b"",
+) -> tuple[bytes, list[StreamEntry]]:
+    """Build the header for a container.
+
+    Args:
+    ----
+        codec_id: Codec MSCompressor was created with
+        stream_keys: Key of every stream, stream indices refer to this list
+        segment_lengths: (stream index, codec id, compressed length, uncompressed length) for each segment in storage
+        order
+        switch_runs: (stream index, number of calls) for every run of consecutive calls to compress with the same
+        stream
+        fragment_lengths: Length of the data passed to every call to compress, in order
+        dictionary: Preset dictionary the streams were primed with
+
+    Returns:
+    -------
+        The encoded header and the segment entries with their offsets filled in.
+
+    """
+    encoded_keys = json.dumps(stream_keys, separators=(",", ":")).encode("utf-8")
+    dictionary = zlib.compress(dictionary, 9) if dictionary else b""
+
+    switch_table = bytearray()
+    position = 0
+    for stream_index, count in switch_runs:
+        encode_varints((stream_index, count), switch_table)
+        encode_varints(fragment_lengths[position : position + count], switch_table)
+        position += count
+    deflate = zlib.compressobj(9, zlib.DEFLATED, -15)
+    deflated = deflate.compress(switch_table) + deflate.flush()
+    stored_switch_table: bytes | bytearray = switch_table
+    switch_length = len(switch_table) << 1
+    if len(deflated) < len(switch_table):
+        stored_switch_table = deflated
+        switch_length = len(deflated) << 1 | 1
+
+    header = bytearray(_PREAMBLE.pack(CONTAINER_MAGIC, CONTAINER_VERSION, codec_id))
+    header += encode_varint(len(segment_lengths))
+    header += encode_varint(len(encoded_keys))
+    header += encode_varint(switch_length)
+    header += encode_varint(len(dictionary))
+    for segment in segment_lengths:
+        encode_varints(segment, header)
+    header += encoded_keys
+    header += stored_switch_table
+    header += dictionary
+
+    entries = []
+    offset = len(header)
+    for stream_index, segment_codec_id, compressed_length, uncompressed_length in segment_lengths:
+        entries.append(
+            StreamEntry(stream_keys[stream_index], offset, compressed_length, uncompressed_length, segment_codec_id)
+        )
+        offset += compressed_length
+    return bytes(header), entries
+
+
+def decode_header(data: ArchiveData, start: int = 0) -> ContainerHeader:
+    """Parse the header of the container at start, segment offsets are then relative to the start of data.
+
+    Raises
+    ------
+        ValueError: If data is not a container or was written by an unsupported version.
+
+    """
+    if start:
+        header = decode_header(memoryview(data)[start:])
+        for entry in header.segments:
+            entry.offset += start
+        return header
+    if len(data) < _PREAMBLE.size or not is_container(data):
+        raise ValueError("Data is not a multi stream container")
+    _, version, codec_id = _PREAMBLE.unpack_from(data, 0)
+    if version != CONTAINER_VERSION:
+        raise ValueError(f"Unsupported container version {version}")
+
+    segment_count, pos = decode_varint(data, _PREAMBLE.size)
+    keys_length, pos = decode_varint(data, pos)
+    switch_length, pos = decode_varint(data, pos)
+    dictionary_length, pos = decode_varint(data, pos)
+    segment_lengths, pos = decode_varints(data, pos, 4 * segment_count)
+
+    keys_end = pos + keys_length
+    switch_end = keys_end + (switch_length >> 1)
+    dictionary_end = switch_end + dictionary_length
+    if len(data) < dictionary_end:
+        raise ValueError("Truncated container header")
+    try:
+        keys = json.loads(bytes(data[pos:keys_end]).decode("utf-8"))
+    except (UnicodeDecodeError, json.decoder.JSONDecodeError):
+        raise ValueError("Expected JSON encoding of container stream keys")
+    stream_count = len(keys)
+
+    switch_table = bytes(data[keys_end:switch_end])
+    if switch_length & 1:
+        try:
+            switch_table = zlib.decompress(switch_table, -15)
+        except zlib.error:
+            raise ValueError("Corrupt container switch table")
+    stream_switch = []
+    fragment_lengths = []
+    pos = 0
+    while pos < len(switch_table):
+        stream_index, pos = decode_varint(switch_table, pos)
+        count, pos = decode_varint(switch_table, pos)
+        if stream_index >= stream_count:
+            raise ValueError("Switch table refers to a missing stream")
+        run_lengths, pos = decode_varints(switch_table, pos, count)
+        stream_switch += [keys[stream_index]] * count
+        fragment_lengths += run_lengths
+    header_length = dictionary_end
+
+    segments = []
+    offset = header_length
+    for i in range(0, len(segment_lengths), 4):
+        stream_index, segment_codec_id, compressed_length, uncompressed_length = segment_lengths[i : i + 4]
+        if stream_index >= stream_count:
+            raise ValueError("Segment table refers to a missing stream")
+        segments.append(
+            StreamEntry(keys[stream_index], offset, compressed_length, uncompressed_length, segment_codec_id)
+        )
+        offset += compressed_length
+    if offset > len(data):
+        raise ValueError("Truncated container segment data")
+
+    dictionary = zlib.decompress(data[switch_end:header_length]) if dictionary_length else b""
+    return ContainerHeader(codec_id, keys, segments, stream_switch, fragment_lengths, dictionary, header_length, offset)
+
+
+def decode_archive(data: ArchiveData) -> ContainerHeader:
+    """Parse every container of an archive and merge them into a single header.
+
+    Stream keys are listed in order of first appearance, the segments, switch and fragment lengths of later containers
+    follow those of earlier ones.
+
+    Raises
+    ------
+        ValueError: If data is not a container, or an appended container uses a different codec or has a dictionary.
+
+    """
+    archive = decode_header(data)
+    start = archive.container_length
+    while start < len(data):
+        header = decode_header(data, start)
+        if header.codec_id != archive.codec_id or header.dictionary:
+            raise ValueError("Appended container uses a different codec or its own preset dictionary")
+        archive.stream_keys = list(dict.fromkeys(archive.stream_keys + header.stream_keys))
+        archive.segments += header.segments
+        archive.stream_switch += header.stream_switch
+        archive.fragment_lengths += header.fragment_lengths
+        start += header.container_length
+    archive.container_length = start
+    return archive
+
+
+def build_bucket_index(header: ContainerHeader) -> dict[Any, BucketIndex]:
+    """Map every stream key to the location of its stream and of each of its fragments."""
+    index = {stream_key: BucketIndex() for stream_key in header.stream_keys}
+    for entry in header.segments:
+        index[entry.key].segments.append(entry)
+    positions = dict.fromkeys(index, 0)
+    for switch_position, (stream_key, fragment_length) in enumerate(zip(header.stream_switch, header.fragment_lengths)):
+        bucket = index[stream_key]
+        bucket.switch_positions.append(switch_position)
+        bucket.fragment_offsets.append(positions[stream_key])
+        bucket.fragment_lengths.append(fragment_length)
+        positions[stream_key] += fragment_length
+    return index
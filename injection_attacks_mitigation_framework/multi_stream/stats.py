@@ -0,0 +1,117 @@
+"""Implements the per stream statistics kept by MSCompressor and MSDecompressor.
+
+Counters are plain attributes updated in place, so reading them while compressing is cheap and always reflects the work
+done so far. Every counter of a stream still has a single writer when compressing with workers: the thread calling
+compress updates bytes_in, segments, switches and fragments, so bytes_in includes data still queued for the workers,
+and the worker compressing the stream updates bytes_out, codec_seconds and flush_seconds. Producers (see MSCompressor.producer) keep counters of their own, added to the compressor's by finish.
+"""
+
+from collections.abc import Callable
+from dataclasses import dataclass, field, fields
+from typing import Any
+
+
+@dataclass
+class StreamStats:
+    """Counters for a single stream.
+
+    bytes_in and bytes_out are the bytes fed to and produced by the codec: uncompressed and compressed bytes when
+    compressing, compressed and decompressed bytes when decompressing.
+
+    Attributes
+    ----------
+        key: Key of the stream
+        bytes_in: Number of bytes fed to the codec
+        bytes_out: Number of bytes produced by the codec. When compressing, only finished segments are counted
+        segments: Number of segments the stream is made of
+        switches: Number of runs of consecutive fragments written to the stream, i.e. how often the archive switched
+        to it
+        fragments: Number of fragments written to the stream
+        codec_seconds: Time spent in the codec compressing or decompressing data
+        flush_seconds: Time spent in the codec finishing segments
+
+    """
+
+    key: Any
+    bytes_in: int = 0
+    bytes_out: int = 0
+    segments: int = 0
+    switches: int = 0
+    fragments: int = 0
+    codec_seconds: float = 0.0
+    flush_seconds: float = 0.0
+
+
+StatsCallback = Callable[[StreamStats], None]
+
+
+@dataclass
+class ArchiveStats:
+    """Counters for every stream of an archive, and their totals.
+
+    Attributes
+    ----------
+        streams: StreamStats of every stream, by key, in order of creation
+        header_length: Number of bytes taken up by the container header, 0 until it is written or read
+
+    """
+
+    streams: dict[Any, StreamStats] = field(default_factory=dict)
+    header_length: int = 0
+
+    def stream(self, stream_key: Any) -> StreamStats:
+        """Return the StreamStats of a stream, creating them if the stream is new."""
+        stats = self.streams.get(stream_key)
+        if stats is None:
+            stats = self.streams[stream_key] = StreamStats(stream_key)
+        return stats
+
+    def add(self, other: "ArchiveStats") -> None:
+        """Add the counters of every stream of other to those of the same stream here."""
+        for stream_key, other_stats in other.streams.items():
+            stats = self.stream(stream_key)
+            for counter in fields(StreamStats)[1:]:
+                setattr(stats, counter.name, getattr(stats, counter.name) + getattr(other_stats, counter.name))
+
+    def _int_total(self, counter: str) -> int:
+        total: int = sum(getattr(stats, counter) for stats in self.streams.values())
+        return total
+
+    def _float_total(self, counter: str) -> float:
+        total: float = sum(getattr(stats, counter) for stats in self.streams.values())
+        return total
+
+    @property
+    def bytes_in(self) -> int:
+        """Bytes fed to the codec, over every stream."""
+        return self._int_total("bytes_in")
+
+    @property
+    def bytes_out(self) -> int:
+        """Bytes produced by the codec, over every stream."""
+        return self._int_total("bytes_out")
+
+    @property
+    def segments(self) -> int:
+        """Number of segments, over every stream."""
+        return self._int_total("segments")
+
+    @property
+    def switches(self) -> int:
+        """Number of switches between streams."""
+        return self._int_total("switches")
+
+    @property
+    def fragments(self) -> int:
+        """Number of fragments, over every stream."""
+        return self._int_total("fragments")
+
+    @property
+    def codec_seconds(self) -> float:
+        """Time spent compressing or decompressing, over every stream."""
+        return self._float_total("codec_seconds")
+
+    @property
+    def flush_seconds(self) -> float:
+        """Time spent finishing segments, over every stream."""
+        return self._float_total("flush_seconds")
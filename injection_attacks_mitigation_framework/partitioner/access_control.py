@@ -2,6 +2,7 @@
 
 from collections.abc import Callable
 from dataclasses import dataclass
+from functools import partial
 from typing import Any
 from xml.etree import ElementTree
 
@@ -59,9 +60,17 @@ def basic_partition_policy(p: Principal) -> str:
     return str(p)
 
 
+def attribute_based_partition_policy(p: Principal, attr: str) -> str:
+    """Partitions based on a given attribute of the principal, see generate_attribute_based_partition_policy."""
+    return str(p.__getattribute__(attr)) if not p.null else str(p)
+
+
 def generate_attribute_based_partition_policy(attr: str) -> Callable[[Principal], str]:
-    """Partitions based on a given attribute of the principal e.g. is_contact."""
-    return lambda p: str(p.__getattribute__(attr)) if not p.null else str(p)
+    """Partitions based on a given attribute of the principal e.g. is_contact.
+
+    The policy is a partial of a module level function, so it can be pickled and sent to worker processes.
+    """
+    return partial(attribute_based_partition_policy, attr=attr)
 
 
 @dataclass
@@ -1,10 +1,14 @@
+import array
+import mmap
 import os
 import sqlite3
 import struct
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Callable
+from typing import Any, Callable, Iterable, Mapping
 
 from injection_attacks_mitigation_framework.partitioner.access_control import Principal
 from injection_attacks_mitigation_framework.partitioner.partitioner import Partitioner
@@ -18,8 +22,12 @@ HEADER_INFO_POSITIONS = {
     "header_string_end": 15,
     "page_size_start": 16,
     "page_size_end": 17,
+    "change_counter_start": 24,
+    "change_counter_end": 27,
     "freelist_count_start": 36,
     "freelist_count_end": 39,
+    "schema_cookie_start": 40,
+    "schema_cookie_end": 43,
 }
 HEADER_STRING = "SQLite format 3\000"
 
@@ -29,6 +37,40 @@ PAGE_TYPES = {
     "index_leaf": 0x0A,
     "index_interior": 0x02,
 }
+# Kinds of page recorded in a PageMap besides the b-tree page types: pages reached by no b-tree, and overflow pages
+UNOWNED_PAGE = 0x00
+OVERFLOW_PAGE = 0x01
+# With workers, the number of page ranges partitioned per worker
+PAGE_RANGES_PER_WORKER = 4
+
+# Content size of the serial types below 12, the others are BLOBs and strings sized by their serial type
+SERIAL_TYPE_SIZES = (0, 1, 2, 3, 4, 6, 8, 8, 0, 0, 0, 0)
+
+
+def _unpack_decoder(fmt: str) -> Callable[[bytes | memoryview, int], int | float]:
+    unpack_from = struct.Struct(fmt).unpack_from
+    return lambda data, offset: unpack_from(data, offset)[0]
+
+
+def _reserved_serial_type(data: bytes | memoryview, offset: int) -> None:
+    raise ValueError("Record uses a reserved serial type, the database is corrupt")
+
+
+# Decoders of the values of serial types below 12, from the record body and the offset of the value
+_SERIAL_TYPE_DECODERS = (
+    lambda data, offset: None,  # NULL
+    _unpack_decoder(">b"),  # 8-bit twos-complement integer
+    _unpack_decoder(">h"),  # Big-endian 16-bit twos-complement integer
+    lambda data, offset: int.from_bytes(data[offset : offset + 3], signed=True),  # 24-bit integer
+    _unpack_decoder(">i"),  # Big-endian 32-bit twos-complement integer
+    lambda data, offset: int.from_bytes(data[offset : offset + 6], signed=True),  # 48-bit integer
+    _unpack_decoder(">q"),  # Big-endian 64-bit twos-complement integer
+    _unpack_decoder(">d"),  # Big-endian IEEE 754-2008 64-bit floating point number
+    lambda data, offset: 0,  # The integer 0
+    lambda data, offset: 1,  # The integer 1
+    _reserved_serial_type,
+    _reserved_serial_type,
+)
 
 
 @dataclass
@@ -43,244 +85,520 @@ class SQLiteDataUnit:
     table_name: str
 
 
+@dataclass
+class PageMap:
+    """Kind and owner of every page of an SQLite database, built in a single pass over its b-trees by build_page_map.
+
+    The arrays are indexed by page number, index 0 is unused. A map only depends on the layout of the database file, so
+    it can be kept and passed to later partitioner runs on the same file. The partitioner rejects a map whose page size,
+    page count, file change counter or schema cookie differ from those of the file, since any write to the database
+    may move rows between pages. SQLite does not always bump the change counter of a database in WAL mode, so a map
+    must not be reused across writes to such a database.
+
+    Attributes
+    ----------
+        page_size: Page size of the database
+        change_counter: File change counter of the database header when the map was built
+        schema_cookie: Schema cookie of the database header when the map was built
+        tables: Name of every table, table ids index this list
+        table_ids: Id of the table owning every page, for index pages the table the index is on
+        kinds: b-tree page type (see PAGE_TYPES) of every page, or OVERFLOW_PAGE, or UNOWNED_PAGE for pages no b-tree
+        reaches
+        overflow_owners: For overflow pages, the b-tree page holding the cell whose payload overflows, 0 for others
+
+    """
+
+    page_size: int
+    change_counter: int
+    schema_cookie: int
+    tables: list[str]
+    # array.array is only subscriptable at runtime from Python 3.12
+    table_ids: "array.array[int]"
+    kinds: bytearray
+    overflow_owners: "array.array[int]"
+
+    @property
+    def page_count(self) -> int:
+        """Number of pages of the database."""
+        return len(self.kinds) - 1
+
+
 class SQLiteAdvancedPartitioner(Partitioner):
-    """Implements partitioner where the data is a Path object for the SQLite database file to be partitioned."""
+    """Implements partitioner where the data is a Path object for the SQLite database file to be partitioned.
+
+    The database file is mapped once and every page is parsed in place, as a memoryview slice of the mapping.
+
+    Attributes
+    ----------
+        zero_copy: If True, partition returns memoryview slices of the mapping rather than bytes, so the bucketed data
+        is never copied. The file then stays mapped until close, and must not be modified or truncated before that.
+        Otherwise partition unmaps the file before returning.
+        page_map: PageMap of the database, built by partition if not given. Pass the map of an earlier run to skip
+        walking the b-trees again.
+        columns: Indexes of the columns the access control policy reads, by table name. Only these columns are decoded:
+        the others are None in the row of the SQLiteDataUnit, which ends at the last of them, and rows of tables missing
+        from the mapping are empty. Overflow pages are only read when a column needs them. If None, every column of
+        every table is decoded.
+        workers: If greater than 0, the pages are partitioned on a pool of this many processes, each mapping the file
+        and partitioning ranges of pages. The output is the same as without workers, but the policies must be
+        picklable, e.g. module level functions rather than lambdas.
+        shared_cells: Set by partition, the cells of the table rows the access control policy gave to the null principal,
+        in file order and as bytes or memoryview slices like the bucketed data. Unlike the rest of the null principal
+        bucket they hold no data of any single principal: index pages carry the indexed values of every row, and
+        overflow pages and the space around cells are left out too. Suitable as samples for a preset dictionary.
+
+    """
+
+    def __init__(
+        self,
+        data: Path,
+        access_control_policy: Callable[[SQLiteDataUnit], Principal],
+        partition_policy: Callable[[Principal], str],
+        zero_copy: bool = False,
+        page_map: PageMap | None = None,
+        columns: Mapping[str, Iterable[int]] | None = None,
+        workers: int = 0,
+    ) -> None:
+        super().__init__(data, access_control_policy, partition_policy)
+        self.zero_copy = zero_copy
+        self.page_map = page_map
+        self.columns = columns
+        self.workers = workers
+        self.shared_cells: list[bytes | memoryview] = []
+        self._mapping: mmap.mmap | None = None
 
     def _get_data(self) -> Path:
         return self.data
 
-    def partition(self) -> list[tuple[str, bytes]]:
-        bucketed_data = []
+    def partition(self) -> list[tuple[str, bytes | memoryview]]:
+        # Map the file once, every page, child page and overflow page is then a slice of the mapping
+        with open(self._get_data(), "rb") as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        bucketed_data = self._partition_mapping(memoryview(mapping))
+        if self.zero_copy:
+            # Replaces the mapping of an earlier run, if any, which is then unmapped once its slices are released
+            self._mapping = mapping
+        else:
+            # The slices were copied, the last views of the mapping went away with the frame of _partition_mapping
+            mapping.close()
+        return bucketed_data
+
+    def close(self) -> None:
+        """Unmap the file kept mapped by a zero_copy run of partition, the slices of which are then invalid.
+
+        shared_cells is cleared, the bucketed data returned by partition must have been released by the caller.
+
+        Raises
+        ------
+            BufferError: If a slice of the mapping is still referenced.
+
+        """
+        self.shared_cells = []
+        if self._mapping is not None:
+            self._mapping.close()
+            self._mapping = None
+
+    def __enter__(self) -> "SQLiteAdvancedPartitioner":
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        # A traceback may still refer to slices of the mapping, which is then unmapped once they are released
+        if exc_info[0] is None:
+            self.close()
+
+    def __getstate__(self) -> dict[str, Any]:
+        # Worker processes get the partitioner pickled, they map the file themselves
+        state = self.__dict__.copy()
+        state["_mapping"] = None
+        state["shared_cells"] = []
+        return state
+
+    def _partition_mapping(self, db: memoryview) -> list[tuple[str, bytes | memoryview]]:
+        """Partition the database file mapped in db, see partition."""
+        db_size = len(db)
+        # First, check header, and find page size
+        header = db[:HEADER_SIZE_BYTES]
+        header_string = header[
+            HEADER_INFO_POSITIONS["header_string_start"] : HEADER_INFO_POSITIONS["header_string_end"] + 1
+        ]
+        if header_string != HEADER_STRING.encode("ascii"):
+            raise ValueError("Input file is not encoded in SQLite's database file format.")
+
+        page_size = int.from_bytes(
+            header[HEADER_INFO_POSITIONS["page_size_start"] : HEADER_INFO_POSITIONS["page_size_end"] + 1]
+        )
+        freelist_count = int.from_bytes(
+            header[HEADER_INFO_POSITIONS["freelist_count_start"] : HEADER_INFO_POSITIONS["freelist_count_end"] + 1]
+        )
+        reserved_bytes_per_page = int.from_bytes(header[20:21])
+        assert reserved_bytes_per_page == 0
+
+        if freelist_count != 0:
+            raise ValueError("Database still contains free pages which could leak data. Please run VACUUM first.")
+
+        if self.page_map is None:
+            with closing(sqlite3.connect(self._get_data())) as con:
+                # Every b-tree, the tables and the indexes on them
+                roots = con.execute("select tbl_name, rootpage FROM sqlite_master WHERE rootpage > 0").fetchall()
+            self.page_map = build_page_map(db, page_size, [("sqlite_schema", 1)] + roots)
+        page_map = self.page_map
+        if (page_map.page_size, page_map.page_count, page_map.change_counter, page_map.schema_cookie) != (
+            page_size,
+            db_size // page_size,
+            _read_header_field(header, "change_counter"),
+            _read_header_field(header, "schema_cookie"),
+        ):
+            raise ValueError("Page map was built for a different database or version of it")
+
+        if self.workers <= 0:
+            spans, overflow_to_partition, shared_cells = self._partition_pages(db, 1, page_map.page_count + 1)
+        else:
+            # More ranges than workers, so that a worker done with a range of small cells picks up another
+            range_count = min(self.workers * PAGE_RANGES_PER_WORKER, page_map.page_count)
+            bounds = [1 + page_map.page_count * i // range_count for i in range(range_count + 1)]
+            spans = []
+            overflow_to_partition = {}
+            shared_cells = []
+            with ProcessPoolExecutor(
+                max_workers=self.workers, initializer=_init_partition_worker, initargs=(self,)
+            ) as executor:
+                for range_spans, range_overflow_to_partition, range_shared_cells in executor.map(
+                    _partition_page_range, bounds[:-1], bounds[1:]
+                ):
+                    spans.extend(range_spans)
+                    overflow_to_partition.update(range_overflow_to_partition)
+                    shared_cells.extend(range_shared_cells)
+
+        # Overflow pages reached before the cell they belong to were left without a partition
+        bucketed_data: list[tuple[str, bytes | memoryview]] = [
+            (overflow_to_partition[start // page_size + 1] if partition is None else partition, db[start:end])
+            for partition, start, end in spans
+        ]
+        self.shared_cells = [db[start:end] for start, end in shared_cells]
+        if not self.zero_copy:
+            bucketed_data = [(bucket, bytes(data)) for bucket, data in bucketed_data]
+            self.shared_cells = [bytes(data) for data in self.shared_cells]
+        return bucketed_data
+
+    def _partition_pages(
+        self, db: memoryview, first_page: int, stop_page: int
+    ) -> tuple[list[tuple[str | None, int, int]], dict[int, str], list[tuple[int, int]]]:
+        """Partition the pages from first_page up to stop_page, excluded, using the page map.
+
+        Returns
+        -------
+            (partition, start, end) of every part of the pages in order, start and end being offsets in the file. The
+            partition of overflow pages reached before their cell is None. Also returns the partition of every overflow
+            page of the cells partitioned, and the (start, end) of the part on the page of every cell partitioned to
+            the null principal (see shared_cells).
+
+        """
+        spans: list[tuple[str | None, int, int]] = []
+        overflow_to_partition: dict[int, str] = {}
+        shared_cells: list[tuple[int, int]] = []
+        page_map = self.page_map
+        assert page_map is not None
+        page_size = page_map.page_size
+        null_partition = self.partition_policy(Principal(null=True))
+        # Columns to decode by table id, None to decode every column
+        table_columns: list[frozenset[int] | None]
+        if self.columns is None:
+            table_columns = [None] * len(page_map.tables)
+        else:
+            table_columns = [frozenset(self.columns.get(table_name, ())) for table_name in page_map.tables]
+        table_column_counts = [-1 if columns is None else max(columns, default=-1) + 1 for columns in table_columns]
+
+        # Main loop: iterate through every page and handle it according to its kind in the page map
+        for page_number in range(first_page, stop_page):
+            page_start = (page_number - 1) * page_size
+            page_end = page_start + page_size
+            page_type = page_map.kinds[page_number]
+
+            # Overflow pages only hold the rest of a cell's payload, bucketed with the cell. Cells of table leaves are
+            # partitioned when their page is parsed, which may come after the overflow page
+            if page_type == OVERFLOW_PAGE:
+                if page_number in overflow_to_partition:
+                    spans.append((overflow_to_partition[page_number], page_start, page_end))
+                elif page_map.kinds[page_map.overflow_owners[page_number]] == PAGE_TYPES["table_leaf"]:
+                    spans.append((None, page_start, page_end))
+                else:
+                    spans.append((null_partition, page_start, page_end))
+                continue
+
+            # First 100 bytes of root page are the DB header, the btree header follows it
+            header_start = page_start
+            if page_number == 1:
+                spans.append((null_partition, 0, HEADER_SIZE_BYTES))
+                header_start = HEADER_SIZE_BYTES
+
+            # Index pages, table interior pages and pages no b-tree reaches are considered metadata
+            if page_type != PAGE_TYPES["table_leaf"]:
+                spans.append((null_partition, header_start, page_end))
+                continue
+
+            table_id = page_map.table_ids[page_number]
+            table_name = page_map.tables[table_id]
+            columns = table_columns[table_id]
+            # Number of serial types to read from record headers, -1 to read them all
+            column_count = table_column_counts[table_id]
+            num_cells, cell_content_offset = struct.unpack_from(">HH", db, header_start + 3)
+
+            # Parse table leaf to partition
+            # Page before cell content is metadata
+            if num_cells:
+                spans.append((null_partition, header_start, page_start + cell_content_offset))
+            else:
+                # Empty page
+                spans.append((null_partition, header_start, page_end))
+                continue
+            # Cell offsets are from the start of the page, even on page 1
+            page = db[page_start:page_end]
+            cell_offsets = sorted(struct.unpack_from(f">{num_cells}H", db, header_start + 8))
+            assert cell_offsets[0] == cell_content_offset
+            for cell_index, cell_offset in enumerate(cell_offsets):
+                # First in cell is a varint encoding payload size
+                cell_payload_size, rowid_offset = _read_varint(page, cell_offset)
+                payload_on_page = _payload_on_page(page_size, cell_payload_size)
+
+                # Next is a varint encoding rowid
+                cell_rowid, payload_offset = _read_varint(page, rowid_offset)
+
+                # Need to capture unused bytes after cell payload before next cell
+                cell_end = cell_offsets[cell_index + 1] if cell_index + 1 < num_cells else page_size
+                payload: bytes | memoryview = page[payload_offset : payload_offset + payload_on_page]
+
+                overflow_pointers = []
+                payload_parts = []
+                if payload_on_page < cell_payload_size:
+                    # For overflow pages we can record the partition and look it up when we reach that page
+                    # since the overflow will be part of the same data unit as the original cell
+                    overflow_pointer = struct.unpack_from(">I", page, payload_offset + payload_on_page)[0]
+                    payload_parts.append(payload)
+                    payload_to_read = cell_payload_size - payload_on_page
+                    while overflow_pointer != 0:
+                        # overflow pages are a linked list with last page starting with 4-byte int 0
+                        overflow_pointers.append(overflow_pointer)
+                        overflow_start = (overflow_pointer - 1) * page_size
+                        overflow_page = db[overflow_start : overflow_start + page_size]
+                        overflow_pointer = int.from_bytes(overflow_page[:4])
+                        if overflow_pointer == 0:
+                            payload_parts.append(overflow_page[4 : 4 + payload_to_read])
+                        else:
+                            payload_parts.append(overflow_page[4:])
+                            payload_to_read -= page_size - 4
+
+                # Now we have the cell decode the payload to find the row data
+                if payload_parts and _read_varint(payload, 0)[0] > payload_on_page:
+                    # Header does not fit on the page, only happens with a great many columns
+                    payload = b"".join(payload_parts)
+                    payload_parts = []
+                column_types, payload_header_size = _decode_record_header(payload, column_count)
 
-        con = sqlite3.connect(self._get_data())
-        cur = con.cursor()
+                if payload_parts and (
+                    columns is None or payload_header_size + _record_size(column_types) > payload_on_page
+                ):
+                    # Only read the overflow pages if a decoded column is stored on them
+                    payload = b"".join(payload_parts)
 
-        # Get schema information
-        cur.execute("select name, rootpage FROM sqlite_master WHERE type='table'")
-        page_to_table = {row[1]: row[0] for row in cur.fetchall()}
-        page_to_table[1] = "sqlite_schema"
-        overflow_to_partition = {}
+                row = _decode_record(payload[payload_header_size:], column_types, columns)
 
-        db_size = self._get_data().stat().st_size
-        with open(self._get_data(), "rb") as f:
-            # First, check header, and find page size
-            header = f.read(HEADER_SIZE_BYTES)
-            if (
-                header[
-                    HEADER_INFO_POSITIONS["header_string_start"] : HEADER_INFO_POSITIONS["header_string_end"] + 1
-                ].decode("ascii")
-                != HEADER_STRING
-            ):
-                raise ValueError("Input file is not encoded in SQLite's database file format.")
-
-            page_size = int.from_bytes(
-                header[HEADER_INFO_POSITIONS["page_size_start"] : HEADER_INFO_POSITIONS["page_size_end"] + 1]
-            )
-            freelist_count = int.from_bytes(
-                header[HEADER_INFO_POSITIONS["freelist_count_start"] : HEADER_INFO_POSITIONS["freelist_count_end"] + 1]
-            )
-            reserved_bytes_per_page = int.from_bytes(header[20:21])
-            assert reserved_bytes_per_page == 0
-
-            if freelist_count != 0:
-                raise ValueError("Database still contains free pages which could leak data. Please run VACUUM first.")
-
-            # Main loop: iterate through every page, determine its type, and handle as needed
-            for page_number in range(1, db_size // page_size + 1):
-                page_start = (page_number - 1) * page_size
-                f.seek(page_start)
-                page = f.read(page_size)
+                data_unit = SQLiteDataUnit(tuple(row), table_name)
+                principal = self.access_control_policy(data_unit)
+                partition = self.partition_policy(principal)
+                spans.append((partition, page_start + cell_offset, page_start + cell_end))
+                if partition == null_partition:
+                    shared_cells.append((page_start + cell_offset, page_start + payload_offset + payload_on_page))
+                for op in overflow_pointers:
+                    # Map overflow pages if any to same partition so we can bucket them when we reach them
+                    overflow_to_partition[op] = partition
 
-                if page_number in overflow_to_partition:
-                    bucketed_data.append((overflow_to_partition[page_number], page))
+        return spans, overflow_to_partition, shared_cells
 
-                # First 100 bytes of root page are the DB header
-                if page_number == 1:
-                    bucketed_data.append((self.partition_policy(Principal(null=True)), page[:100]))
-                    page = page[100:]
 
-                page_type = page[0]
-                num_cells = int.from_bytes(page[3:5])
-                cell_content_offset = int.from_bytes(page[5:7])
+# Partitioner and mapping of the database of a worker process, set up once per process by _init_partition_worker
+_worker_partitioner: SQLiteAdvancedPartitioner | None = None
+_worker_db: memoryview | None = None
 
-                # Index pages considered metadata
-                if page_type == PAGE_TYPES["index_leaf"] or page_type == PAGE_TYPES["index_interior"]:
-                    bucketed_data.append((self.partition_policy(Principal(null=True)), page))
-                    continue
 
-                # Get name if table page
-                table_name = page_to_table[page_number]
-
-                # Parse table interior to add to page_to_table_mapping
-                if page_type == PAGE_TYPES["table_interior"]:
-                    children = _parse_interior_page(page_number, page)
-                    if children[0] not in page_to_table:
-                        # This must be a root page, traverse the tree to find all pages for mapping
-                        while children:
-                            child = children.pop(0)
-                            page_to_table[child] = table_name
-                            f.seek((child - 1) * page_size)
-                            child_page = f.read(page_size)
-                            if child_page[0] != PAGE_TYPES["table_interior"]:
-                                # Leaf node
-                                continue
-                            else:
-                                # Interior node
-                                children.extend(_parse_interior_page(child, child_page))
-                    bucketed_data.append((self.partition_policy(Principal(null=True)), page))
-                    continue
+def _init_partition_worker(partitioner: SQLiteAdvancedPartitioner) -> None:
+    global _worker_partitioner, _worker_db
+    # The file stays mapped for the lifetime of the worker process, which ends with the pool in partition
+    with open(partitioner._get_data(), "rb") as f:
+        _worker_db = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    _worker_partitioner = partitioner
 
-                # Parse table leaf to partition
-                elif page_type == PAGE_TYPES["table_leaf"]:
-                    cell_pointer_array = page[8 : 8 + (2 * num_cells)]
-                    # Page before cell content is metadata
-                    if cell_pointer_array:
-                        if page_number == 1:
-                            bucketed_data.append(
-                                (self.partition_policy(Principal(null=True)), page[: cell_content_offset - 100])
-                            )
-                        else:
-                            bucketed_data.append(
-                                (self.partition_policy(Principal(null=True)), page[:cell_content_offset])
-                            )
-                    else:
-                        # Empty page
-                        bucketed_data.append((self.partition_policy(Principal(null=True)), page))
-                        continue
-                    cell_offsets = [
-                        int.from_bytes(cell_pointer_array[cell_index * 2 : cell_index * 2 + 2])
-                        for cell_index in range(num_cells)
-                    ]
-                    cell_offsets.sort()
-                    assert cell_offsets[0] == cell_content_offset
-                    if page_number == 1:
-                        # 100 bytes of header are not accounted for in offset
-                        cell_offsets = [x - 100 for x in cell_offsets]
-                    for cell_index, cell_offset in enumerate(cell_offsets):
-                        # First in cell is a varint encoding payload size
-                        cell_payload_size, cell_payload_size_bu = _varint_to_integer(
-                            page[cell_offset : cell_offset + 9]
-                        )
-                        payload_on_page = _payload_on_page(page_size, cell_payload_size)
-
-                        # Next is a varint encoding rowid
-                        rowid_offset = cell_offset + cell_payload_size_bu
-                        cell_rowid, cell_rowid_bu = _varint_to_integer(page[rowid_offset : rowid_offset + 9])
-
-                        cell_payload_offset = cell_payload_size_bu + cell_rowid_bu
-
-                        # Need to capture unused bytes after cell payload before next cell
-                        if cell_offset == cell_offsets[-1]:
-                            cell_data = page[cell_offset:]
-                        else:
-                            cell_data = page[cell_offset : cell_offsets[cell_index + 1]]
-                        payload = cell_data[cell_payload_offset : cell_payload_offset + payload_on_page]
-
-                        overflow_pointers = []
-                        if payload_on_page < cell_payload_size:
-                            # For overflow pages we can record the partition and look it up when we reach that page
-                            # since the overflow will be part of the same data unit as the original cell
-                            overflow_pointer_offset = cell_offset + cell_payload_offset + payload_on_page
-                            overflow_pointer = int.from_bytes(
-                                page[overflow_pointer_offset : overflow_pointer_offset + 4]
-                            )
-                            payload = cell_data[cell_payload_offset : cell_payload_offset + payload_on_page]
-                            payload_to_read = cell_payload_size - payload_on_page
-                            while overflow_pointer != 0:
-                                # overflow pages are a linked list with last page starting with 4-byte int 0
-                                overflow_pointers.append(overflow_pointer)
-                                overflow_start = (overflow_pointer - 1) * page_size
-                                f.seek(overflow_start)
-                                overflow_page = f.read(page_size)
-                                overflow_pointer = int.from_bytes(overflow_page[:4])
-                                if overflow_pointer == 0:
-                                    payload += overflow_page[4 : 4 + overflow_pointer + payload_to_read]
-                                else:
-                                    payload += overflow_page[4:]
-                                    payload_to_read -= page_size - 4
-
-                        # Now we have the cell decode the payload to find the row data
-                        payload_header_size, payload_header_size_bu = _varint_to_integer(payload[:9])
-                        payload_header_offset = payload_header_size_bu
-                        column_types = []
-                        while payload_header_offset < payload_header_size:
-                            column_serial_type, column_serial_type_bu = _varint_to_integer(
-                                payload[payload_header_offset : payload_header_offset + 9]
-                            )
-                            column_types.append(column_serial_type)
-                            payload_header_offset += column_serial_type_bu
-
-                        record_data = payload[payload_header_size:]
-                        record_offset = 0
-                        row = []
-                        for col in column_types:
-                            if col == 0:
-                                col_data = None
-                            elif col == 8:
-                                col_data = 0
-                            elif col == 9:
-                                col_data = 1
-                            else:
-                                col_data_size, col_data_type = _get_content_size_type(col)
-                                col_data = record_data[record_offset : record_offset + col_data_size]
-                                col_data = col_data_type(col_data)
-                                record_offset += col_data_size
-                            row.append(col_data)
-
-                        data_unit = SQLiteDataUnit(tuple(row), table_name)
-                        principal = self.access_control_policy(data_unit)
-                        partition = self.partition_policy(principal)
-                        bucketed_data.append((partition, cell_data))
-                        for op in overflow_pointers:
-                            # Map overflow pages if any to same partition so we can bucket them when we reach them
-                            overflow_to_partition[op] = partition
-                else:
-                    raise ValueError("Cannot identify page type")
 
-        return bucketed_data
+def _partition_page_range(
+    first_page: int, stop_page: int
+) -> tuple[list[tuple[str | None, int, int]], dict[int, str], list[tuple[int, int]]]:
+    """Partition a range of pages in a worker process, see SQLiteAdvancedPartitioner._partition_pages."""
+    assert _worker_partitioner is not None
+    assert _worker_db is not None
+    return _worker_partitioner._partition_pages(_worker_db, first_page, stop_page)
 
 
-def _parse_interior_page(page_number: int, page: bytes) -> list[int]:
-    """Parse a table interior page, returning a list of child pages numbers"""
-    num_cells = int.from_bytes(page[3:5])
-    rightmost_pointer = int.from_bytes(page[8:12])
-    cell_pointer_array = page[12 : 12 + (2 * num_cells)]  # Interior btree page has 12 byte header
-    children = [rightmost_pointer]
-    for cell_index in range(num_cells):
-        cell_offset = int.from_bytes(cell_pointer_array[cell_index * 2 : cell_index * 2 + 2])
-        if page_number == 1:
-            # 100 bytes of header are not accounted for in offset
-            left_pointer = int.from_bytes(page[cell_offset - 100 : cell_offset - 100 + 4])
-        else:
-            left_pointer = int.from_bytes(page[cell_offset : cell_offset + 4])
-        children.append(left_pointer)
-    return children
+def build_page_map(db: memoryview, page_size: int, roots: list[tuple[str, int]]) -> PageMap:
+    """Walk every b-tree once from its root page, recording the kind and owner of every page it reaches.
+
+    Every page is visited once, overflow chains included, so building the map takes time linear in the size of the
+    database whatever the order of the pages in the file.
 
+    Args:
+    ----
+        db: The database file
+        page_size: Page size of the database
+        roots: (table name, root page) of every b-tree, for an index the name of the table it is on
 
-def _varint_to_integer(varint: bytes) -> tuple[int, int]:
-    """Parse a bytestring as a big endian varint and return the varint and bytes used for the encoding"""
-    value = 0
-    num_bytes = 0
+    Raises
+    ------
+        ValueError: If a page is out of range, reached twice or not a b-tree page, which only happens in a corrupt
+        database.
+
+    """
+    page_count = len(db) // page_size
+    tables = list(dict.fromkeys(table_name for table_name, _ in roots))
+    table_id_by_name = {table_name: table_id for table_id, table_name in enumerate(tables)}
+    table_ids = array.array("I", [0]) * (page_count + 1)
+    kinds = bytearray(page_count + 1)
+    overflow_owners = array.array("I", [0]) * (page_count + 1)
+
+    def claim(page_number: int, table_id: int, kind: int) -> None:
+        if not 0 < page_number <= page_count or kinds[page_number] != UNOWNED_PAGE:
+            raise ValueError(f"Page {page_number} is out of range or reached twice, the database is corrupt")
+        kinds[page_number] = kind
+        table_ids[page_number] = table_id
+
+    for table_name, root in roots:
+        table_id = table_id_by_name[table_name]
+        stack = [root]
+        while stack:
+            page_number = stack.pop()
+            page_start = (page_number - 1) * page_size
+            # The b-tree header of page 1 follows the database header, cell offsets are from the start of the page
+            header_start = page_start + (HEADER_SIZE_BYTES if page_number == 1 else 0)
+            page_type = db[header_start]
+            if page_type not in PAGE_TYPES.values():
+                raise ValueError("Cannot identify page type")
+            claim(page_number, table_id, page_type)
+            num_cells = struct.unpack_from(">H", db, header_start + 3)[0]
+
+            interior = page_type in (PAGE_TYPES["table_interior"], PAGE_TYPES["index_interior"])
+            # Interior btree pages have a 12 byte header ending with the rightmost pointer, each cell starts with
+            # the 4 byte pointer to its left child
+            cell_offsets = struct.unpack_from(f">{num_cells}H", db, header_start + (12 if interior else 8))
+            if interior:
+                stack.append(struct.unpack_from(">I", db, header_start + 8)[0])
+                stack.extend(struct.unpack_from(">I", db, page_start + cell_offset)[0] for cell_offset in cell_offsets)
+            if page_type == PAGE_TYPES["table_interior"]:
+                # Table interior cells hold no payload
+                continue
+
+            index = page_type != PAGE_TYPES["table_leaf"]
+            max_local = _max_local_payload(page_size, index)
+            for cell_offset in cell_offsets:
+                position = page_start + cell_offset + (4 if interior else 0)
+                # Most cells are small, so look at the payload size alone first
+                payload_size, position = _read_varint(db, position)
+                if payload_size <= max_local:
+                    continue
+                payload_on_page = _payload_on_page(page_size, payload_size, index)
+                if not index:
+                    position = _read_varint(db, position)[1]
+                overflow_pointer = struct.unpack_from(">I", db, position + payload_on_page)[0]
+                while overflow_pointer != 0:
+                    claim(overflow_pointer, table_id, OVERFLOW_PAGE)
+                    overflow_owners[overflow_pointer] = page_number
+                    overflow_pointer = struct.unpack_from(">I", db, (overflow_pointer - 1) * page_size)[0]
+
+    change_counter = _read_header_field(db, "change_counter")
+    schema_cookie = _read_header_field(db, "schema_cookie")
+    return PageMap(page_size, change_counter, schema_cookie, tables, table_ids, kinds, overflow_owners)
 
-    # Count the number of bytes used for the varint
-    for byte in varint:
-        num_bytes += 1
-        if (byte & 0x80) == 0:
-            break
 
-    # Decode the varint as big-endian
-    for i in range(num_bytes):
-        value = (value << 7) | (varint[i] & 0x7F)
+def _read_header_field(header: bytes | memoryview, field: str) -> int:
+    """Read a big endian integer field of the database header, its position given by HEADER_INFO_POSITIONS."""
+    return int.from_bytes(header[HEADER_INFO_POSITIONS[f"{field}_start"] : HEADER_INFO_POSITIONS[f"{field}_end"] + 1])
 
-    return value, num_bytes
 
+def _read_varint(data: bytes | memoryview, offset: int) -> tuple[int, int]:
+    """Decode the big endian varint at offset in data, return its value and the offset of the byte following it.
 
-def _payload_on_page(u: int, p: int):
+    One and two byte varints, by far the most common, are decoded without looping.
     """
-    Calculate the size of the payload stored on a table btree leaf page (as opposed to on an overflow page).
+    byte = data[offset]
+    if byte < 0x80:
+        return byte, offset + 1
+    value = byte & 0x7F
+    byte = data[offset + 1]
+    if byte < 0x80:
+        return (value << 7) | byte, offset + 2
+    value = (value << 7) | (byte & 0x7F)
+    for position in range(offset + 2, offset + 8):
+        byte = data[position]
+        value = (value << 7) | (byte & 0x7F)
+        if byte < 0x80:
+            return value, position + 1
+    # All 8 bits of the ninth byte are used
+    return (value << 8) | data[offset + 8], offset + 9
+
+
+def _decode_record_header(payload: bytes | memoryview, column_count: int = -1) -> tuple[list[int], int]:
+    """Decode the serial types at the start of a record, return them and the size of the record header.
+
+    Only the first column_count serial types are decoded, or all of them if column_count is negative. Serial types
+    below 0x80 are one byte varints, so the header of a row of small integers and short strings is decoded in one go.
+    """
+    header_size, offset = _read_varint(payload, 0)
+    header = bytes(payload[offset:header_size])
+    serial_types = header if column_count < 0 else header[:column_count]
+    if serial_types.isascii():
+        return list(serial_types), header_size
+    column_types: list[int] = []
+    offset = 0
+    while offset < len(header) and len(column_types) != column_count:
+        serial_type, offset = _read_varint(header, offset)
+        column_types.append(serial_type)
+    return column_types, header_size
+
+
+def _decode_record(
+    record_data: bytes | memoryview, column_types: list[int], columns: frozenset[int] | None = None
+) -> list[Any]:
+    """Decode the values of a record body from their serial types.
+
+    If columns is given, only the values of these columns are decoded and the others are None.
+    """
+    row: list[Any] = [None] * len(column_types)
+    offset = 0
+    for column_index, serial_type in enumerate(column_types):
+        if serial_type < 12:
+            size = SERIAL_TYPE_SIZES[serial_type]
+            if columns is None or column_index in columns:
+                row[column_index] = _SERIAL_TYPE_DECODERS[serial_type](record_data, offset)
+        else:
+            size = (serial_type - 12) >> 1
+            if columns is None or column_index in columns:
+                value = record_data[offset : offset + size]
+                # Odd serial types are strings, even ones BLOBs
+                row[column_index] = str(value, "utf-8") if serial_type & 1 else bytes(value)
+        offset += size
+    return row
+
+
+def _record_size(column_types: list[int]) -> int:
+    """Size of the values of a record body with the given serial types."""
+    return sum(
+        SERIAL_TYPE_SIZES[serial_type] if serial_type < 12 else (serial_type - 12) >> 1 for serial_type in column_types
+    )
+
+
+def _payload_on_page(u: int, p: int, index: bool = False) -> int:
+    """
+    Calculate the size of the payload stored on a table btree leaf page, or an index btree page if index is True (as
+    opposed to on an overflow page).
     The logic is directly copied from sqlite documentation.
     """
-    x = u - 35
+    x = _max_local_payload(u, index)
     m = ((u - 12) * 32 // 255) - 23
 
     if p <= x:
@@ -294,33 +612,6 @@ def _payload_on_page(u: int, p: int):
         return m
 
 
-def _get_content_size_type(serial_type: int) -> tuple[int, Callable]:
-    """Convert a serial type to a content size and a function used to parse content to a Python data type"""
-    if serial_type == 0:
-        return 0, int.from_bytes  # Value is a NULL.
-    elif serial_type == 1:
-        return 1, int.from_bytes  # Value is an 8-bit twos-complement integer.
-    elif serial_type == 2:
-        return 2, int.from_bytes  # Value is a big-endian 16-bit twos-complement integer.
-    elif serial_type == 3:
-        return 3, int.from_bytes  # Value is a big-endian 24-bit twos-complement integer.
-    elif serial_type == 4:
-        return 4, int.from_bytes  # Value is a big-endian 32-bit twos-complement integer.
-    elif serial_type == 5:
-        return 6, int.from_bytes  # Value is a big-endian 48-bit twos-complement integer.
-    elif serial_type == 6:
-        return 8, int.from_bytes  # Value is a big-endian 64-bit twos-complement integer.
-    elif serial_type == 7:
-        return 8, int.from_bytes  # Value is a big-endian IEEE 754-2008 64-bit floating point number.
-    elif serial_type == 8:
-        return 0, int.from_bytes  # Value is the integer 0. (Only available for schema format 4 and higher.)
-    elif serial_type == 9:
-        return 0, int.from_bytes  # Value is the integer 1. (Only available for schema format 4 and higher.)
-    elif serial_type >= 12 and serial_type % 2 == 0:
-        return (serial_type - 12) // 2, bytes  # Value is a BLOB that is {(serial_type - 12) // 2} bytes in length.
-    elif serial_type >= 13 and serial_type % 2 == 1:
-        return (serial_type - 13) // 2, lambda x: x.decode(
-            "utf-8"
-        )  # Value is a string in the text encoding and {(serial_type - 13) // 2} bytes in length.
-    else:
-        pass
+def _max_local_payload(u: int, index: bool = False) -> int:
+    """Largest payload stored entirely on a btree page, X in the sqlite documentation."""
+    return ((u - 12) * 64 // 255) - 23 if index else u - 35
@@ -0,0 +1,110 @@
+"""Tests for the asyncio front-end of multi stream compression."""
+
+import asyncio
+import os
+
+import pytest
+
+from injection_attacks_mitigation_framework.multi_stream.aio import AsyncMSCompressor, AsyncMSDecompressor
+from injection_attacks_mitigation_framework.multi_stream.compress import (
+    MSCompressor,
+    ZlibCompressionStream,
+)
+
+
+class BufferWriter:
+    """AsyncWriter collecting everything written to it."""
+
+    def __init__(self) -> None:
+        self.data = bytearray()
+        self.drains = 0
+
+    def write(self, data: bytes) -> None:
+        self.data += data
+
+    async def drain(self) -> None:
+        self.drains += 1
+        await asyncio.sleep(0)
+
+
+class FailingCompressionStream(ZlibCompressionStream):
+    """Compression stream failing on the data b"fail"."""
+
+    def compress(self, data: bytes) -> None:
+        if data == b"fail":
+            raise ValueError("Failed")
+        super().compress(data)
+
+
+def chunks_for_job(job: int) -> list[tuple[int, bytes]]:
+    return [(i % 4, os.urandom(50) + b"job %d chunk %d" % (job, i) * 20) for i in range(100)]
+
+
+def test_async_compress_concurrent_jobs():
+    """Test concurrent jobs on one loop produce the same archives as MSCompressor."""
+
+    async def job(n):
+        writer = BufferWriter() if n % 2 else None
+        amsc = AsyncMSCompressor(ZlibCompressionStream, writer=writer, max_pending=4)
+        for stream_key, data in chunks[n]:
+            await amsc.compress(stream_key, data)
+            assert amsc._queue.qsize() <= 4
+        out = await amsc.finish()
+        return bytes(writer.data) if writer else out
+
+    async def main():
+        return await asyncio.gather(*[job(n) for n in range(6)])
+
+    chunks = [chunks_for_job(n) for n in range(6)]
+    for n, archive in enumerate(asyncio.run(main())):
+        msc = MSCompressor(ZlibCompressionStream)
+        for stream_key, data in chunks[n]:
+            msc.compress(stream_key, data)
+        assert archive == msc.finish()
+
+
+def test_async_decompress():
+    """Test decompressed data is streamed to a writer and buckets are extracted."""
+    chunks = chunks_for_job(0)
+    msc = MSCompressor(ZlibCompressionStream)
+    for stream_key, data in chunks:
+        msc.compress(stream_key, data)
+    archive = msc.finish()
+
+    async def main():
+        reader = asyncio.StreamReader()
+        reader.feed_data(archive)
+        reader.feed_eof()
+        amsd = AsyncMSDecompressor()
+        await amsd.decompress_from(reader)
+        writer = BufferWriter()
+        await amsd.write_to(writer, chunk_size=256)
+        return writer, await amsd.extract_bucket(1)
+
+    writer, bucket = asyncio.run(main())
+    assert writer.data == b"".join(data for _, data in chunks)
+    assert writer.drains > 1
+    assert bucket == b"".join(data for stream_key, data in chunks if stream_key == 1)
+
+
+def test_async_compress_error():
+    """Test an error hit by the compressor is raised to the producer."""
+
+    async def main():
+        amsc = AsyncMSCompressor(FailingCompressionStream, max_pending=1)
+        for data in [b"ok", b"fail"] + [b"ok"] * 10:
+            await amsc.compress("a", data)
+        await amsc.finish()
+
+    with pytest.raises(ValueError, match="Failed"):
+        asyncio.run(main())
+
+
+def test_async_compress_append_rejected():
+    """Test appending is rejected, since the archive cannot be read back from an AsyncWriter."""
+
+    async def main():
+        AsyncMSCompressor(ZlibCompressionStream, writer=BufferWriter(), append=True)
+
+    with pytest.raises(ValueError, match="cannot append"):
+        asyncio.run(main())
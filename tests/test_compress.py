@@ -1,20 +1,50 @@
 """Tests for multi stream compression."""
 
+import array
+import json
+import mmap
 import os
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 
 import pytest
 
 from injection_attacks_mitigation_framework.multi_stream.compress import (
+    CODEC_NAMES,
+    COMPRESSION_STREAMS,
+    DEFAULT_BLOCK_SIZE,
+    AdaptiveStreamPolicy,
     MSCompressor,
     MSDecompressor,
+    ParallelZlibCompressionStream,
+    StreamClosedException,
     ZlibCompressionStream,
     ZlibDecompressionStream,
+    available_codecs,
+    build_preset_dictionary,
 )
+from injection_attacks_mitigation_framework.multi_stream.container import CONTAINER_MAGIC, decode_header
 
 TEST1 = b"The quick brown fox jumped over the lazy dog"
 TEST2 = b"The quick brown fox jumped over the lazy dog round 2"
 
 
+def escaped_format_archive(chunks, stream_switch_delimiter=b"[|", output_delimiter=b"\x7f"):
+    """Build an archive in the escaped format written before the container format was introduced."""
+    streams = {}
+    for stream_key, data in chunks:
+        streams.setdefault(stream_key, zlib.compressobj())
+    compressed = {k: b"" for k in streams}
+    for stream_key, data in chunks:
+        compressed[stream_key] += streams[stream_key].compress(data + stream_switch_delimiter)
+    archive = json.dumps([k for k, _ in chunks]).encode("utf-8") + output_delimiter
+    for k, c in compressed.items():
+        c += streams[k].flush()
+        archive += c.replace(b"Z", b"ZZ").replace(output_delimiter, b"Z:") + output_delimiter
+    return archive
+
+
 def test_compress_correctness():
     """Test compression correctness."""
     msc = MSCompressor(ZlibCompressionStream)
@@ -85,3 +115,465 @@ def test_compress_blocks(rdata):
     decompressed_data = msd.finish()
 
     assert decompressed_data == rdata
+
+
+def test_compress_container_header():
+    """Test the container header locates every stream without escaping."""
+    msc = MSCompressor(ZlibCompressionStream)
+    msc.compress("a", TEST1)
+    msc.compress("b", TEST2)
+    msc.compress("a", TEST2)
+    c = msc.finish()
+
+    assert c.startswith(CONTAINER_MAGIC)
+    header = decode_header(c)
+    assert header.stream_switch == ["a", "b", "a"]
+    assert [s.key for s in header.segments] == ["a", "b"]
+    assert header.segments[0].offset == header.header_length
+    for entry, expected in zip(header.segments, [TEST1 + TEST2, TEST2]):
+        stream = c[entry.offset : entry.offset + entry.compressed_length]
+        assert zlib.decompress(stream) == expected
+        assert entry.uncompressed_length == len(expected)
+    assert header.fragment_lengths == [len(TEST1), len(TEST2), len(TEST2)]
+
+
+def test_compress_data_containing_delimiter():
+    """Test data is not scanned for a delimiter, any bytes can be compressed."""
+    chunks = [("a", b"[|" * 100), ("b", b"\x7fZ:[|"), ("a", bytes(range(256)) * 40)]
+    msc = MSCompressor(ZlibCompressionStream)
+    for stream_key, data in chunks:
+        msc.compress(stream_key, data)
+    msd = MSDecompressor()
+    msd.decompress(msc.finish())
+    assert b"".join(msd.iter_chunks(chunk_size=7)) == b"".join(data for _, data in chunks)
+    assert msd.extract_bucket("b") == b"\x7fZ:[|"
+
+
+def test_container_switch_runs():
+    """Test the stream switch survives run length encoding with short and long fragments."""
+    chunks = [("a", b"x" * 10)] * 500 + [("b", b"y" * 300), ("a", b"")] * 200 + [("c", b"z")]
+    msc = MSCompressor(ZlibCompressionStream)
+    for stream_key, data in chunks:
+        msc.compress(stream_key, data)
+    assert msc.switch_runs[0] == [0, 500]
+    assert msc.stream_switch == [k for k, _ in chunks]
+    c = msc.finish()
+
+    header = decode_header(c)
+    assert header.stream_switch == [k for k, _ in chunks]
+    assert header.fragment_lengths == [len(d) for _, d in chunks]
+    # The repeated switch pattern deflates to far less than a byte per call to compress
+    assert header.header_length < len(chunks) // 4
+
+    msd = MSDecompressor()
+    msd.decompress(c)
+    assert msd.finish() == b"".join(d for _, d in chunks)
+
+
+def test_extract_bucket():
+    """Test one bucket is extracted using the index without touching the other streams."""
+    chunks = [("a", TEST1), ("b", os.urandom(5000)), ("a", TEST2), ("c", b""), ("b", TEST1)]
+    msc = MSCompressor(ZlibCompressionStream)
+    for stream_key, data in chunks:
+        msc.compress(stream_key, data)
+    c = bytearray(msc.finish())
+
+    # Corrupt stream "b", extracting the other buckets must still succeed
+    entry = decode_header(c).segments[1]
+    c[entry.offset : entry.offset + entry.compressed_length] = b"\x00" * entry.compressed_length
+
+    msd = MSDecompressor()
+    msd.decompress(bytes(c))
+    assert msd.index["a"].switch_positions == [0, 2]
+    assert msd.index["a"].fragment_offsets == [0, len(TEST1)]
+    assert msd.extract_bucket("a") == TEST1 + TEST2
+    assert msd.extract_bucket("c") == b""
+    with pytest.raises(zlib.error):
+        msd.extract_bucket("b")
+    with pytest.raises(KeyError):
+        msd.extract_bucket("missing")
+
+
+def test_extract_bucket_escaped_format():
+    """Test buckets can be extracted from archives in the escaped format."""
+    chunks = [(0, TEST1), (1, TEST2), (0, TEST2)]
+    msd = MSDecompressor(ZlibDecompressionStream)
+    msd.decompress(escaped_format_archive(chunks))
+    assert msd.extract_bucket(0) == TEST1 + TEST2
+    assert msd.extract_bucket(1) == TEST2
+
+
+def test_decompress_escaped_format():
+    """Test archives written in the escaped format can still be decompressed."""
+    chunks = [(0, os.urandom(2000).replace(b"[|", b"..")), (None, b"Z:ZZ\x7fZ" * 50), (0, TEST1)]
+    msd = MSDecompressor(ZlibDecompressionStream)
+    msd.decompress(escaped_format_archive(chunks))
+    assert msd.finish() == b"".join(data for _, data in chunks)
+
+
+def test_decode_add_output_delimiter_matches_bytewise_parse():
+    """Test unescaping agrees with a byte by byte parse of the escape sequences."""
+    data = bytes(os.urandom(4000)) + b"ZZZ:Z:ZZZZ\x7fZ\x7f:Z"
+    escaped = data.replace(b"Z", b"ZZ").replace(b"\x7f", b"Z:")
+
+    expected = bytearray()
+    pair = False
+    for b in escaped:
+        if pair:
+            expected.append(b"Z"[0] if b == b"Z"[0] else 0x7F)
+            pair = False
+        elif b == b"Z"[0]:
+            pair = True
+        else:
+            expected.append(b)
+
+    msd = MSDecompressor(ZlibDecompressionStream)
+    assert msd.decode_add_output_delimiter(escaped) == bytes(expected) == data
+
+
+@pytest.mark.parametrize("sink_type", ["file", "path"])
+def test_compress_to_sink(sink_type, tmp_path):
+    """Test streaming to a sink writes the same container as compressing in memory."""
+    chunks = [(i % 7, os.urandom(64) + TEST1 * (i % 50)) for i in range(500)]
+
+    msc = MSCompressor(ZlibCompressionStream)
+    for stream_key, data in chunks:
+        msc.compress(stream_key, data)
+    expected = msc.finish()
+
+    path = tmp_path / "archive.msc"
+    if sink_type == "file":
+        with path.open("wb") as f:
+            msc_sink = MSCompressor(ZlibCompressionStream, sink=f)
+            for stream_key, data in chunks:
+                msc_sink.compress(stream_key, data)
+            assert msc_sink.finish() is None
+    else:
+        msc_sink = MSCompressor(ZlibCompressionStream, sink=path)
+        for stream_key, data in chunks:
+            msc_sink.compress(stream_key, data)
+        msc_sink.finish()
+
+    assert path.read_bytes() == expected
+    msd = MSDecompressor(ZlibDecompressionStream)
+    msd.decompress(path.read_bytes())
+    assert msd.finish() == b"".join(data for _, data in chunks)
+
+
+def test_decompress_iter_chunks():
+    """Test iter_chunks yields the original data in order, in bounded chunks, including fragments larger than a chunk."""
+    chunks = [("a", TEST1 * 2000), ("b", TEST2), ("a", b""), ("b", os.urandom(5000)), ("a", TEST1)]
+    msc = MSCompressor(ZlibCompressionStream)
+    for stream_key, data in chunks:
+        msc.compress(stream_key, data)
+
+    msd = MSDecompressor(ZlibDecompressionStream)
+    msd.decompress(msc.finish())
+    out = list(msd.iter_chunks(chunk_size=1024))
+
+    assert b"".join(out) == b"".join(data for _, data in chunks)
+    assert max(len(o) for o in out) <= 1024
+
+
+@pytest.mark.parametrize("to_sink", [False, True])
+def test_compress_workers_identical_output(to_sink, tmp_path):
+    """Test compressing streams on worker threads produces the same archive as compressing serially."""
+    chunks = [(i % 13, (TEST1 + bytes([i % 256])) * (i % 40)) for i in range(2000)]
+
+    def compress(**kwargs):
+        msc = MSCompressor(ZlibCompressionStream, **kwargs)
+        for stream_key, data in chunks:
+            msc.compress(stream_key, data)
+        return msc.finish()
+
+    expected = compress()
+    if to_sink:
+        path = tmp_path / "archive.msc"
+        compress(workers=4, sink=path)
+        assert path.read_bytes() == expected
+    else:
+        assert compress(workers=4) == expected
+
+
+@pytest.mark.parametrize("sink_type", ["file", "path"])
+def test_compress_append(sink_type, tmp_path):
+    """Test appending to an archive leaves the existing segments untouched and decompresses to all data in order."""
+    days = [[("a", TEST1), ("b", TEST2)], [("b", TEST1 * 3), ("c", b"")], [("a", TEST2)]]
+    path = tmp_path / "archive.msc"
+    dictionary = build_preset_dictionary([TEST1 + TEST2])
+    for day, chunks in enumerate(days):
+        previous = path.read_bytes() if path.exists() else b""
+        params = {"preset_dictionary": dictionary} if day == 0 else {}
+        if sink_type == "path":
+            msc = MSCompressor(ZlibCompressionStream, sink=path, append=True, **params)
+        else:
+            f = path.open("r+b") if path.exists() else path.open("w+b")
+            msc = MSCompressor(ZlibCompressionStream, sink=f, append=True, **params)
+        for stream_key, data in chunks:
+            msc.compress(stream_key, data)
+        msc.finish()
+        if sink_type == "file":
+            f.close()
+        assert path.read_bytes().startswith(previous)
+
+    msd = MSDecompressor()
+    msd.decompress(path.read_bytes())
+    assert msd.finish() == b"".join(data for chunks in days for _, data in chunks)
+    assert msd.stream_switch == ["a", "b", "b", "c", "a"]
+    assert msd.extract_bucket("b") == TEST2 + TEST1 * 3
+    assert decode_header(path.read_bytes()).dictionary == dictionary
+
+    with pytest.raises(ValueError):
+        MSCompressor(COMPRESSION_STREAMS[CODEC_NAMES["bz2"]], sink=path, append=True)
+    with pytest.raises(ValueError):
+        MSCompressor(ZlibCompressionStream, sink=path, append=True, preset_dictionary=b"other")
+
+
+@pytest.mark.parametrize("workers", [0, 3])
+def test_compress_max_live_streams(workers, tmp_path):
+    """Test evicted streams continue in new segments and are reassembled transparently."""
+    chunks = [(i % 5, TEST1 * (i % 3) + bytes([i % 256])) for i in range(200)] + [(0, TEST2)]
+    expected = b"".join(data for _, data in chunks)
+
+    msc = MSCompressor(ZlibCompressionStream, max_live_streams=2, workers=workers)
+    for stream_key, data in chunks:
+        msc.compress(stream_key, data)
+        assert len(msc.live_segments) <= 2
+    c = msc.finish()
+    msc_sink = MSCompressor(ZlibCompressionStream, max_live_streams=2, workers=workers, sink=tmp_path / "archive")
+    for stream_key, data in chunks:
+        msc_sink.compress(stream_key, data)
+    msc_sink.finish()
+    assert (tmp_path / "archive").read_bytes() == c
+
+    header = decode_header(c)
+    assert header.stream_keys == [0, 1, 2, 3, 4]
+    assert len(header.segments) == 201
+    for d in [MSDecompressor(), MSDecompressor(workers=2)]:
+        d.decompress(c)
+        assert d.finish() == expected
+    msd = MSDecompressor()
+    msd.decompress(c)
+    assert b"".join(msd.iter_chunks(chunk_size=16)) == expected
+    assert msd.extract_bucket(0) == b"".join(data for stream_key, data in chunks if stream_key == 0)
+
+
+def test_decompress_workers():
+    """Test decompressing streams on worker threads reassembles the original order."""
+    chunks = [(i % 5, TEST1 * (i % 7) + bytes([i % 256])) for i in range(300)]
+    msc = MSCompressor(ZlibCompressionStream)
+    for stream_key, data in chunks:
+        msc.compress(stream_key, data)
+
+    msd = MSDecompressor(ZlibDecompressionStream, workers=3)
+    msd.decompress(msc.finish())
+    assert msd.finish() == b"".join(data for _, data in chunks)
+
+
+@pytest.mark.parametrize("codec", CODEC_NAMES)
+def test_compress_codecs(codec):
+    """Test every codec round trips and the decompressor picks the codec recorded in the archive."""
+    if codec not in available_codecs():
+        pytest.skip(f"{codec} is not installed")
+    chunks = [(i % 3, TEST1 * (i % 300)) for i in range(60)]
+    msc = MSCompressor(COMPRESSION_STREAMS[CODEC_NAMES[codec]], level=1)
+    for stream_key, data in chunks:
+        msc.compress(stream_key, data)
+    c = msc.finish()
+
+    assert decode_header(c).codec_id == CODEC_NAMES[codec]
+    msd = MSDecompressor()
+    msd.decompress(c)
+    assert msd.stream_type.codec_id == CODEC_NAMES[codec]
+    assert b"".join(msd.iter_chunks(chunk_size=512)) == b"".join(data for _, data in chunks)
+
+
+@pytest.mark.parametrize("codec", ["zlib", "zstd"])
+def test_compress_preset_dictionary(codec):
+    """Test streams primed with a preset dictionary compress small fragments better and round trip."""
+    if codec not in available_codecs():
+        pytest.skip(f"{codec} is not installed")
+    chunks = [(i, TEST2 + bytes([i])) for i in range(20)]
+
+    def compress(preset_dictionary):
+        msc = MSCompressor(COMPRESSION_STREAMS[CODEC_NAMES[codec]], preset_dictionary=preset_dictionary)
+        for stream_key, data in chunks:
+            msc.compress(stream_key, data)
+        return msc.finish()
+
+    dictionary = build_preset_dictionary([TEST1, TEST2])
+    c = compress(dictionary)
+    assert decode_header(c).dictionary == dictionary
+    assert len(c) < len(compress(None))
+
+    msd = MSDecompressor()
+    msd.decompress(c)
+    assert msd.finish() == b"".join(data for _, data in chunks)
+
+
+def test_compress_preset_dictionary_unsupported():
+    """Test codecs without preset dictionary support reject one."""
+    with pytest.raises(ValueError):
+        MSCompressor(COMPRESSION_STREAMS[CODEC_NAMES["bz2"]], preset_dictionary=TEST1)
+
+
+@pytest.mark.parametrize(
+    "policy_params, expected_settings",
+    [({}, [0, 2]), ({"target_ratio": 2}, [0, 0]), ({"time_budget": 0, "expected_size": 1}, [0, 0])],
+)
+def test_adaptive_stream_policy(policy_params, expected_settings):
+    """Test the policy picks each segment's codec and level, and segments with different codecs decompress."""
+    settings = [(ZlibCompressionStream, 1), (ZlibCompressionStream, 9), (COMPRESSION_STREAMS[CODEC_NAMES["lzma"]], 6)]
+    chunks = [("random", os.urandom(8000)), ("text", TEST1 * 200), ("random", os.urandom(100)), ("text", TEST2)]
+    msc = MSCompressor(ZlibCompressionStream, stream_policy=AdaptiveStreamPolicy(settings, **policy_params))
+    for stream_key, data in chunks:
+        msc.compress(stream_key, data)
+    assert [segment.setting for segment in msc.segments] == [settings[i] for i in expected_settings]
+    c = msc.finish()
+
+    assert [entry.codec_id for entry in decode_header(c).segments] == [
+        settings[i][0].codec_id for i in expected_settings
+    ]
+    msd = MSDecompressor()
+    msd.decompress(c)
+    assert msd.finish() == b"".join(data for _, data in chunks)
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_stream_stats(workers):
+    """Test per stream statistics match the archive and the callbacks see every finished segment or stream."""
+    chunks = [("a", TEST1), ("a", TEST2), ("b", TEST1 * 10), ("a", TEST1), ("c", os.urandom(100))]
+    finished = []
+    msc = MSCompressor(ZlibCompressionStream, workers=workers, max_live_streams=2, stats_callback=finished.append)
+    for stream_key, data in chunks:
+        msc.compress(stream_key, data)
+    assert msc.stats.streams["a"].bytes_in == len(TEST1 * 2 + TEST2)
+    c = msc.finish()
+
+    stats = msc.stats
+    assert [(s.key, s.segments, s.switches, s.fragments) for s in stats.streams.values()] == [
+        ("a", 1, 2, 3),
+        ("b", 1, 1, 1),
+        ("c", 1, 1, 1),
+    ]
+    assert stats.bytes_in == sum(len(data) for _, data in chunks)
+    assert stats.header_length + stats.bytes_out == len(c)
+    assert stats.codec_seconds > 0 and stats.flush_seconds > 0
+    assert sorted(s.key for s in finished) == ["a", "b", "c"]
+
+    msd_finished = []
+    msd = MSDecompressor(workers=workers, stats_callback=msd_finished.append)
+    msd.decompress(c)
+    assert [(s.key, s.segments, s.switches, s.fragments) for s in msd.stats.streams.values()] == [
+        (s.key, s.segments, s.switches, s.fragments) for s in stats.streams.values()
+    ]
+    assert msd.stats.header_length == stats.header_length
+    msd.finish()
+    assert msd.stats.bytes_in == stats.bytes_out
+    assert msd.stats.bytes_out == stats.bytes_in
+    assert sorted(s.key for s in msd_finished) == ["a", "b", "c"]
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_compress_buffer_protocol(workers, tmp_path):
+    """Test buffer protocol objects are compressed like the equivalent bytes."""
+    data = TEST1 * 100 + os.urandom(64)
+    path = tmp_path / "source"
+    path.write_bytes(data)
+    policy = AdaptiveStreamPolicy(min_sample_size=16)
+
+    msc_bytes = MSCompressor(ZlibCompressionStream, workers=workers, stream_policy=policy)
+    for stream_key, chunk in [("a", data[:1000]), ("b", data[1000:]), ("a", data[:64]), ("c", data[:64])]:
+        msc_bytes.compress(stream_key, chunk)
+    expected = msc_bytes.finish()
+
+    with path.open("rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as source:
+        view = memoryview(source)
+        msc = MSCompressor(ZlibCompressionStream, workers=workers, stream_policy=policy)
+        msc.compress("a", view[:1000])
+        msc.compress("b", bytearray(data[1000:]))
+        msc.compress("a", array.array("I", data[:64]))
+        msc.compress("c", source[:64])
+        c = msc.finish()
+        view.release()
+    assert c == expected
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_compress_producers(workers, tmp_path):
+    """Test producers writing concurrently decompress in the order their ranges were reserved."""
+    parts = [
+        [(f"t{(p + i) % 3}", os.urandom(20) + TEST1 * (i % 4) + bytes([p, i % 256])) for i in range(300)]
+        for p in range(4)
+    ]
+    before = [("t0", TEST1), ("t1", TEST2)]
+    between = [("t1", TEST2), ("own", TEST1)]
+
+    for sink in [None, tmp_path / "archive"]:
+        msc = MSCompressor(ZlibCompressionStream, sink=sink, workers=workers, max_live_streams=2)
+        for stream_key, data in before:
+            msc.compress(stream_key, data)
+        producers = [msc.producer() for _ in parts[:2]]
+        for stream_key, data in between:
+            msc.compress(stream_key, data)
+        producers += [msc.producer() for _ in parts[2:]] + [msc.producer()]
+
+        def produce(producer, chunks):
+            with producer:
+                for stream_key, data in chunks:
+                    producer.compress(stream_key, data)
+
+        threads = [threading.Thread(target=produce, args=args) for args in zip(producers, parts)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        with pytest.raises(RuntimeError):
+            msc.finish()
+        producers[-1].close()
+        c = msc.finish()
+        if sink is not None:
+            c = sink.read_bytes()
+
+        expected_chunks = before + parts[0] + parts[1] + between + parts[2] + parts[3]
+        msd = MSDecompressor()
+        msd.decompress(c)
+        assert msd.finish() == b"".join(data for _, data in expected_chunks)
+        assert msd.extract_bucket("t1") == b"".join(data for stream_key, data in expected_chunks if stream_key == "t1")
+        assert msc.stats.bytes_in == sum(len(data) for _, data in expected_chunks)
+        assert msc.stats.fragments == len(decode_header(c).fragment_lengths)
+        with pytest.raises(StreamClosedException):
+            producers[0].compress("t0", TEST1)
+
+
+@pytest.mark.parametrize("zdict", [None, TEST1 * 20])
+@pytest.mark.parametrize("block_size", [1000, DEFAULT_BLOCK_SIZE])
+def test_parallel_zlib_compression_stream(zdict, block_size, tmp_path):
+    """Test blocks compressed in parallel form one zlib stream, nearly as small as compressing serially."""
+    data = b"".join(os.urandom(4) + TEST1 + bytes([i % 256]) for i in range(5000))
+    compression_stream = ParallelZlibCompressionStream(zdict=zdict, block_size=block_size)
+    taken = b""
+    for start in range(0, len(data), 3000):
+        compression_stream.compress(memoryview(data)[start : start + 3000])
+        taken += compression_stream.take()
+    compressed = taken + compression_stream.finish()
+
+    decompression_stream = ZlibDecompressionStream(zdict=zdict)
+    decompression_stream.decompress(compressed)
+    assert decompression_stream.finish() == data
+    if block_size == DEFAULT_BLOCK_SIZE:
+        serial = ZlibCompressionStream(zdict=zdict)
+        serial.compress(data)
+        assert len(compressed) < len(serial.finish()) * 1.02
+
+    chunks = [(i % 3, data[i * 1000 : (i + 1) * 1000]) for i in range(200)]
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        msc = MSCompressor(
+            ParallelZlibCompressionStream, sink=tmp_path / "archive", block_size=block_size, executor=executor
+        )
+        for stream_key, chunk in chunks:
+            msc.compress(stream_key, chunk)
+        msc.finish()
+    msd = MSDecompressor()
+    msd.decompress((tmp_path / "archive").read_bytes())
+    assert msd.finish() == data[:200000]
@@ -1,4 +1,5 @@
 import os
+import sqlite3
 from pathlib import Path
 from xml.etree import ElementTree
 
@@ -8,6 +9,7 @@ from injection_attacks_mitigation_framework.end_to_end.compress_sqlite_advanced
     compress_sqlite_advanced,
     decompress_sqlite_advanced,
 )
+from injection_attacks_mitigation_framework.end_to_end.compress_sqlite_simple import compress_sqlite_simple
 from injection_attacks_mitigation_framework.end_to_end.compress_xml_advanced import (
     compress_xml_advanced_by_element,
     decompress_xml_advanced_by_element,
@@ -17,11 +19,18 @@ from injection_attacks_mitigation_framework.end_to_end.compress_xml_simple impor
     decompress_xml_simple,
 )
 from injection_attacks_mitigation_framework.end_to_end.dedup_files import dedup_files_by_name
-from injection_attacks_mitigation_framework.multi_stream.compress import ZlibCompressionStream
+from injection_attacks_mitigation_framework.multi_stream.compress import (
+    MSDecompressor,
+    ZlibCompressionStream,
+    ZlibDecompressionStream,
+)
+from injection_attacks_mitigation_framework.multi_stream.container import decode_archive
 from injection_attacks_mitigation_framework.partitioner.access_control import (
     basic_partition_policy,
     generate_attribute_based_partition_policy,
 )
+from injection_attacks_mitigation_framework.partitioner.types.sqlite_simple import SQLiteSimplePartitioner
+from tests.example_data.generate_test_db_sqlite import create_messages_db, insert_message
 from tests.test_partitioner_sqlite import gid_as_principal_access_control_policy
 from tests.test_partitioner_xml import (
     example_author_as_principal_books_xml,
@@ -136,3 +145,53 @@ def test_compress_sql_advanced_basic(scratch_dir):
 
     assert len(partition_compressed_bytes) > len(regular_compressed_bytes)  # This may not be true for large DBs
     assert path.read_bytes() == partition_decompressed_bytes
+
+
+def test_compress_sql_advanced_preset_dictionary(tmpdir):
+    db_path = Path(tmpdir) / "messages.db"
+    create_messages_db(str(db_path))
+    with sqlite3.connect(db_path) as con:
+        con.execute("CREATE INDEX message_content ON message (content)")
+    con.close()
+    for gid in range(20):
+        insert_message(str(db_path), gid, 1, f"secret of {gid}")
+
+    compressed = compress_sqlite_advanced(
+        db_path,
+        gid_as_principal_access_control_policy,
+        generate_attribute_based_partition_policy("gid"),
+        preset_dictionary=True,
+    )
+    # Index pages are in the null principal bucket, but only rows of the null principal go in the dictionary
+    dictionary = decode_archive(compressed).dictionary
+    assert dictionary
+    assert b"secret" not in dictionary
+    assert decompress_sqlite_advanced(compressed) == db_path.read_bytes()
+
+
+def test_compress_xml_advanced_preset_dictionary():
+    path = Path(__file__).parent / "example_data/keepass_sample.xml"
+    policy = example_group_uuid_as_principal_keepass_sample_xml
+
+    dict_compressed_bytes = compress_xml_advanced_by_element(path, policy, preset_dictionary=True)
+
+    assert len(dict_compressed_bytes) < len(compress_xml_advanced_by_element(path, policy))
+    assert decompress_xml_advanced_by_element(dict_compressed_bytes) == decompress_xml_advanced_by_element(
+        compress_xml_advanced_by_element(path, policy)
+    )
+
+
+def test_compress_sqlite_simple_empty_bucket(tmp_path, monkeypatch):
+    bucket_paths = [tmp_path / "empty.db", tmp_path / "full.db"]
+    bucket_paths[0].write_bytes(b"")
+    bucket_paths[1].write_bytes(b"SQLite format 3\x00" * 100)
+    monkeypatch.setattr(SQLiteSimplePartitioner, "partition", lambda self: bucket_paths)
+
+    compressed = compress_sqlite_simple(
+        tmp_path / "unused.db",
+        gid_as_principal_access_control_policy,
+        generate_attribute_based_partition_policy("gid"),
+    )
+    msd = MSDecompressor(ZlibDecompressionStream)
+    msd.decompress(compressed)
+    assert msd.finish() == bucket_paths[1].read_bytes()
@@ -1,15 +1,24 @@
+import sqlite3
 from pathlib import Path
 
+import pytest
+
 from injection_attacks_mitigation_framework.partitioner.access_control import (
     Principal,
     generate_attribute_based_partition_policy,
 )
-from injection_attacks_mitigation_framework.partitioner.types.sqlite_advanced import SQLiteAdvancedPartitioner
+from injection_attacks_mitigation_framework.partitioner.types.sqlite_advanced import (
+    OVERFLOW_PAGE,
+    PAGE_TYPES,
+    UNOWNED_PAGE,
+    SQLiteAdvancedPartitioner,
+    _read_varint,
+)
 from injection_attacks_mitigation_framework.partitioner.types.sqlite_simple import (
     SQLiteDataUnit,
     SQLiteSimplePartitioner,
 )
-from tests.example_data.generate_test_db_sqlite import generate_test_db_sqlite
+from tests.example_data.generate_test_db_sqlite import create_messages_db, generate_test_db_sqlite, insert_message
 
 
 def gid_as_principal_access_control_policy(sqlite_du: SQLiteDataUnit):
@@ -63,3 +72,219 @@ def test_partitioner_sqlite_advanced_gid_col_as_principal_whatsapp_sample(tmpdir
     assert reconstructed_db_bytes == original_bytes
     assert out[0][1] == original_bytes[:100] and out[0][0] == np_str
     assert "def! we should!".encode() in out[5000][1] and out[5000][0] == "31"
+
+
+def test_partitioner_sqlite_advanced_overflow_pages_zero_copy(tmpdir):
+    db_path = Path(tmpdir) / "overflow.db"
+    create_messages_db(str(db_path))
+    for gid, content in [(1, "short"), (2, "long message " * 1000), (3, "short"), (2, "x" * 9000)]:
+        insert_message(str(db_path), gid, 1, content)
+
+    for zero_copy in [False, True]:
+        partitioner = SQLiteAdvancedPartitioner(
+            db_path,
+            gid_as_principal_access_control_policy,
+            generate_attribute_based_partition_policy("gid"),
+            zero_copy=zero_copy,
+        )
+        out = partitioner.partition()
+        assert all(isinstance(data, memoryview if zero_copy else bytes) for _, data in out)
+        assert b"".join(data for _, data in out) == db_path.read_bytes()
+        # Both long messages spill to overflow pages, which are bucketed with their cell
+        assert sum(len(data) for bucket, data in out if bucket == "2") > 9000 + 13000
+        assert {bucket for bucket, _ in out} == {"1", "2", "3", str(Principal(null=True))}
+
+
+def test_partitioner_sqlite_advanced_close(tmpdir):
+    db_path = Path(tmpdir) / "messages.db"
+    create_messages_db(str(db_path))
+    for gid in [1, 2, 1]:
+        insert_message(str(db_path), gid, 1, "content")
+
+    with SQLiteAdvancedPartitioner(
+        db_path,
+        gid_as_principal_access_control_policy,
+        generate_attribute_based_partition_policy("gid"),
+        zero_copy=True,
+    ) as partitioner:
+        out = partitioner.partition()
+        # The bucketed data is a view of the mapping, which cannot be unmapped while it is referenced
+        with pytest.raises(BufferError):
+            partitioner.close()
+        assert b"".join(data for _, data in out) == db_path.read_bytes()
+        del out
+    assert partitioner._mapping is None
+    assert partitioner.shared_cells == []
+
+
+def test_partitioner_sqlite_advanced_page_map(tmpdir):
+    db_path = Path(tmpdir) / "fragmented.db"
+    create_messages_db(str(db_path))
+    with sqlite3.connect(db_path) as con:
+        con.execute("CREATE INDEX message_content ON message (content)")
+    # The overflow pages of the first message are allocated before the leaf pages its cell ends up on once the table
+    # grows, and its content also overflows the index
+    insert_message(str(db_path), 5, 1, "long message " * 1000)
+    for i in range(300):
+        insert_message(str(db_path), i % 3, 0, f"message {i}")
+
+    partitioner = SQLiteAdvancedPartitioner(
+        db_path, gid_as_principal_access_control_policy, generate_attribute_based_partition_policy("gid")
+    )
+    out = partitioner.partition()
+    page_map = partitioner.page_map
+    kinds = list(page_map.kinds[1:])
+    assert UNOWNED_PAGE not in kinds
+    overflow_pages = [page_number for page_number, kind in enumerate(page_map.kinds) if kind == OVERFLOW_PAGE]
+    first_leaf = min(
+        page_map.overflow_owners[page_number]
+        for page_number in overflow_pages
+        if page_map.kinds[page_map.overflow_owners[page_number]] == PAGE_TYPES["table_leaf"]
+    )
+    assert min(overflow_pages) < first_leaf
+    assert sorted(page_map.tables) == ["message", "sqlite_schema", "sqlite_sequence"]
+
+    np_str = str(Principal(null=True))
+    assert b"".join(data for _, data in out) == db_path.read_bytes()
+    assert {bucket for bucket, _ in out} == {"0", "1", "2", "5", np_str}
+    assert sum(len(data) for bucket, data in out if bucket == "5") > 13000
+
+    reused = SQLiteAdvancedPartitioner(
+        db_path,
+        gid_as_principal_access_control_policy,
+        generate_attribute_based_partition_policy("gid"),
+        page_map=page_map,
+    )
+    assert reused.partition() == out
+
+
+def test_partitioner_sqlite_advanced_stale_page_map(tmpdir):
+    db_path = Path(tmpdir) / "messages.db"
+    create_messages_db(str(db_path))
+    for gid in [1, 2, 1]:
+        insert_message(str(db_path), gid, 1, "content")
+    partitioner = SQLiteAdvancedPartitioner(
+        db_path, gid_as_principal_access_control_policy, generate_attribute_based_partition_policy("gid")
+    )
+    partitioner.partition()
+
+    # Rewriting a row leaves the size of the database unchanged, but a map of the earlier layout may no longer fit
+    size = db_path.stat().st_size
+    with sqlite3.connect(db_path) as con:
+        con.execute("UPDATE message SET content = 'CONTENT' WHERE gid = 2")
+    assert db_path.stat().st_size == size
+    stale = SQLiteAdvancedPartitioner(
+        db_path,
+        gid_as_principal_access_control_policy,
+        generate_attribute_based_partition_policy("gid"),
+        page_map=partitioner.page_map,
+    )
+    with pytest.raises(ValueError, match="different database"):
+        stale.partition()
+
+
+def test_partitioner_sqlite_advanced_columns(tmpdir):
+    db_path = Path(tmpdir) / "columns.db"
+    create_messages_db(str(db_path))
+    for gid, content in [(1, "short"), (2, "long message " * 1000), (3, "short")]:
+        insert_message(str(db_path), gid, 1, content)
+
+    rows = []
+
+    def recording_policy(sqlite_du: SQLiteDataUnit):
+        rows.append((sqlite_du.table_name, sqlite_du.row))
+        return gid_as_principal_access_control_policy(sqlite_du)
+
+    full = SQLiteAdvancedPartitioner(
+        db_path, gid_as_principal_access_control_policy, generate_attribute_based_partition_policy("gid")
+    ).partition()
+    partitioner = SQLiteAdvancedPartitioner(
+        db_path, recording_policy, generate_attribute_based_partition_policy("gid"), columns={"message": [1, 2]}
+    )
+    assert partitioner.partition() == full
+    # Only gid and from_me are decoded, the row stops before content, and other tables are not decoded at all
+    message_rows = sorted(row for table_name, row in rows if table_name == "message")
+    assert message_rows == [(None, 1, 1), (None, 2, 1), (None, 3, 1)]
+    assert all(row == () for table_name, row in rows if table_name != "message")
+
+
+def test_partitioner_sqlite_advanced_shared_cells(tmpdir):
+    db_path = Path(tmpdir) / "shared.db"
+    create_messages_db(str(db_path))
+    with sqlite3.connect(db_path) as con:
+        con.execute("CREATE INDEX message_content ON message (content)")
+        con.execute("CREATE TABLE contact (name TEXT)")
+        con.execute("INSERT INTO contact (name) VALUES ('shared contact')")
+    con.close()
+    insert_message(str(db_path), 1, 1, "secret of one")
+    insert_message(str(db_path), 2, 1, "secret of two " * 500)
+
+    np_str = str(Principal(null=True))
+    for zero_copy in [False, True]:
+        partitioner = SQLiteAdvancedPartitioner(
+            db_path,
+            gid_as_principal_access_control_policy,
+            generate_attribute_based_partition_policy("gid"),
+            zero_copy=zero_copy,
+        )
+        out = partitioner.partition()
+        # The index pages in the null principal bucket carry the content of every message
+        assert b"secret of one" in b"".join(data for bucket, data in out if bucket == np_str)
+        assert all(isinstance(data, memoryview if zero_copy else bytes) for data in partitioner.shared_cells)
+        shared = b"".join(partitioner.shared_cells)
+        assert b"shared contact" in shared
+        assert b"secret" not in shared
+
+
+def test_partitioner_sqlite_advanced_record_decoding(tmpdir):
+    db_path = Path(tmpdir) / "types.db"
+    values = [
+        (None, 0, 1, -1, 300, -(2**23), 2**31 - 1, -(2**40), 2**63 - 1, -(2**63)),
+        (1.5, -0.25, "", "é" * 100, b"", b"\x00\xff" * 100, "x" * 5000, 127, 128, 2**47),
+    ]
+    with sqlite3.connect(db_path) as con:
+        con.execute(f"CREATE TABLE t ({', '.join(f'c{i}' for i in range(10))})")
+        con.executemany(f"INSERT INTO t VALUES ({', '.join('?' * 10)})", values)
+    con.close()
+
+    rows = []
+
+    def recording_policy(sqlite_du: SQLiteDataUnit):
+        if sqlite_du.table_name == "t":
+            rows.append(sqlite_du.row)
+        return Principal(null=True)
+
+    SQLiteAdvancedPartitioner(db_path, recording_policy, generate_attribute_based_partition_policy("gid")).partition()
+    assert sorted(rows, key=repr) == sorted(values, key=repr)
+
+
+def test_read_varint():
+    for value in [0, 127, 128, 16383, 16384, 2**56 - 1, 2**56, 2**64 - 1]:
+        if value >= 2**56:
+            # Nine byte varints use all 8 bits of their last byte
+            encoded = bytes((value >> (8 + 7 * i)) & 0x7F | 0x80 for i in reversed(range(8))) + bytes([value & 0xFF])
+        else:
+            septets = [(value >> (7 * i)) & 0x7F for i in reversed(range(max((value.bit_length() + 6) // 7, 1)))]
+            encoded = bytes(septet | 0x80 for septet in septets[:-1]) + bytes(septets[-1:])
+        assert _read_varint(b"\x00" + encoded + b"\xff", 1) == (value, 1 + len(encoded))
+
+
+def test_partitioner_sqlite_advanced_workers(tmpdir):
+    db_path = Path(tmpdir) / "workers.db"
+    create_messages_db(str(db_path))
+    # Interleave long messages, whose overflow pages may land in another worker's range than their cell
+    for i in range(200):
+        insert_message(str(db_path), i % 5, 0, "long message " * 400 if i % 7 == 0 else f"message {i}")
+
+    serial = SQLiteAdvancedPartitioner(
+        db_path, gid_as_principal_access_control_policy, generate_attribute_based_partition_policy("gid")
+    ).partition()
+    for workers in [1, 3]:
+        partitioner = SQLiteAdvancedPartitioner(
+            db_path,
+            gid_as_principal_access_control_policy,
+            generate_attribute_based_partition_policy("gid"),
+            columns={"message": [1]},
+            workers=workers,
+        )
+        assert partitioner.partition() == serial